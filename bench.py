@@ -0,0 +1,60 @@
+import argparse
+import json
+import sys
+from dataclasses import fields
+from pathlib import Path
+from build_lib.benchmark import BENCHMARK_PATH, DEFAULT_THRESHOLD, SyntheticRepoConfig, compare_results, load_result, measure_graph_memory, run_benchmark
+from build_lib.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Benchmark parsing, hashing, diffing and scheduling on a generated repository')
+    parser.add_argument('--config', type = Path, help = 'JSON file with the settings of the generated repository; options given on the command line override it')
+    defaults = SyntheticRepoConfig()
+    for setting in fields(SyntheticRepoConfig):
+        parser.add_argument(f'--{setting.name.replace("_", "-")}', dest = setting.name, type = type(getattr(defaults, setting.name)), help = f'(default: {getattr(defaults, setting.name)})')
+    parser.add_argument('--path', type = Path, default = BENCHMARK_PATH, help = f'Directory of the generated repository, inside this repository (default: {BENCHMARK_PATH})')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Repetitions of every phase; the median is reported (default: 3)')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Maximum number of modules built in parallel (default: number of CPUs)')
+    parser.add_argument('--hash-algorithm', choices = sorted(ALGORITHMS), default = DEFAULT_ALGORITHM)
+    parser.add_argument('--graph-memory', type = int, metavar = 'FILES', help = 'Only measure the memory of an in-memory module graph of FILES files, e.g. 1000000, instead of running the phases')
+    parser.add_argument('--output', type = Path, help = 'Write the results as JSON, e.g. to be used as a baseline later')
+    parser.add_argument('--baseline', type = Path, help = 'Compare against the results in this JSON file and exit with 1 on a regression')
+    parser.add_argument('--threshold', type = float, default = DEFAULT_THRESHOLD, help = f'Slowdown of a phase, as a fraction, reported as a regression (default: {DEFAULT_THRESHOLD})')
+    args = parser.parse_args()
+    if args.graph_memory is not None and args.graph_memory < 0:
+        parser.error(f'--graph-memory must not be negative, but found {args.graph_memory}')
+    if args.repeat < 1:
+        parser.error(f'--repeat must be at least 1, but found {args.repeat}')
+    return args
+
+def main() -> None:
+    args = parse_args()
+    json_data = {} if args.config is None else json.loads(args.config.read_text())
+    for setting in fields(SyntheticRepoConfig):
+        value = getattr(args, setting.name)
+        if value is not None:
+            json_data[setting.name] = value
+    config = SyntheticRepoConfig.from_json(json_data)
+
+    if args.graph_memory is not None:
+        memory = measure_graph_memory(config, args.graph_memory)
+        print(memory.format())
+        if args.output is not None:
+            args.output.write_text(json.dumps(memory.to_json(), indent = 4) + '\n')
+        return
+
+    result = run_benchmark(config, args.path.resolve(), args.repeat, args.jobs, args.hash_algorithm)
+    print(result.format())
+    current = result.to_json()
+    if args.output is not None:
+        args.output.write_text(json.dumps(current, indent = 4) + '\n')
+
+    if args.baseline is not None:
+        lines, regressed = compare_results(current, load_result(args.baseline), args.threshold)
+        print()
+        print('\n'.join(lines))
+        if regressed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Client of the build daemon. It only uses the standard library, so a request
+does not pay for importing `build_lib`.
+'''
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+BASE_PATH = Path(__file__).parent
+# Must match `build_lib.daemon.SOCKET_PATH`.
+SOCKET_PATH = BASE_PATH / '.build_cache' / 'daemon.sock'
+DAEMON_LOG_PATH = BASE_PATH / '.build_cache' / 'daemon.log'
+START_TIMEOUT = 30.0
+CLIENT_FLAGS = { '--connect', '--daemon-status', '--daemon-stop' }
+
+def is_client(argv: List[str]) -> bool:
+    return any(arg in CLIENT_FLAGS for arg in argv)
+
+def connect() -> socket.socket:
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.fspath(SOCKET_PATH))
+    except OSError:
+        client.close()
+        raise
+    return client
+
+def start_daemon(argv: List[str]) -> socket.socket:
+    '''
+    Starts a daemon in the background, configured by the options of the
+    first request, and waits until it accepts connections.
+    '''
+    SOCKET_PATH.parent.mkdir(parents = True, exist_ok = True)
+    with DAEMON_LOG_PATH.open('ab') as log:
+        subprocess.Popen([sys.executable, os.fspath(BASE_PATH / 'main.py'), '--daemon', *argv], cwd = BASE_PATH, stdin = subprocess.DEVNULL, stdout = log, stderr = log, start_new_session = True)
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            return connect()
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+def main(argv: List[str]) -> int:
+    if '--daemon-status' in argv:
+        command = 'status'
+    elif '--daemon-stop' in argv:
+        command = 'stop'
+    elif '--print-affected' in argv:
+        command = 'affected'
+    else:
+        command = 'build'
+    args = [arg for arg in argv if arg not in CLIENT_FLAGS]
+
+    try:
+        client = connect()
+    except OSError:
+        if command in ('status', 'stop'):
+            print('No build daemon is running', file = sys.stderr)
+            return 1
+        try:
+            client = start_daemon(args)
+        except OSError as e:
+            print(f'Failed to start the build daemon: {e} (see "{DAEMON_LOG_PATH}")', file = sys.stderr)
+            return 1
+
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps({ 'command': command, 'args': args }).encode() + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            match message.get('type'):
+                case 'text':
+                    sys.stdout.write(message['text'])
+                    sys.stdout.flush()
+                case 'exit':
+                    return int(message['code'])
+    print('The build daemon closed the connection', file = sys.stderr)
+    return 1
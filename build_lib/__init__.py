@@ -1,5 +1,6 @@
 from .parse_module_dep import parse_module
-from .diagnostics import StreamDiagnostics, DiagnosticKind, DiagnosticLocation, ListDiagnostics
-from .run_shell_cmds import run_shell
+from .module_graph import load_module_graph
+from .diagnostics import StreamDiagnostics, JsonLinesDiagnostics, TeeDiagnostics, DiagnosticKind, DiagnosticLocation, ListDiagnostics
+from .run_shell_cmds import run_shell, run_shell_async
 from .build_module_dep import build_module
-from .changed_files import parse_cached_file_checksums, get_changed_files_from_module, upsert_checksum
\ No newline at end of file
+from .changed_files import parse_cached_file_checksums, get_changed_files_from_module, get_changeset_from_module, upsert_checksum
\ No newline at end of file
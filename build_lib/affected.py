@@ -0,0 +1,29 @@
+from typing import Dict, Iterable, List, Set
+from .changed_files import ChangeSet, iter_modules
+from .parse_module_dep import Module
+
+def get_reverse_includes(module: Module) -> Dict[Module, List[Module]]:
+    '''
+    Maps every module reachable from `module` to the modules that include it.
+    '''
+    parents: Dict[Module, List[Module]] = { current: [] for current in iter_modules(module) }
+    for current in parents:
+        for include in current.includes:
+            parents[include].append(current)
+    return parents
+
+def get_affected_modules(module: Module, changes: ChangeSet, changed_modules: Iterable[Module] = ()) -> Set[Module]:
+    '''
+    Returns the modules owning an added, modified or removed file, plus
+    `changed_modules` and every module that transitively includes one of them.
+    '''
+    parents = get_reverse_includes(module)
+    affected: Set[Module] = set()
+    stack = [change.module for change in changes if change.has_changes()] + list(changed_modules)
+    while len(stack) > 0:
+        current = stack.pop()
+        if current in affected:
+            continue
+        affected.add(current)
+        stack.extend(parents.get(current, []))
+    return affected
@@ -0,0 +1,252 @@
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Optional
+from .hashing import hash_bytes, hash_file, split_checksum
+from .parse_module_dep import BASE_PATH, Module
+from .path_table import PATHS
+from .scheduler import BuildGraph
+from .stat_cache import CACHE_DIR_NAME, StatCache
+from .step_cache import hash_inputs
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # type: ignore
+
+ARTIFACT_STORE_PATH = BASE_PATH / CACHE_DIR_NAME / 'artifacts'
+DEFAULT_MAX_BYTES = 5 << 30
+OBJECT_ALGORITHM = 'sha256'
+KEY_ALGORITHM = 'sha256'
+# ioctl request that makes a file share the extents of another (Linux).
+FICLONE = 0x40049409
+
+def module_artifact_keys(module: Module, stat_cache: Optional[StatCache] = None) -> Dict[Module, str]:
+    '''
+    Key of the outputs of every module: a fingerprint of its steps, the
+    checksums of their declared inputs, the environment variables they name,
+    its source checksums and the keys of its includes.
+
+    Inputs that a step or build file of the graph produces are left out:
+    they may not be built yet, and their content follows from the key of
+    the module producing them.
+    '''
+    def repo_key(current: Module, path: str) -> str:
+        return PATHS.normalize(PATHS.join(current.dir_id, path))
+
+    graph = BuildGraph.from_module(module)
+    produced = { repo_key(current, path) for current in graph.nodes for step in current.steps for path in step.outputs }
+    produced.update(file.build_key for current in graph.nodes for file in current.files)
+
+    keys: Dict[Module, str] = {}
+    for node in graph.topological_order():
+        current = node.module
+        env = sorted({ name for step in current.steps for name in step.env })
+        inputs = [hash_inputs(current, [path for path in step.inputs if repo_key(current, path) not in produced], stat_cache) for step in current.steps]
+        data = {
+            'steps': [step.to_json() for step in current.steps],
+            'inputs': inputs,
+            'env': { name: os.environ.get(name) for name in env },
+            'files': sorted([file.src_key, file.build_key, file.checksum] for file in current.files),
+            'includes': sorted(keys[include] for include in current.includes),
+        }
+        keys[current] = split_checksum(hash_bytes(json.dumps(data, sort_keys = True).encode(), KEY_ALGORITHM))[1]
+    return keys
+
+def is_cacheable(module: Module) -> bool:
+    return len(module.steps) > 0 and len(module.files) > 0 and not any(step.is_builtin() for step in module.steps)
+
+def clone_file(src: Path, dst: Path, hardlink: bool = False) -> None:
+    '''
+    Materialises `src` at `dst` by reflink, then (if allowed) hardlink, then copy.
+    '''
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            os.chmod(dst, 0o644)
+            return
+        except OSError:
+            dst.unlink(missing_ok = True)
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+class ArtifactStore:
+    '''
+    Content-addressed store of module build outputs. An entry maps the
+    repository-relative build paths of a module to their content.
+    '''
+    def get(self, key: str) -> Optional[Mapping[str, str]]:
+        raise NotImplementedError
+
+    def restore(self, key: str, entry: Mapping[str, str], base_path: Path) -> bool:
+        raise NotImplementedError
+
+    def put(self, key: str, files: Mapping[str, Path]) -> None:
+        raise NotImplementedError
+
+class LocalArtifactStore(ArtifactStore):
+    '''
+    Store in a directory, which may live on a shared filesystem:
+
+        objects/<aa>/<digest>   file contents, written once and never modified
+        entries/<key>.json      build path -> object digest, plus total size
+
+    Files are written to a temporary name and renamed into place, so readers
+    never see partial data and concurrent writers of the same content agree.
+    Entry mtimes record the last use; when the store grows beyond `max_bytes`
+    the least recently used entries and their unreferenced objects are removed.
+    '''
+    def __init__(self, root: Path = ARTIFACT_STORE_PATH, max_bytes: int = DEFAULT_MAX_BYTES, hardlink: bool = False) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        # Hardlinked outputs share the object's inode; only safe when builds replace outputs instead of rewriting them.
+        self.hardlink = hardlink
+        self.objects_path = root / 'objects'
+        self.entries_path = root / 'entries'
+
+    @contextmanager
+    def lock(self, exclusive: bool) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        self.root.mkdir(parents = True, exist_ok = True)
+        with open(self.root / 'lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / digest
+
+    def entry_path(self, key: str) -> Path:
+        return self.entries_path / f'{key}.json'
+
+    def write_atomic(self, path: Path, write) -> None:
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok = True)
+
+    def get(self, key: str) -> Optional[Mapping[str, str]]:
+        path = self.entry_path(key)
+        try:
+            json_data = json.loads(path.read_text())
+            files = json_data['files']
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if type(files) != dict:
+            return None
+        return files
+
+    def restore(self, key: str, entry: Mapping[str, str], base_path: Path) -> bool:
+        with self.lock(exclusive = False):
+            for build_path, digest in entry.items():
+                if not self.object_path(digest).is_file():
+                    # Evicted or damaged; drop the entry so it is rebuilt.
+                    self.entry_path(key).unlink(missing_ok = True)
+                    return False
+
+            for build_path, digest in entry.items():
+                dst = base_path / build_path
+                dst.parent.mkdir(parents = True, exist_ok = True)
+                tmp_path = dst.with_name(f'.{dst.name}.{os.getpid()}.{threading.get_ident()}.restore')
+                tmp_path.unlink(missing_ok = True)
+                try:
+                    clone_file(self.object_path(digest), tmp_path, self.hardlink)
+                    os.replace(tmp_path, dst)
+                finally:
+                    tmp_path.unlink(missing_ok = True)
+        return True
+
+    def put(self, key: str, files: Mapping[str, Path]) -> None:
+        entry: Dict[str, str] = {}
+        size = 0
+        with self.lock(exclusive = False):
+            for build_path, path in files.items():
+                digest = split_checksum(hash_file(path, OBJECT_ALGORITHM))[1]
+                entry[build_path] = digest
+                object_path = self.object_path(digest)
+                size += path.stat().st_size
+                if object_path.exists():
+                    continue
+                def write(tmp_path: Path) -> None:
+                    shutil.copyfile(path, tmp_path)
+                    os.chmod(tmp_path, 0o444)
+                self.write_atomic(object_path, write)
+
+            json_data = json.dumps({ 'files': dict(sorted(entry.items())), 'size': size }, indent = 4)
+            self.write_atomic(self.entry_path(key), lambda tmp_path: tmp_path.write_text(json_data))
+        self.evict()
+
+    def evict(self) -> None:
+        with self.lock(exclusive = True):
+            entries: List[tuple] = []
+            total = 0
+            for path in self.entries_path.glob('*.json'):
+                try:
+                    json_data = json.loads(path.read_text())
+                    size = int(json_data['size'])
+                    entries.append((path.stat().st_mtime_ns, path, size))
+                except (OSError, ValueError, KeyError, TypeError):
+                    path.unlink(missing_ok = True)
+                    continue
+                total += size
+
+            if total <= self.max_bytes:
+                return
+
+            entries.sort(key = lambda item: item[0])
+            while total > self.max_bytes and len(entries) > 0:
+                _, path, size = entries.pop(0)
+                path.unlink(missing_ok = True)
+                total -= size
+
+            referenced = set()
+            for _, path, _ in entries:
+                try:
+                    referenced.update(json.loads(path.read_text())['files'].values())
+                except (OSError, ValueError, KeyError, TypeError):
+                    continue
+            for object_path in self.objects_path.glob('*/*'):
+                if object_path.name not in referenced and not object_path.name.startswith('.'):
+                    object_path.unlink(missing_ok = True)
+
+def restore_module_artifacts(store: ArtifactStore, module: Module, key: str) -> Optional[int]:
+    '''
+    Restores the build outputs of `module` stored under `key`; returns the number
+    of restored files, or `None` on a miss.
+    '''
+    entry = store.get(key)
+    if entry is None or set(entry) != { file.build_key for file in module.files }:
+        return None
+    if not store.restore(key, entry, BASE_PATH):
+        return None
+    return len(entry)
+
+def store_module_artifacts(store: ArtifactStore, module: Module, key: str) -> bool:
+    '''
+    Stores the build outputs of `module` under `key` if all of them exist.
+    '''
+    files = { file.build_key: file.get_build_path() for file in module.files }
+    if any(not path.is_file() for path in files.values()):
+        return False
+    store.put(key, files)
+    return True
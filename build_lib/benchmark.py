@@ -0,0 +1,350 @@
+from dataclasses import asdict, dataclass, field
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from .affected import get_affected_modules
+from .build_module_dep import build_module_async
+from .changed_files import FileChecksum, get_changed_files_from_changeset, get_changeset_from_module, iter_modules
+from .diagnostics import ListDiagnostics
+from .file_globs import GlobCache
+from .graph_cache import GraphCache
+from .hashing import DEFAULT_ALGORITHM, hash_files
+from .parse_module_dep import DependencyCmds, DependencyFiles, Module, parse_module
+from .path_table import PATHS
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME, StatCache
+
+# Generated repositories must live inside the repository, since file paths are stored relative to it.
+BENCHMARK_PATH = BASE_PATH / CACHE_DIR_NAME / 'benchmark'
+BENCHMARK_VERSION = 1
+DEFAULT_THRESHOLD = 0.1
+# Phases that measure the harness itself rather than the build system.
+UNCOMPARED_PHASES = { 'generate' }
+
+@dataclass
+class SyntheticRepoConfig:
+    # Number of modules, including the root.
+    modules: int = 200
+    # Includes added per module before the next level is started.
+    fan_out: int = 4
+    # Deepest level of includes; the root is at depth 0.
+    depth: int = 6
+    # Chance of a module being included a second time by a shallower module.
+    diamonds: float = 0.2
+    files_per_module: int = 20
+    # File sizes follow a log-normal distribution with this median.
+    file_size: int = 4096
+    file_size_sigma: float = 1.0
+    steps_per_module: int = 1
+    # Seconds every step sleeps; 0 runs `true`.
+    step_sleep: float = 0.0
+    # Fraction of the source files reported as modified by the diff phase.
+    changed: float = 0.05
+    seed: int = 0
+
+    @staticmethod
+    def from_json(json_data: dict) -> 'SyntheticRepoConfig':
+        config = SyntheticRepoConfig()
+        for key, value in json_data.items():
+            if not hasattr(config, key):
+                raise ValueError(f'Unknown benchmark setting: "{key}"')
+            if type(value) != type(getattr(config, key)) and not (type(value) == int and type(getattr(config, key)) == float):
+                raise ValueError(f'type of "{key}" must be a "{type(getattr(config, key)).__name__}", but found "{type(value).__name__}"')
+            setattr(config, key, value)
+        return config
+
+def module_dir(index: int) -> str:
+    return '.' if index == 0 else f'modules/m{index:05}'
+
+def generate_includes(config: SyntheticRepoConfig, rng: random.Random) -> List[List[int]]:
+    '''
+    Lays the modules out breadth first, giving every module up to `fan_out`
+    includes until `depth` is reached, then adds diamond edges from shallower
+    modules. Edges always point to deeper modules, so the graph is acyclic.
+    '''
+    includes: List[List[int]] = [[] for _ in range(config.modules)]
+    depths = [0] * config.modules
+    parent = 0
+    for index in range(1, config.modules):
+        while parent < index and (len(includes[parent]) >= config.fan_out or depths[parent] >= config.depth):
+            parent += 1
+        if parent >= index:
+            # Every slot is taken; widen the shallowest levels instead.
+            parent = min((i for i in range(index) if depths[i] < config.depth), key = lambda i: (len(includes[i]), depths[i]))
+        includes[parent].append(index)
+        depths[index] = depths[parent] + 1
+
+    levels: List[List[int]] = [[] for _ in range(max(depths) + 1)]
+    for index, depth in enumerate(depths):
+        levels[depth].append(index)
+    for index in range(1, config.modules):
+        if rng.random() >= config.diamonds:
+            continue
+        includer = rng.choice(levels[rng.randrange(depths[index])])
+        if index not in includes[includer]:
+            includes[includer].append(index)
+    return includes
+
+def generate_repo(config: SyntheticRepoConfig, path: Path = BENCHMARK_PATH) -> Tuple[int, int]:
+    '''
+    Writes a synthetic module tree to `path`, replacing its previous content.
+    Returns the number of files and their total size.
+    '''
+    rng = random.Random(config.seed)
+    if path.exists():
+        shutil.rmtree(path)
+    includes = generate_includes(config, rng)
+    cmd = 'true' if config.step_sleep <= 0 else f'sleep {config.step_sleep}'
+
+    file_count = 0
+    total_size = 0
+    for index in range(config.modules):
+        directory = path / module_dir(index)
+        (directory / 'src').mkdir(parents = True, exist_ok = True)
+        files = []
+        for number in range(config.files_per_module):
+            size = max(1, int(rng.lognormvariate(0, config.file_size_sigma) * config.file_size))
+            (directory / 'src' / f'f{number}.txt').write_bytes(rng.randbytes(size))
+            files.append({ 'uuid': f'{index}-{number}', 'path': f'build/f{number}.out', 'srcPath': f'src/f{number}.txt' })
+            file_count += 1
+            total_size += size
+
+        manifest = {
+            'name': f'Module {index}',
+            'includes': [os.path.relpath(path / module_dir(include), directory) for include in includes[index]],
+            'steps': [{ 'name': f'Step {step}', 'cmd': cmd } for step in range(config.steps_per_module)],
+            'files': files,
+        }
+        (directory / 'module.json').write_text(json.dumps(manifest, indent = 4))
+    return (file_count, total_size)
+
+def generate_graph(config: SyntheticRepoConfig, files: int) -> Module:
+    '''
+    Builds the module graph `generate_repo` would write, with `files` files
+    spread over the modules, in memory only, so graphs far larger than the
+    generated repository can be measured.
+    '''
+    rng = random.Random(config.seed)
+    includes = generate_includes(config, rng)
+    cmd = 'true' if config.step_sleep <= 0 else f'sleep {config.step_sleep}'
+    root = BENCHMARK_PATH.relative_to(BASE_PATH).as_posix()
+    modules: Dict[int, Module] = {}
+    # Includes always point to deeper modules, so they are created first.
+    for index in reversed(range(config.modules)):
+        directory = f'{root}/{module_dir(index)}'
+        count = files // config.modules + (1 if index < files % config.modules else 0)
+        module_files = []
+        for number in range(count):
+            file = DependencyFiles(uuid = f'{index}-{number}', build_path = f'{directory}/build/f{number}.out', src_path = f'{directory}/src/f{number}.txt')
+            file.checksum = rng.randbytes(16).hex()
+            module_files.append(file)
+        modules[index] = Module(
+            name = f'Module {index}',
+            path_id = PATHS.intern(f'{directory}/module.json'),
+            dir_id = PATHS.intern(directory),
+            includes = [modules[include] for include in includes[index]],
+            steps = [DependencyCmds(name = f'Step {step}', cmd = cmd) for step in range(config.steps_per_module)],
+            files = module_files,
+        )
+    return modules[0]
+
+@dataclass
+class GraphMemoryResult:
+    files: int
+    modules: int
+    # Memory allocated while the graph was built and still held by it, and the peak.
+    retained_bytes: int
+    peak_bytes: int
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+    def format(self) -> str:
+        per_file = self.retained_bytes / max(self.files, 1)
+        return f'{self.files} files in {self.modules} modules: {self.retained_bytes / (1 << 20):.1f}MiB retained ({per_file:.0f} bytes per file), {self.peak_bytes / (1 << 20):.1f}MiB peak'
+
+def measure_graph_memory(config: SyntheticRepoConfig, files: int) -> GraphMemoryResult:
+    '''
+    Memory of a generated graph of `files` files, as traced by `tracemalloc`;
+    unlike the peak RSS it does not include the interpreter or earlier phases.
+    '''
+    tracemalloc.start()
+    try:
+        module = generate_graph(config, files)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return GraphMemoryResult(files = sum(len(current.files) for current in iter_modules(module)), modules = config.modules, retained_bytes = retained, peak_bytes = peak)
+
+def peak_rss_kib() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere.
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+@dataclass
+class PhaseResult:
+    name: str
+    # Seconds of every repetition.
+    samples: List[float]
+    # Items processed per repetition, and their unit.
+    items: float
+    unit: str
+    peak_rss_kib: int
+
+    @property
+    def seconds(self) -> float:
+        return statistics.median(self.samples)
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else float('inf')
+
+    def to_json(self) -> dict:
+        return { 'seconds': self.seconds, 'samples': self.samples, 'items': self.items, 'unit': self.unit, 'throughput': self.throughput, 'peak_rss_kib': self.peak_rss_kib }
+
+@dataclass
+class BenchmarkResult:
+    config: SyntheticRepoConfig
+    phases: List[PhaseResult] = field(default_factory = list)
+
+    def to_json(self) -> dict:
+        return {
+            'version': BENCHMARK_VERSION,
+            'config': asdict(self.config),
+            'phases': { phase.name: phase.to_json() for phase in self.phases },
+            'peak_rss_kib': peak_rss_kib(),
+        }
+
+    def format(self) -> str:
+        lines = [f'{"Phase":<16} {"Median":>10} {"Throughput":>22} {"Peak RSS":>12}']
+        for phase in self.phases:
+            lines.append(f'{phase.name:<16} {phase.seconds:>9.4f}s {phase.throughput:>14.1f} {phase.unit + "/s":<7} {phase.peak_rss_kib / 1024:>9.1f}MiB')
+        return '\n'.join(lines)
+
+def time_phase(name: str, run: Callable[[], float], unit: str, repeat: int, setup: Optional[Callable[[], None]] = None) -> PhaseResult:
+    '''
+    Runs `run`, which returns the number of processed items, `repeat` times.
+    Only `run` is timed; `setup` prepares every repetition.
+    '''
+    samples: List[float] = []
+    items = 0.0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        items = run()
+        samples.append(time.perf_counter() - start)
+    return PhaseResult(name = name, samples = samples, items = items, unit = unit, peak_rss_kib = peak_rss_kib())
+
+def modified_baseline(module: Module, fraction: float, seed: int) -> List[FileChecksum]:
+    '''
+    Checksums as stored after the last build, with `fraction` of them changed.
+    '''
+    rng = random.Random(seed)
+    cached: List[FileChecksum] = []
+    for current in iter_modules(module):
+        for file in current.files:
+            checksum = file.checksum if rng.random() >= fraction else '0' * 32
+            cached.append(FileChecksum(Path(file.src_key), checksum))
+    return cached
+
+def run_benchmark(config: SyntheticRepoConfig, path: Path = BENCHMARK_PATH, repeat: int = 3, jobs: Optional[int] = None, algorithm: str = DEFAULT_ALGORITHM) -> BenchmarkResult:
+    result = BenchmarkResult(config = config)
+    counts: Dict[str, float] = {}
+
+    def generate() -> float:
+        counts['files'], counts['bytes'] = generate_repo(config, path)
+        return config.modules
+    result.phases.append(time_phase('generate', generate, 'modules', 1))
+
+    def parse_cold() -> float:
+        parse_module(path, StatCache(None), algorithm, GraphCache(None), GlobCache(None))
+        return config.modules
+    result.phases.append(time_phase('parse-cold', parse_cold, 'modules', repeat))
+
+    stat_cache = StatCache(None)
+    graph_cache = GraphCache(None)
+    glob_cache = GlobCache(None)
+    module = parse_module(path, stat_cache, algorithm, graph_cache, glob_cache)
+    def parse_warm() -> float:
+        parse_module(path, stat_cache, algorithm, graph_cache, glob_cache)
+        return config.modules
+    result.phases.append(time_phase('parse-warm', parse_warm, 'modules', repeat))
+
+    sources = [file.get_src_path() for current in iter_modules(module) for file in current.files]
+    def hash_sources() -> float:
+        hash_files(sources, algorithm)
+        return counts['bytes'] / (1 << 20)
+    result.phases.append(time_phase('hash', hash_sources, 'MiB', repeat))
+
+    cached = modified_baseline(module, config.changed, config.seed)
+    diagnostic = ListDiagnostics()
+    def diff() -> float:
+        changes = get_changeset_from_module(diagnostic, module, cached)
+        get_changed_files_from_changeset(diagnostic, module, changes, check_build_paths = False)
+        return len(cached)
+    result.phases.append(time_phase('diff', diff, 'files', repeat, setup = diagnostic.clear))
+
+    changes = get_changeset_from_module(diagnostic, module, cached)
+    def affected() -> float:
+        get_affected_modules(module, changes)
+        return config.modules
+    result.phases.append(time_phase('affected', affected, 'modules', repeat))
+
+    def build() -> float:
+        results = asyncio.run(build_module_async(diagnostic, module, jobs))
+        if not all(results.values()):
+            raise RuntimeError('Synthetic build failed')
+        return config.modules * config.steps_per_module
+    result.phases.append(time_phase('schedule', build, 'steps', repeat, setup = diagnostic.clear))
+    return result
+
+def load_result(path: Path) -> dict:
+    json_data = json.loads(path.read_text())
+    if type(json_data) != dict or json_data.get('version') != BENCHMARK_VERSION or type(json_data.get('phases')) != dict:
+        raise ValueError(f'Not a benchmark result: "{path}"')
+    return json_data
+
+def compare_results(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> Tuple[List[str], bool]:
+    '''
+    Compares the median time of every phase; a phase regressed when it is
+    more than `threshold` (a fraction) slower than in `baseline`. Returns the
+    report lines and whether any phase regressed.
+    '''
+    lines: List[str] = []
+    regressed = False
+    if current['config'] != baseline.get('config'):
+        lines.append('Warning: the baseline was recorded with a different configuration')
+
+    lines.append(f'{"Phase":<16} {"Baseline":>10} {"Current":>10} {"Change":>9}')
+    for name, phase in current['phases'].items():
+        if name in UNCOMPARED_PHASES:
+            continue
+        base = baseline['phases'].get(name)
+        if base is None:
+            lines.append(f'{name:<16} {"-":>10} {phase["seconds"]:>9.4f}s')
+            continue
+        change = phase['seconds'] / base['seconds'] - 1 if base['seconds'] > 0 else 0.0
+        marker = ''
+        if change > threshold:
+            marker = '  REGRESSION'
+            regressed = True
+        lines.append(f'{name:<16} {base["seconds"]:>9.4f}s {phase["seconds"]:>9.4f}s {change:>+8.1%}{marker}')
+
+    base_rss = baseline.get('peak_rss_kib')
+    if type(base_rss) == int and base_rss > 0:
+        change = current['peak_rss_kib'] / base_rss - 1
+        marker = ''
+        if change > threshold:
+            marker = '  REGRESSION'
+            regressed = True
+        lines.append(f'{"peak RSS":<16} {base_rss / 1024:>8.1f}Mi {current["peak_rss_kib"] / 1024:>8.1f}Mi {change:>+8.1%}{marker}')
+    return (lines, regressed)
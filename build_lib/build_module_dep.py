@@ -1,40 +1,189 @@
-from typing import MutableMapping
+from typing import AbstractSet, MutableMapping, Optional
 from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
-from .parse_module_dep import Module
+from .parse_module_dep import DependencyCmds, Module
 import asyncio
-from .run_shell_cmds import run_shell
+import time
+from .resources import ResourceBudget, ResourceGovernor
+from .run_shell_cmds import StepOutputOptions, run_shell_async
+from .deploy import Deployer
+from .artifact_store import ArtifactStore, is_cacheable, module_artifact_keys, restore_module_artifacts, store_module_artifacts
+from .scheduler import BuildGraph, run_graph
+from .sharding import SHARD_POLL_INTERVAL, ModuleDurations, ShardPlan
+from .step_cache import StepCache
+from .tracing import get_tracer, trace_span
 
-async def build_steps_async(diagnostic: DiagnosticBase, module: Module) -> bool:
-    for step in module.steps:
+# Delay before the first retry of a failed step; it doubles with every retry.
+RETRY_BACKOFF = 1.0
+MAX_RETRY_DELAY = 60.0
+
+def retry_delay(retry: int) -> float:
+    return min(MAX_RETRY_DELAY, RETRY_BACKOFF * 2 ** (retry - 1))
+
+async def run_step_async(diagnostic: DiagnosticBase, location: DiagnosticLocation, module: Module, step: DependencyCmds, output: Optional[StepOutputOptions] = None, deployer: Optional[Deployer] = None) -> bool:
+    if not step.is_deploy():
+        return await run_shell_async(diagnostic, location, step, output)
+    if deployer is None:
+        diagnostic.add(location, DiagnosticKind.WARNING, f'No deploy destination, skipping step: "{step.get_builtin()}"')
+        return True
+    return await asyncio.to_thread(deployer.deploy, diagnostic, location, module)
+
+async def build_steps_async(diagnostic: DiagnosticBase, module: Module, step_cache: Optional[StepCache] = None, output: Optional[StepOutputOptions] = None, governor: Optional[ResourceGovernor] = None, priority: float = 0.0, deployer: Optional[Deployer] = None) -> bool:
+    # The first step has no predecessor; '' keeps it cacheable.
+    previous: Optional[str] = ''
+    tracer = get_tracer()
+    for index, step in enumerate(module.steps):
+        runnable_ns = time.perf_counter_ns() if tracer is not None else 0
         location = DiagnosticLocation(path = module.path, prefix = step, resolved_base_path = module.resolve_base_path)
-        if not run_shell(diagnostic, location, step):
+        fingerprint = None if step_cache is None else step_cache.fingerprint(module, index, previous)
+        previous = fingerprint
+
+        if step_cache is not None and step_cache.is_fresh(module, index, fingerprint):
+            diagnostic.add(location, DiagnosticKind.SUCCESS, f'Cache hit, skipping step: "{step.name}"')
+            if tracer is not None:
+                tracer.add(step.name, 'step', runnable_ns, time.perf_counter_ns(), module = module.name, cached = True)
+            continue
+
+        success = False
+        for attempt in range(step.retries + 1):
+            if attempt > 0:
+                delay = retry_delay(attempt)
+                diagnostic.add(location, DiagnosticKind.WARNING, f'Retrying step: "{step.name}" in {delay:g}s (attempt {attempt + 1} of {step.retries + 1})')
+                # Resources are released while waiting, so other steps can use them.
+                await asyncio.sleep(delay)
+                runnable_ns = time.perf_counter_ns() if tracer is not None else 0
+            if governor is None:
+                start_ns = time.perf_counter_ns() if tracer is not None else 0
+                success = await run_step_async(diagnostic, location, module, step, output, deployer)
+            else:
+                async with governor.acquire(step.resources, priority):
+                    start_ns = time.perf_counter_ns() if tracer is not None else 0
+                    success = await run_step_async(diagnostic, location, module, step, output, deployer)
+            if tracer is not None:
+                tracer.add(step.name, 'step', start_ns, time.perf_counter_ns(), module = module.name, cached = False, success = success, wait_ms = (start_ns - runnable_ns) / 1e6, attempt = attempt)
+            if success:
+                break
+        if not success:
+            if step_cache is not None:
+                step_cache.invalidate(module, index)
             return False
+
+        if step_cache is not None:
+            step_cache.record(module, index, fingerprint)
     return True
     
 
-def build_module_helper(diagnostic: DiagnosticBase, module: Module, tasks: MutableMapping[Module, asyncio.Task]) -> None:
+async def build_single_module_async(diagnostic: DiagnosticBase, module: Module, step_cache: Optional[StepCache] = None, output: Optional[StepOutputOptions] = None, governor: Optional[ResourceGovernor] = None, priority: float = 0.0, deployer: Optional[Deployer] = None) -> bool:
     location = DiagnosticLocation.from_module(module)
     diagnostic.add(location, DiagnosticKind.INFO, f'Building module: "{module.name}"')
 
-    if (len(module.steps) > 0):
-        task = asyncio.create_task(build_steps_async(diagnostic, module), name=f'{module.name}_steps')
-        tasks[module] = task
-    else:
+    if len(module.steps) == 0:
         diagnostic.add(location, DiagnosticKind.INFO, f'No steps for module: "{module.name}"')
+        return True
 
-    for dep in module.includes:    
-        build_module_helper(diagnostic, dep, tasks)
-    
-    diagnostic.add(location, DiagnosticKind.INFO, f'Finished building module: "{module.name}"')
+    success = await build_steps_async(diagnostic, module, step_cache, output, governor, priority, deployer)
+    if success:
+        diagnostic.add(location, DiagnosticKind.INFO, f'Finished building module: "{module.name}"')
+    return success
+
+
+async def restore_artifacts_async(diagnostic: DiagnosticBase, store: ArtifactStore, module: Module, key: str) -> bool:
+    location = DiagnosticLocation.from_module(module)
+    try:
+        with trace_span('Restore artifacts', 'artifact', module = module.name) as args:
+            restored = await asyncio.to_thread(restore_module_artifacts, store, module, key)
+            if args is not None:
+                args['files'] = restored
+    except OSError as e:
+        diagnostic.add(location, DiagnosticKind.WARNING, f'Failed to restore artifacts of module: "{module.name}"\n\t{e}')
+        return False
+    if restored is None:
+        return False
+    diagnostic.add(location, DiagnosticKind.SUCCESS, f'Restored {restored} artifacts from cache, skipping steps of module: "{module.name}"')
+    return True
+
+async def wait_for_artifacts_async(diagnostic: DiagnosticBase, store: ArtifactStore, module: Module, key: str, timeout: float) -> bool:
+    '''
+    Restores the outputs of a module built by another shard, polling the
+    shared artifact store until that shard stored them or `timeout` passed.
+    '''
+    deadline = time.monotonic() + timeout
+    diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.INFO, f'Waiting for another shard to build module: "{module.name}"')
+    while not await restore_artifacts_async(diagnostic, store, module, key):
+        if time.monotonic() >= deadline:
+            diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.ERROR, f'Artifacts of module: "{module.name}" were not stored by another shard within {timeout:.0f}s')
+            return False
+        await asyncio.sleep(SHARD_POLL_INTERVAL)
+    return True
+
+async def store_artifacts_async(diagnostic: DiagnosticBase, store: ArtifactStore, module: Module, key: str) -> None:
+    location = DiagnosticLocation.from_module(module)
+    try:
+        with trace_span('Store artifacts', 'artifact', module = module.name):
+            stored = await asyncio.to_thread(store_module_artifacts, store, module, key)
+        if not stored:
+            diagnostic.add(location, DiagnosticKind.WARNING, f'Not caching artifacts of module: "{module.name}", some build files are missing')
+    except OSError as e:
+        diagnostic.add(location, DiagnosticKind.WARNING, f'Failed to store artifacts of module: "{module.name}"\n\t{e}')
+
+async def build_module_async(diagnostic: DiagnosticBase, module: Module, jobs: Optional[int] = None, only: Optional[AbstractSet[Module]] = None, step_cache: Optional[StepCache] = None, artifact_store: Optional[ArtifactStore] = None, output: Optional[StepOutputOptions] = None, budget: Optional[ResourceBudget] = None, durations: Optional[ModuleDurations] = None, shard: Optional[ShardPlan] = None, fail_fast: bool = False, deployer: Optional[Deployer] = None) -> MutableMapping[Module, bool]:
+    graph = BuildGraph.from_module(module) if durations is None else BuildGraph.from_module(module, durations.estimate)
+    if only is not None:
+        graph = graph.subgraph(only)
+    artifact_keys = {} if artifact_store is None else module_artifact_keys(module, None if step_cache is None else step_cache.stat_cache)
+    governor = None if budget is None else ResourceGovernor(budget)
+
+    def on_blocked(blocked: Module, failed: Module) -> None:
+        diagnostic.add(DiagnosticLocation.from_module(blocked), DiagnosticKind.ERROR, f'Skipping module: "{blocked.name}" because "{failed.name}" failed to build')
+
+    def on_cancelled(cancelled: Module, failed: Module) -> None:
+        diagnostic.add(DiagnosticLocation.from_module(cancelled), DiagnosticKind.ERROR, f'Cancelled module: "{cancelled.name}" because "{failed.name}" failed to build')
+
+    async def build(current: Module) -> bool:
+        if shard is not None and current in shard.foreign:
+            if artifact_store is None or not is_cacheable(current):
+                diagnostic.add(DiagnosticLocation.from_module(current), DiagnosticKind.ERROR, f'Module: "{current.name}" is built by another shard, but its artifacts cannot be restored')
+                return False
+            return await wait_for_artifacts_async(diagnostic, artifact_store, current, artifact_keys[current], shard.wait_timeout)
+
+        cacheable = is_cacheable(current)
+        if artifact_store is not None and cacheable and await restore_artifacts_async(diagnostic, artifact_store, current, artifact_keys[current]):
+            return True
 
+        start = time.perf_counter()
+        success = await build_single_module_async(diagnostic, current, step_cache, output, governor, graph.nodes[current].priority, deployer)
+        if success and durations is not None and len(current.steps) > 0:
+            durations.record(current, time.perf_counter() - start)
+        if not success:
+            diagnostic.add(DiagnosticLocation.from_module(current), DiagnosticKind.ERROR, f'Failed to build module: "{current.name}"')
+        elif artifact_store is not None and cacheable:
+            await store_artifacts_async(diagnostic, artifact_store, current, artifact_keys[current])
+        return success
 
-async def build_module_async(diagnostic: DiagnosticBase, module: Module) -> None:
-    tasks: MutableMapping[Module, asyncio.Task] = {}
-    build_module_helper(diagnostic, module, tasks)
-    for module, task in tasks.items():
-        if await task == False:
-            diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.ERROR, f'Failed to build module: "{module.name}"')
+    return await run_graph(graph, build, jobs = jobs, on_blocked = on_blocked, slotless = frozenset() if shard is None else shard.foreign, fail_fast = fail_fast, on_cancelled = on_cancelled)
 
-def build_module(diagnostic: DiagnosticBase, module: Module) -> Module:
-    asyncio.run(build_module_async(diagnostic, module))
-    return module
\ No newline at end of file
+def build_module(diagnostic: DiagnosticBase, module: Module, jobs: Optional[int] = None, only: Optional[AbstractSet[Module]] = None, step_cache: Optional[StepCache] = None, artifact_store: Optional[ArtifactStore] = None, output: Optional[StepOutputOptions] = None, budget: Optional[ResourceBudget] = None, durations: Optional[ModuleDurations] = None, shard: Optional[ShardPlan] = None, fail_fast: bool = False, deployer: Optional[Deployer] = None) -> MutableMapping[Module, bool]:
+    '''
+    Builds `module` and its includes, or only the modules in `only` when given.
+    Steps whose fingerprint matches their last successful run in `step_cache`
+    are skipped, and modules whose outputs are in `artifact_store` are restored
+    instead of built. `output` controls how step output is shown and logged.
+    With a `budget`, steps only start while their declared resources fit into it.
+    The build time of every module is recorded in `durations`. With a `shard`,
+    its foreign includes are restored from `artifact_store` instead of built.
+    With `fail_fast`, the first failure cancels the rest of the build.
+    Deploy steps publish the changed files through `deployer`.
+    Returns whether every built module succeeded.
+    '''
+    try:
+        return asyncio.run(build_module_async(diagnostic, module, jobs, only, step_cache, artifact_store, output, budget, durations, shard, fail_fast, deployer))
+    finally:
+        if step_cache is not None:
+            try:
+                step_cache.save()
+            except OSError as e:
+                diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.WARNING, f'Failed to save step cache\n\t{e}')
+        if durations is not None:
+            try:
+                durations.save()
+            except OSError as e:
+                diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.WARNING, f'Failed to save module durations\n\t{e}')
@@ -1,15 +1,18 @@
-from dataclasses import dataclass
-import json
+from dataclasses import dataclass, field
+import os
+import posixpath
+import sqlite3
 from pathlib import Path
-from typing import List, MutableMapping, MutableSet, Optional, Set, cast
+from typing import Dict, Iterable, Iterator, List, Mapping, MutableSet, Optional, Set, Union, cast
 from .parse_module_dep import DependencyFiles, Module
 from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
-from hashlib import md5
+from .checksum_store import CHECKSUM_FILE_NAME, ChecksumStore, JsonChecksumStore
+from .hashing import DEFAULT_ALGORITHM, checksum_matches, hash_file_async
+from .tracing import trace_span
 from os import environ
 import asyncio
 
 REPO_PATH = Path(__file__).parent.parent
-CHECKSUM_FILE_NAME = 'checksums.json'
 FILE_CHANGED_PATH = REPO_PATH / CHECKSUM_FILE_NAME
 
 @dataclass
@@ -28,48 +31,59 @@ class FileChecksum:
             diagnostic.add(location, DiagnosticKind.ERROR, f'Invalid checksum type: "{checksum}"')
             return None
         
+        # Files that no longer exist are kept; the diff reports them as removed.
         path = Path(path_str)
-
-        if not path.exists():
-            diagnostic.add(location, DiagnosticKind.ERROR, f'File not found: "{path}"')
-            return None
         
-        checksum.strip()
+        checksum = checksum.strip()
 
         if checksum == '':
             diagnostic.add(location, DiagnosticKind.INFO, f'Empty checksum for "{path}"')
 
         return FileChecksum(Path(path), checksum)
 
-def parse_cached_file_checksum_from_file(diagnostic: DiagnosticBase) -> Optional[List[FileChecksum]]:
+def normalize_repo_path(path: Union[Path, str]) -> str:
+    '''
+    Returns the key used to index checksums: a normalised, '/'-separated path
+    relative to the repository root.
+    '''
+    path_str = os.fspath(path)
+    if os.path.isabs(path_str):
+        path_str = os.path.relpath(path_str, REPO_PATH)
+    key = posixpath.normpath(Path(path_str).as_posix())
+    return '' if key == '.' else key
+
+def index_checksums(checksums: List[FileChecksum]) -> Dict[str, FileChecksum]:
+    return { normalize_repo_path(checksum.path): checksum for checksum in checksums }
+
+def parse_cached_file_checksum_from_file(diagnostic: DiagnosticBase, store: Optional[ChecksumStore] = None) -> Optional[List[FileChecksum]]:
     res: List[FileChecksum] = []
 
     location = DiagnosticLocation(path=Path(FILE_CHANGED_PATH.name), prefix=None, resolved_base_path=REPO_PATH)
-    if not FILE_CHANGED_PATH.exists():
+    if store is None:
+        store = JsonChecksumStore(FILE_CHANGED_PATH)
+
+    try:
+        json_data = store.read()
+    except (ValueError, OSError, sqlite3.Error) as e:
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to parse "{CHECKSUM_FILE_NAME}"\n\t{e}')
+        return res
+
+    if json_data is None:
         diagnostic.add(location, DiagnosticKind.INFO, f'Failed to find "{CHECKSUM_FILE_NAME}"')
         return None
-    
-    with FILE_CHANGED_PATH.open('r') as f:
-        data = f.read().strip()
-        if data == '':
-            diagnostic.add(location, DiagnosticKind.INFO, f'Empty "{CHECKSUM_FILE_NAME}"')
-            return res
-        try:
-            json_data = json.loads(data)
-            if type(json_data) != dict:
-                diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to parse "{CHECKSUM_FILE_NAME}"')
-                return res
-            for json_file in json_data.items():
-                file_checksum = FileChecksum.from_tuple(diagnostic, location, json_file)
-                if file_checksum is not None:
-                    res.append(file_checksum)
-        except json.JSONDecodeError as e:
-            diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to parse "{CHECKSUM_FILE_NAME}"\n\t{e}')
-            return res
+
+    if len(json_data) == 0:
+        diagnostic.add(location, DiagnosticKind.INFO, f'Empty "{CHECKSUM_FILE_NAME}"')
+        return res
+
+    for json_file in json_data.items():
+        file_checksum = FileChecksum.from_tuple(diagnostic, location, json_file)
+        if file_checksum is not None:
+            res.append(file_checksum)
         
     return res
 
-async def generate_changed_files(diagnostic: DiagnosticBase, path: Path) -> Optional[FileChecksum]:
+async def generate_changed_files(diagnostic: DiagnosticBase, path: Path, algorithm: str = DEFAULT_ALGORITHM) -> Optional[FileChecksum]:
     location = DiagnosticLocation(path=path, prefix=None, resolved_base_path=REPO_PATH)
     if not path.exists():
         diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to find "{path}"')
@@ -79,29 +93,33 @@ async def generate_changed_files(diagnostic: DiagnosticBase, path: Path) -> Opti
         diagnostic.add(location, DiagnosticKind.ERROR, f'"{path}" is not a file')
         return None
     
-    with path.open('r') as f:
-        data = f.read()
-        checksum = md5(data.encode()).hexdigest()
-        return FileChecksum(path, checksum)
+    try:
+        checksum = await hash_file_async(path, algorithm)
+    except OSError as e:
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to read "{path}"\n\t{e}')
+        return None
+    return FileChecksum(path, checksum)
     
-async def write_changed_files_to_file_helper(diagnostic: DiagnosticBase, paths: List[Path]) -> List[FileChecksum]:
-    res = await asyncio.gather(*[generate_changed_files(diagnostic, path) for path in paths])
+async def write_changed_files_to_file_helper(diagnostic: DiagnosticBase, paths: List[Path], algorithm: str = DEFAULT_ALGORITHM) -> List[FileChecksum]:
+    res = await asyncio.gather(*[generate_changed_files(diagnostic, path, algorithm) for path in paths])
     return [file for file in res if file is not None]
 
-def write_changed_files_to_file(diagnostic: DiagnosticBase, files: List[Path]) -> None:
+def write_changed_files_to_file(diagnostic: DiagnosticBase, files: List[Path], algorithm: str = DEFAULT_ALGORITHM, store: Optional[ChecksumStore] = None) -> None:
 
     location = DiagnosticLocation(path=Path(CHECKSUM_FILE_NAME), prefix=None, resolved_base_path=REPO_PATH)
     
-    changed_files = asyncio.run(write_changed_files_to_file_helper(diagnostic, files))
+    changed_files = asyncio.run(write_changed_files_to_file_helper(diagnostic, files, algorithm))
     
     if len(changed_files) == 0:
         diagnostic.add(location, DiagnosticKind.INFO, f'No files changed')
         return
 
+    if store is None:
+        store = JsonChecksumStore(FILE_CHANGED_PATH)
+
     try:
-        with FILE_CHANGED_PATH.open('w') as f:
-            json.dump({ (file.path, file.checksum) for file in changed_files}, f, indent=4)
-    except Exception as e:
+        store.upsert({ normalize_repo_path(file.path): file.checksum for file in changed_files })
+    except (ValueError, OSError, sqlite3.Error) as e:
         diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to write "{CHECKSUM_FILE_NAME}"\n\t{e}')
         return
 
@@ -132,63 +150,167 @@ def parse_space_separated_paths_escape(line: str, paths: List[Path], resolved_ba
         if path_buf.exists() and path_buf.is_file():
             paths.append(path_buf)
 
-def parse_cached_file_checksums(diagnostic: DiagnosticBase) -> Optional[List[FileChecksum]]:    
-    return parse_cached_file_checksum_from_file(diagnostic)
+def parse_cached_file_checksums(diagnostic: DiagnosticBase, store: Optional[ChecksumStore] = None) -> Optional[List[FileChecksum]]:    
+    return parse_cached_file_checksum_from_file(diagnostic, store)
 
-def get_changed_files_from_module_helper(diagnostic: DiagnosticBase, module: Module, changed_source_files: Optional[List[FileChecksum]], changed_files: MutableSet[DependencyFiles]) -> None:
-    for file in module.files:
-        if changed_source_files is None:
-            changed_files.add(file)
+@dataclass
+class ModuleChangeSet:
+    module: Module
+    added: List[DependencyFiles] = field(default_factory = list)
+    modified: List[DependencyFiles] = field(default_factory = list)
+    unchanged: List[DependencyFiles] = field(default_factory = list)
+    # Cached paths below the module's directory that no module declares any more.
+    removed: List[str] = field(default_factory = list)
+
+    def has_changes(self) -> bool:
+        return len(self.added) > 0 or len(self.modified) > 0 or len(self.removed) > 0
+
+@dataclass
+class ChangeSet:
+    modules: Dict[Module, ModuleChangeSet] = field(default_factory = dict)
+
+    def __iter__(self) -> Iterator[ModuleChangeSet]:
+        return iter(self.modules.values())
+
+    @property
+    def added(self) -> List[DependencyFiles]:
+        return [file for change in self for file in change.added]
+
+    @property
+    def modified(self) -> List[DependencyFiles]:
+        return [file for change in self for file in change.modified]
+
+    @property
+    def unchanged(self) -> List[DependencyFiles]:
+        return [file for change in self for file in change.unchanged]
+
+    @property
+    def removed(self) -> List[str]:
+        return [path for change in self for path in change.removed]
+
+def iter_modules(module: Module) -> Iterator[Module]:
+    '''
+    Yields every module reachable from `module` once, even if it is included
+    by several parents.
+    '''
+    seen: Set[int] = set()
+    stack = [module]
+    while len(stack) > 0:
+        current = stack.pop()
+        if id(current) in seen:
             continue
+        seen.add(id(current))
+        yield current
+        stack.extend(reversed(current.includes))
 
-        has_path = False
-        for changed_file in changed_source_files:
-            if file.src_path == changed_file.path and file.checksum != changed_file.checksum:
-                has_path = True
-                break
+def module_dir_key(module: Module) -> str:
+    return normalize_repo_path(module.resolve_base_path)
 
-        if has_path:
-            if not file.build_path.exists():
-                diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.ERROR, f'Dependency Found but build file "{file.build_path}" does not exist')
+def diff_module_checksums(module: Module, cached: Optional[Dict[str, FileChecksum]]) -> ChangeSet:
+    '''
+    Diffs the files of every module reachable from `module` against the `cached`
+    checksum index in one pass over the files. Without a cache every file is
+    reported as added.
+    '''
+    changes = ChangeSet()
+    declared: Set[str] = set()
+    owners: Dict[str, ModuleChangeSet] = {}
+
+    for current in iter_modules(module):
+        change = ModuleChangeSet(module = current)
+        changes.modules[current] = change
+        owners.setdefault(module_dir_key(current), change)
+        for file in current.files:
+            key = file.src_key
+            declared.add(key)
+            entry = None if cached is None else cached.get(key)
+            if entry is None:
+                change.added.append(file)
                 continue
-            changed_files.add(file)
-    
-    for include in module.includes:
-        get_changed_files_from_module_helper(diagnostic, include, changed_source_files, changed_files)
+            checksum = file.checksum
+            # The path is only needed to rehash with the stored algorithm.
+            if checksum == entry.checksum or checksum_matches(file.get_src_path(), checksum, entry.checksum):
+                change.unchanged.append(file)
+            else:
+                change.modified.append(file)
 
+    if cached is None:
+        return changes
 
-def get_changed_files_from_module(diagnostic: DiagnosticBase, module: Module, changed_source_files: Optional[List[FileChecksum]]) -> Set[DependencyFiles]:
+    root_change = changes.modules[module]
+    for key in cached:
+        if key in declared:
+            continue
+        # Attribute the stale entry to the deepest module directory containing it.
+        owner = root_change
+        parent = posixpath.dirname(key)
+        while True:
+            if parent in owners:
+                owner = owners[parent]
+                break
+            if parent == '':
+                break
+            parent = posixpath.dirname(parent)
+        owner.removed.append(key)
+
+    return changes
+
+def get_changeset_from_module(diagnostic: DiagnosticBase, module: Module, cached_checksums: Optional[List[FileChecksum]]) -> ChangeSet:
+    cached = None if cached_checksums is None else index_checksums(cached_checksums)
+    with trace_span('Diff checksums', 'diff'):
+        changes = diff_module_checksums(module, cached)
+    for change in changes:
+        if change.has_changes():
+            diagnostic.add(DiagnosticLocation.from_module(change.module), DiagnosticKind.INFO, f'{len(change.added)} added, {len(change.modified)} modified, {len(change.removed)} removed, {len(change.unchanged)} unchanged files')
+    return changes
+
+def get_changed_files_from_changeset(diagnostic: DiagnosticBase, module: Module, changes: ChangeSet, check_build_paths: bool = True) -> Set[DependencyFiles]:
     changed_files: MutableSet[DependencyFiles] = set()
-    get_changed_files_from_module_helper(diagnostic, module, changed_source_files, changed_files)
+    for change in changes:
+        for file in change.added + change.modified:
+            if check_build_paths and not file.get_build_path().exists():
+                diagnostic.add(DiagnosticLocation.from_module(change.module), DiagnosticKind.ERROR, f'Dependency Found but build file "{file.build_path}" does not exist')
+                continue
+            changed_files.add(file)
     diagnostic.add(DiagnosticLocation.from_module(module), DiagnosticKind.INFO, f'Found {len(changed_files)} changed files')
     return cast(Set, changed_files)
 
-def upsert_checksum(diagnostic: DiagnosticBase, changed_files: Set[DependencyFiles], only_for_actions = True) -> None:
+def get_changed_files_from_module(diagnostic: DiagnosticBase, module: Module, changed_source_files: Optional[List[FileChecksum]]) -> Set[DependencyFiles]:
+    changes = get_changeset_from_module(diagnostic, module, changed_source_files)
+    return get_changed_files_from_changeset(diagnostic, module, changes, check_build_paths = changed_source_files is not None)
+
+def get_removed_paths(changes: ChangeSet, results: Optional[Mapping[Module, bool]] = None) -> List[str]:
+    '''
+    Cached paths that no module declares any more. Paths owned by a module
+    that failed to build are kept, so the module stays affected.
+    '''
+    return [path for change in changes if results is None or results.get(change.module, True) for path in change.removed]
+
+def get_built_changeset(changes: ChangeSet, results: Mapping[Module, bool]) -> ChangeSet:
+    '''
+    Changes of the modules that built successfully. The files of a module
+    that failed, or was skipped because an include failed, stay changed.
+    '''
+    return ChangeSet(modules = { current: change for current, change in changes.modules.items() if results.get(current) is True })
+
+def upsert_checksum(diagnostic: DiagnosticBase, changed_files: Set[DependencyFiles], only_for_actions = True, store: Optional[ChecksumStore] = None, removed: Iterable[str] = ()) -> None:
     if only_for_actions and environ.get('GITHUB_ACTIONS') != 'true':
         return
     
     location = DiagnosticLocation(path=Path(CHECKSUM_FILE_NAME), prefix=None, resolved_base_path=REPO_PATH)
-    
-    if len(changed_files) == 0:
-        diagnostic.add(location, DiagnosticKind.INFO, f'No files changed')
-        return
 
-    old_json: MutableMapping[str, str] = {}
-    if FILE_CHANGED_PATH.exists():
-        try:
-            old_json = json.loads(FILE_CHANGED_PATH.read_text())
-        except Exception as e:
-            old_json = {}
-    
-    if type(old_json) != dict:
-        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to parse "{CHECKSUM_FILE_NAME}"')
+    if store is None:
+        store = JsonChecksumStore(FILE_CHANGED_PATH)
+
+    removed = list(removed)
+    if len(changed_files) == 0 and len(removed) == 0:
+        diagnostic.add(location, DiagnosticKind.INFO, f'No files changed')
         return
-    
-    for file in changed_files:
-        old_json[str(file.src_path)] = file.checksum
 
     try:
-        json.dump(old_json, FILE_CHANGED_PATH.open('w'), indent=4)
-    except Exception as e:
+        store.apply({ file.src_key: file.checksum for file in changed_files }, removed)
+    except (ValueError, OSError, sqlite3.Error) as e:
         diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to write "{CHECKSUM_FILE_NAME}"\n\t{e}')
-        return
\ No newline at end of file
+        return
+    if len(removed) > 0:
+        diagnostic.add(location, DiagnosticKind.INFO, f'Removed {len(removed)} checksums of files no module declares')
@@ -0,0 +1,202 @@
+from contextlib import closing
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Tuple
+from .hashing import hash_file
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+
+CHECKSUM_FILE_NAME = 'checksums.json'
+CHECKSUM_JSON_PATH = BASE_PATH / CHECKSUM_FILE_NAME
+CHECKSUM_SQLITE_PATH = BASE_PATH / CACHE_DIR_NAME / 'checksums.sqlite'
+
+def write_sorted_json(path: Path, items: Iterable[Tuple[str, Optional[str]]]) -> None:
+    '''
+    Atomically writes `items`, which must be sorted by path, as the JSON object
+    committed to the repository. Both backends produce byte-identical files.
+    '''
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with tmp_path.open('w') as f:
+            f.write('{')
+            separator = '\n'
+            for key, value in items:
+                f.write(f'{separator}    {json.dumps(key)}: {json.dumps(value)}')
+                separator = ',\n'
+            f.write('\n}\n' if separator != '\n' else '}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok = True)
+
+def read_json_checksums(path: Path) -> Optional[Dict[str, str]]:
+    '''
+    Returns `None` if `path` does not exist; raises `ValueError` if it is not
+    a JSON object.
+    '''
+    if not path.exists():
+        return None
+    data = path.read_text().strip()
+    if data == '':
+        return {}
+    json_data = json.loads(data)
+    if type(json_data) != dict:
+        raise ValueError(f'Expected a JSON object in "{path}"')
+    return json_data
+
+class ChecksumStore:
+    '''
+    Persistent mapping from repository-relative source paths to checksums.
+    '''
+    def read(self) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    def apply(self, entries: Mapping[str, str], removed: Iterable[str] = ()) -> None:
+        '''
+        Inserts or updates `entries` and deletes the `removed` paths in one
+        write of the store.
+        '''
+        raise NotImplementedError
+
+    def upsert(self, entries: Mapping[str, str]) -> None:
+        self.apply(entries)
+
+    def remove(self, paths: Iterable[str]) -> None:
+        self.apply({}, paths)
+
+    def export_json(self, path: Path) -> None:
+        raise NotImplementedError
+
+class JsonChecksumStore(ChecksumStore):
+    '''
+    Keeps the checksums only in the committed JSON file, rewritten through a
+    temporary file and a rename so a crash never leaves it half written.
+    '''
+    def __init__(self, path: Path = CHECKSUM_JSON_PATH) -> None:
+        self.path = path
+
+    def read(self) -> Optional[Dict[str, str]]:
+        return read_json_checksums(self.path)
+
+    def write(self, checksums: Mapping[str, str]) -> None:
+        write_sorted_json(self.path, sorted(checksums.items()))
+
+    def apply(self, entries: Mapping[str, str], removed: Iterable[str] = ()) -> None:
+        checksums = self.read() or {}
+        removed_count = sum(checksums.pop(path, None) is not None for path in removed)
+        if removed_count == 0 and all(checksums.get(key) == value for key, value in entries.items()):
+            return
+        checksums.update(entries)
+        self.write(checksums)
+
+    def export_json(self, path: Path) -> None:
+        write_sorted_json(path, sorted((self.read() or {}).items()))
+
+class SqliteChecksumStore(ChecksumStore):
+    '''
+    Keeps the checksums in SQLite and only touches the rows that change. The
+    committed JSON file stays the source of truth: it is re-imported whenever
+    it differs from what the database last exported, and exported (sorted)
+    after every change.
+    '''
+    def __init__(self, path: Path = CHECKSUM_SQLITE_PATH, json_path: Optional[Path] = CHECKSUM_JSON_PATH) -> None:
+        self.path = path
+        self.json_path = json_path
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is not None:
+            return self.connection
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, checksum TEXT NOT NULL) WITHOUT ROWID')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+        self.connection = connection
+        return connection
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def json_fingerprint(self) -> Optional[Tuple[str, str]]:
+        if self.json_path is None or not self.json_path.exists():
+            return None
+        st = self.json_path.stat()
+        return (f'{st.st_size}:{st.st_mtime_ns}:{st.st_ino}', hash_file(self.json_path))
+
+    def remember_json(self, connection: sqlite3.Connection) -> None:
+        fingerprint = self.json_fingerprint()
+        if fingerprint is None:
+            return
+        connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [('json_stat', fingerprint[0]), ('json_digest', fingerprint[1])])
+
+    def sync_from_json(self) -> bool:
+        '''
+        Re-imports the JSON file if it changed since the last import or export.
+        Returns `False` when neither the JSON file nor any import exists.
+        '''
+        connection = self.connect()
+        if self.json_path is None or not self.json_path.exists():
+            return self.get_meta('json_digest') is not None
+
+        st = self.json_path.stat()
+        if self.get_meta('json_stat') == f'{st.st_size}:{st.st_mtime_ns}:{st.st_ino}':
+            return True
+        fingerprint = self.json_fingerprint()
+        if fingerprint is not None and self.get_meta('json_digest') == fingerprint[1]:
+            with connection:
+                self.remember_json(connection)
+            return True
+
+        checksums = read_json_checksums(self.json_path) or {}
+        with connection:
+            connection.execute('DELETE FROM checksums')
+            connection.executemany('INSERT INTO checksums (path, checksum) VALUES (?, ?)', checksums.items())
+            self.remember_json(connection)
+        return True
+
+    def read(self) -> Optional[Dict[str, str]]:
+        if not self.sync_from_json():
+            return None
+        return dict(self.connect().execute('SELECT path, checksum FROM checksums'))
+
+    def apply(self, entries: Mapping[str, str], removed: Iterable[str] = ()) -> None:
+        self.sync_from_json()
+        connection = self.connect()
+        with connection:
+            before = connection.total_changes
+            connection.executemany('DELETE FROM checksums WHERE path = ?', ((path,) for path in removed))
+            connection.executemany(
+                'INSERT INTO checksums (path, checksum) VALUES (?, ?) ON CONFLICT (path) DO UPDATE SET checksum = excluded.checksum WHERE checksum != excluded.checksum',
+                entries.items(),
+            )
+            changed = connection.total_changes != before
+        if changed and self.json_path is not None:
+            self.export_json(self.json_path)
+
+    def iter_sorted(self) -> Iterator[Tuple[str, str]]:
+        with closing(self.connect().execute('SELECT path, checksum FROM checksums ORDER BY path')) as cursor:
+            yield from cursor
+
+    def export_json(self, path: Path) -> None:
+        write_sorted_json(path, self.iter_sorted())
+        if path == self.json_path:
+            connection = self.connect()
+            with connection:
+                self.remember_json(connection)
+
+def open_checksum_store(kind: str = 'json') -> ChecksumStore:
+    match kind:
+        case 'json': return JsonChecksumStore()
+        case 'sqlite': return SqliteChecksumStore()
+        case _: raise ValueError(f'Unknown checksum store: {kind}')
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from pprint import pformat
+from typing import Callable, List, Optional, Protocol, Sequence, Set
+from .affected import get_affected_modules
+from .build_module_dep import build_module_async
+from .changed_files import get_built_changeset, get_changed_files_from_changeset, get_changeset_from_module, get_removed_paths, iter_modules, parse_cached_file_checksums, upsert_checksum
+from .checksum_store import ChecksumStore
+from .deploy import Deployer
+from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticMessage, FilteredDiagnostics
+from .resources import ResourceBudget, physical_memory
+from .run_shell_cmds import StepOutputOptions
+from .scheduler import BuildGraph
+from .sharding import ModuleDurations
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+from .watch import WatchSession
+
+# `build_client.SOCKET_PATH` must match.
+SOCKET_PATH = BASE_PATH / CACHE_DIR_NAME / 'daemon.sock'
+DEFAULT_IDLE_TIMEOUT = 1800.0
+# How often the watcher thread checks whether the daemon stops.
+WATCH_INTERVAL = 1.0
+
+class SavableCache(Protocol):
+    '''
+    A cache the daemon writes back after every build.
+    '''
+    def save(self) -> None: ...
+
+class SocketDiagnostics(FilteredDiagnostics):
+    '''
+    Streams formatted messages to a client as JSON lines. Messages may be
+    added from any thread; they are written by the event loop in order.
+    '''
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, min_kind: DiagnosticKind = DiagnosticKind.INFO) -> None:
+        super().__init__(min_kind)
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, json_data: dict) -> None:
+        self.loop.call_soon_threadsafe(self.write, (json.dumps(json_data) + '\n').encode())
+
+    def write(self, data: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def emit(self, message: DiagnosticMessage) -> None:
+        self.send({ 'type': 'text', 'text': f'{message}\n' })
+
+    def print(self, text: str) -> None:
+        self.send({ 'type': 'text', 'text': f'{text}\n' })
+
+    async def finish(self, code: int) -> None:
+        self.send({ 'type': 'exit', 'code': code })
+        # Callbacks run in order, so every message was written once this one ran.
+        done = self.loop.create_future()
+        self.loop.call_soon_threadsafe(done.set_result, None)
+        await done
+        await self.writer.drain()
+
+class BuildDaemon(WatchSession):
+    '''
+    Keeps the module graph, the stat, graph and glob caches and the step cache
+    in memory and serves build requests on a Unix socket. File-change events
+    are collected in the background and applied before the next request, so
+    a request only rehashes the files that changed since the last one.
+    '''
+    def __init__(
+        self,
+        diagnostic: DiagnosticBase,
+        parse_request: Callable[[List[str]], argparse.Namespace],
+        checksum_store: ChecksumStore,
+        durations: Optional[ModuleDurations] = None,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        **kwargs,
+    ) -> None:
+        super().__init__(diagnostic, **kwargs)
+        self.log = diagnostic
+        self.parse_request = parse_request
+        self.checksum_store = checksum_store
+        self.durations = durations
+        self.idle_timeout = idle_timeout
+        self.pending: Set[Path] = set()
+        self.pending_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.clients = 0
+        self.requests = 0
+
+    def watch_files(self) -> None:
+        while not self.stopping.is_set():
+            changed = self.watcher.wait(WATCH_INTERVAL)
+            if len(changed) > 0:
+                with self.pending_lock:
+                    self.pending |= changed
+
+    def refresh(self) -> bool:
+        '''
+        Applies the file changes seen since the last request.
+        '''
+        with self.pending_lock:
+            changed = self.pending
+            self.pending = set()
+        if self.module is None or self.needs_reload(changed):
+            return self.load()
+        self.refresh_files(changed)
+        return True
+
+    def save_caches(self) -> None:
+        caches: Sequence[Optional[SavableCache]] = (self.stat_cache, self.graph_cache, self.glob_cache, self.step_cache, self.durations)
+        for cache in caches:
+            if cache is None:
+                continue
+            try:
+                cache.save()
+            except OSError as e:
+                self.diagnostic.add(None, DiagnosticKind.WARNING, f'Failed to save a cache\n\t{e}')
+
+    async def build(self, args: argparse.Namespace, diagnostic: SocketDiagnostics) -> int:
+        if not await asyncio.to_thread(self.refresh) or self.module is None:
+            return 1
+        module = self.module
+
+        files = parse_cached_file_checksums(diagnostic, self.checksum_store)
+        changes = get_changeset_from_module(diagnostic, module, files)
+        affected = set(iter_modules(module)) if args.full else get_affected_modules(module, changes)
+        if args.print_affected:
+            for node in BuildGraph.from_module(module).subgraph(affected).topological_order():
+                diagnostic.print(f'{node.module.name}\t{node.module.path}')
+            return 0
+
+        diagnostic.print(pformat(module))
+        output = StepOutputOptions(live = args.live_output, log_dir = None if args.no_step_logs else args.log_dir, tail_lines = args.output_tail)
+        budget = ResourceBudget(cpu = args.jobs if args.cpu_slots is None else args.cpu_slots, memory = physical_memory() if args.memory_budget is None else args.memory_budget)
+        deployer = Deployer(args.deploy_dir, changes, args.jobs)
+        results = await build_module_async(diagnostic, module, args.jobs, affected, self.step_cache, self.artifact_store, output, budget, self.durations, fail_fast = args.fail_fast, deployer = deployer)
+        changed_files = get_changed_files_from_changeset(diagnostic, module, get_built_changeset(changes, results), check_build_paths = files is not None)
+        changed_files -= deployer.undeployed(changed_files)
+        diagnostic.print(str(changed_files))
+        upsert_checksum(diagnostic, changed_files, store = self.checksum_store, removed = get_removed_paths(changes, results))
+        await asyncio.to_thread(self.save_caches)
+        return 0 if all(results.values()) else 1
+
+    def status(self, diagnostic: SocketDiagnostics) -> int:
+        now = time.monotonic()
+        with self.pending_lock:
+            pending = len(self.pending)
+        lines = [
+            f'pid: {os.getpid()}',
+            f'uptime: {now - self.started:.0f}s',
+            f'requests: {self.requests}',
+            f'modules: {0 if self.module is None else sum(1 for _ in iter_modules(self.module))}',
+            f'watched files: {len(self.manifests) + len(self.owners)}',
+            f'pending changes: {pending}',
+            f'stat cache: {self.stat_cache.hits} hits, {self.stat_cache.misses} misses',
+            f'idle timeout: {self.idle_timeout:.0f}s',
+        ]
+        diagnostic.print('\n'.join(lines))
+        return 0
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, lock: asyncio.Lock) -> None:
+        self.clients += 1
+        try:
+            line = await reader.readline()
+            request = json.loads(line)
+            command = request.get('command')
+            argv = request.get('args', [])
+            if type(argv) != list or any(type(arg) != str for arg in argv):
+                raise ValueError(f'Invalid request arguments: {argv}')
+            loop = asyncio.get_running_loop()
+
+            # Status and stop requests do not depend on the build options.
+            match command:
+                case 'status':
+                    diagnostic = SocketDiagnostics(loop, writer)
+                    await diagnostic.finish(self.status(diagnostic))
+                    return
+                case 'stop':
+                    diagnostic = SocketDiagnostics(loop, writer)
+                    diagnostic.add(None, DiagnosticKind.INFO, 'Stopping the build daemon')
+                    self.stopping.set()
+                    await diagnostic.finish(0)
+                    return
+
+            try:
+                args = self.parse_request(argv)
+            except ValueError as e:
+                diagnostic = SocketDiagnostics(loop, writer)
+                diagnostic.add(None, DiagnosticKind.ERROR, f'Invalid request: {e}')
+                await diagnostic.finish(2)
+                return
+            diagnostic = SocketDiagnostics(loop, writer, DiagnosticKind.from_name(args.log_level))
+
+            match command:
+                case 'build' | 'affected':
+                    async with lock:
+                        self.requests += 1
+                        # The session reports reloads through `self.diagnostic`.
+                        self.diagnostic = diagnostic
+                        try:
+                            code = await self.build(args, diagnostic)
+                        finally:
+                            self.diagnostic = self.log
+                case _:
+                    diagnostic.add(None, DiagnosticKind.ERROR, f'Unknown request: {command}')
+                    code = 2
+            await diagnostic.finish(code)
+        except (ValueError, ConnectionError) as e:
+            self.log.add(None, DiagnosticKind.WARNING, f'Dropped a request\n\t{e}')
+        finally:
+            self.clients -= 1
+            self.last_active = time.monotonic()
+            writer.close()
+
+    def claim_socket(self, path: Path) -> None:
+        '''
+        Removes a socket left behind by a daemon that did not shut down, but
+        refuses to replace a running daemon.
+        '''
+        if not path.exists():
+            path.parent.mkdir(parents = True, exist_ok = True)
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(os.fspath(path))
+        except OSError:
+            path.unlink(missing_ok = True)
+            return
+        finally:
+            probe.close()
+        raise OSError(f'A build daemon is already listening on "{path}"')
+
+    async def serve(self, path: Path = SOCKET_PATH) -> None:
+        self.claim_socket(path)
+        lock = asyncio.Lock()
+        server = await asyncio.start_unix_server(lambda reader, writer: self.handle_client(reader, writer, lock), path = os.fspath(path))
+        async with lock:
+            await asyncio.to_thread(self.load)
+        watcher = threading.Thread(target = self.watch_files, name = 'watcher', daemon = True)
+        watcher.start()
+        self.log.add(None, DiagnosticKind.INFO, f'Build daemon {os.getpid()} listening on "{path}"')
+        try:
+            while not self.stopping.is_set():
+                await asyncio.sleep(WATCH_INTERVAL)
+                if self.clients == 0 and time.monotonic() - self.last_active >= self.idle_timeout:
+                    self.log.add(None, DiagnosticKind.INFO, f'No requests for {self.idle_timeout:.0f}s, stopping')
+                    break
+        finally:
+            self.stopping.set()
+            server.close()
+            await server.wait_closed()
+            path.unlink(missing_ok = True)
+            watcher.join()
+            self.watcher.close()
+            self.save_caches()
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
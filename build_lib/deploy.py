@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from .changed_files import ChangeSet, get_changed_files_from_changeset, iter_modules
+from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
+from .hashing import hash_file
+from .parse_module_dep import DependencyFiles, Module
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+
+# Local stand-in for the bucket the build outputs are published to.
+DEPLOY_PATH = BASE_PATH / CACHE_DIR_NAME / 'deploy'
+DEPLOY_MANIFEST_NAME = 'manifest.json'
+DEPLOY_MANIFEST_VERSION = 1
+DEPLOY_ALGORITHM = 'sha256'
+DEFAULT_DEPLOY_JOBS = min(32, (os.cpu_count() or 1) + 4)
+COPY_CHUNK_SIZE = 1 << 30
+
+def copy_file_contents(src: Path, dst: Path) -> None:
+    '''
+    Copies `src` to `dst` inside the kernel with `copy_file_range`, or
+    `sendfile` where that is not supported, falling back to a buffered copy.
+    '''
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+        remaining = os.fstat(src_fd).st_size
+        offset = 0
+        for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if copy is None:
+                continue
+            try:
+                while remaining > 0:
+                    if copy is os.sendfile:
+                        copied = os.sendfile(dst_fd, src_fd, offset, min(remaining, COPY_CHUNK_SIZE))
+                    else:
+                        copied = os.copy_file_range(src_fd, dst_fd, min(remaining, COPY_CHUNK_SIZE), offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                    remaining -= copied
+                return
+            except OSError:
+                if offset > 0:
+                    raise
+        shutil.copyfileobj(src_file, dst_file)
+
+@dataclass
+class DeployEntry:
+    checksum: str
+    size: int
+
+    def to_json(self) -> dict:
+        return { 'checksum': self.checksum, 'size': self.size }
+
+class Deployer:
+    '''
+    Publishes the changed build files of the modules with a deploy step to a
+    directory that mirrors their repository paths:
+
+        <build_path>    published file
+        manifest.json   build path -> checksum and size of the published file
+
+    Files are copied in parallel; a file whose content is already published
+    at its path is skipped. Every file is written to a temporary name and
+    renamed into place, and the manifest is replaced only after all copies
+    succeeded, so it never lists content that is not there.
+
+    `modules` limits the deploy steps this build runs, e.g. to the modules of
+    a shard; the deploy steps of other modules are left to their own build.
+    '''
+    def __init__(self, destination: Path, changes: ChangeSet, jobs: int = DEFAULT_DEPLOY_JOBS, modules: Optional[Set[Module]] = None) -> None:
+        self.destination = destination
+        self.changes = changes
+        self.jobs = jobs
+        self.modules = modules
+        self.manifest: Optional[Dict[str, DeployEntry]] = None
+        self.lock = threading.Lock()
+        # Changed files published by this build.
+        self.published: Set[DependencyFiles] = set()
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.destination / DEPLOY_MANIFEST_NAME
+
+    def load_manifest(self) -> Dict[str, DeployEntry]:
+        if self.manifest is not None:
+            return self.manifest
+        self.manifest = {}
+        try:
+            json_data = json.loads(self.manifest_path.read_text())
+            if json_data.get('version') == DEPLOY_MANIFEST_VERSION:
+                for build_path, entry in json_data['files'].items():
+                    self.manifest[build_path] = DeployEntry(checksum = entry['checksum'], size = entry['size'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Without a manifest the content at the destination is compared instead.
+            self.manifest = {}
+        return self.manifest
+
+    def save_manifest(self) -> None:
+        manifest = self.load_manifest()
+        json_data = {
+            'version': DEPLOY_MANIFEST_VERSION,
+            'files': { build_path: manifest[build_path].to_json() for build_path in sorted(manifest) },
+        }
+        self.destination.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.manifest_path.with_name(f'.{DEPLOY_MANIFEST_NAME}.{os.getpid()}.tmp')
+        try:
+            tmp_path.write_text(json.dumps(json_data, indent = 4))
+            os.replace(tmp_path, self.manifest_path)
+        finally:
+            tmp_path.unlink(missing_ok = True)
+
+    def is_published(self, build_path: str, checksum: str, size: int) -> bool:
+        target = self.destination / build_path
+        try:
+            target_size = target.stat().st_size
+        except OSError:
+            return False
+        if target_size != size:
+            return False
+        entry = self.load_manifest().get(build_path)
+        if entry is not None:
+            return entry.checksum == checksum
+        return hash_file(target, DEPLOY_ALGORITHM) == checksum
+
+    def publish_file(self, file: DependencyFiles) -> Tuple[str, DeployEntry, bool]:
+        '''
+        Publishes one build file unless its content is already at the target;
+        returns its manifest entry and whether it was copied.
+        '''
+        build_path = file.build_key
+        src = file.get_build_path()
+        entry = DeployEntry(checksum = hash_file(src, DEPLOY_ALGORITHM), size = src.stat().st_size)
+        if self.is_published(build_path, entry.checksum, entry.size):
+            return build_path, entry, False
+        target = self.destination / build_path
+        target.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}.deploy')
+        try:
+            copy_file_contents(src, tmp_path)
+            os.replace(tmp_path, target)
+        finally:
+            tmp_path.unlink(missing_ok = True)
+        return build_path, entry, True
+
+    def changed_files(self, diagnostic: DiagnosticBase, module: Module) -> Set[DependencyFiles]:
+        '''
+        Changed files of `module` and every module it includes.
+        '''
+        changes = ChangeSet(modules = { current: self.changes.modules[current] for current in iter_modules(module) if current in self.changes.modules })
+        return get_changed_files_from_changeset(diagnostic, module, changes)
+
+    def deploy(self, diagnostic: DiagnosticBase, location: DiagnosticLocation, module: Module) -> bool:
+        files = sorted(self.changed_files(diagnostic, module), key = lambda file: file.build_key)
+        if len(files) == 0:
+            diagnostic.add(location, DiagnosticKind.INFO, 'Nothing to deploy')
+            return True
+        diagnostic.add(location, DiagnosticKind.INFO, f'Deploying {len(files)} changed files to "{self.destination}"')
+
+        # Deploy steps of different modules may publish the same files.
+        with self.lock:
+            manifest = self.load_manifest()
+            with ThreadPoolExecutor(max_workers = min(self.jobs, len(files)), thread_name_prefix = 'deploy') as executor:
+                futures = [(file, executor.submit(self.publish_file, file)) for file in files]
+                copied = 0
+                published: List[DependencyFiles] = []
+                for file, future in futures:
+                    try:
+                        build_path, entry, was_copied = future.result()
+                    except OSError as e:
+                        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to deploy "{file.build_path}"\n\t{e}')
+                        continue
+                    manifest[build_path] = entry
+                    copied += was_copied
+                    published.append(file)
+
+            try:
+                self.save_manifest()
+            except OSError as e:
+                diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to write the deploy manifest "{self.manifest_path}"\n\t{e}')
+                return False
+            if len(published) != len(files):
+                return False
+            self.published.update(published)
+
+        diagnostic.add(location, DiagnosticKind.SUCCESS, f'Deployed {copied} files, {len(files) - copied} already up to date')
+        return True
+
+    def undeployed(self, changed_files: Set[DependencyFiles]) -> Set[DependencyFiles]:
+        '''
+        Changed files that a deploy step should have published but did not, so
+        their checksums must not be recorded yet.
+        '''
+        scope: Set[DependencyFiles] = set()
+        for module in self.changes.modules:
+            if self.modules is not None and module not in self.modules:
+                continue
+            if any(step.is_deploy() for step in module.steps):
+                for current in iter_modules(module):
+                    scope.update(current.files)
+        return { file for file in changed_files if file in scope and file not in self.published }
@@ -1,25 +1,54 @@
 from dataclasses import dataclass
 from enum import Enum, auto
+import atexit
+import json
+import queue
+import re
+import threading
+import time
+import weakref
 from pathlib import Path
-from typing import IO, List, Optional, Union, cast
+from typing import IO, List, Optional, Sequence, Union, cast
 from .parse_module_dep import DependencyCmds, Module
 from colorama import Fore, Style
 
+DEFAULT_FLUSH_INTERVAL = 0.1
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
 class DiagnosticKind(Enum):
     ERROR = auto()
     WARNING = auto()
     INFO = auto()
     SUCCESS = auto()
 
+    @staticmethod
+    def from_name(name: str) -> 'DiagnosticKind':
+        try:
+            return DiagnosticKind[name.upper()]
+        except KeyError:
+            raise ValueError(f'Unknown diagnostic level: {name}')
+
     def __str__(self) -> str:
-        prefix = ''
-        match self:
-            case DiagnosticKind.ERROR: prefix = f'{Fore.RED}'
-            case DiagnosticKind.WARNING: prefix = f'{Fore.YELLOW}'
-            case DiagnosticKind.INFO: prefix = f'{Fore.BLUE}'
-            case DiagnosticKind.SUCCESS: prefix = f'{Fore.GREEN}'
-        max_len = max(len(kind.name) for kind in DiagnosticKind)
-        return f'{prefix} {self.name:<{max_len}}:{Style.RESET_ALL}'
+        return KIND_PREFIX[self]
+
+KIND_SEVERITY = {
+    DiagnosticKind.INFO: 0,
+    DiagnosticKind.SUCCESS: 1,
+    DiagnosticKind.WARNING: 2,
+    DiagnosticKind.ERROR: 3,
+}
+
+def format_kind(kind: DiagnosticKind) -> str:
+    prefix = ''
+    match kind:
+        case DiagnosticKind.ERROR: prefix = f'{Fore.RED}'
+        case DiagnosticKind.WARNING: prefix = f'{Fore.YELLOW}'
+        case DiagnosticKind.INFO: prefix = f'{Fore.BLUE}'
+        case DiagnosticKind.SUCCESS: prefix = f'{Fore.GREEN}'
+    max_len = max(len(kind.name) for kind in DiagnosticKind)
+    return f'{prefix} {kind.name:<{max_len}}:{Style.RESET_ALL}'
+
+KIND_PREFIX = { kind: format_kind(kind) for kind in DiagnosticKind }
 
 @dataclass
 class DiagnosticLocation:
@@ -52,8 +81,20 @@ class DiagnosticMessage:
 
     def __str__(self) -> str:
         if self.location is None:
-            return f'{self.kind}: {self.message}'
-        return f'{self.kind} {self.location}: {self.message}'
+            return f'{KIND_PREFIX[self.kind]}: {self.message}'
+        return f'{KIND_PREFIX[self.kind]} {self.location}: {self.message}'
+
+    def to_json(self) -> dict:
+        json_data: dict = { 'kind': self.kind.name.lower(), 'message': ANSI_ESCAPE.sub('', self.message) }
+        if self.location is None:
+            return json_data
+        json_data['path'] = str(self.location.path)
+        match self.location.prefix:
+            case Module() as module:
+                json_data['module'] = module.name
+            case DependencyCmds() as cmd:
+                json_data['step'] = cmd.get_builtin() if cmd.is_builtin() else cmd.name
+        return json_data
 
 class DiagnosticBase:
     def add_message(self, message: DiagnosticMessage) -> None:
@@ -62,6 +103,13 @@ class DiagnosticBase:
     def add(self, location: Optional[DiagnosticLocation], kind: DiagnosticKind, message: str) -> None:
         self.add_message(DiagnosticMessage(location = location, message = message, kind = kind))
     
+    def is_enabled(self, kind: DiagnosticKind) -> bool:
+        '''
+        Whether messages of `kind` are kept; callers can skip building
+        expensive messages that would be dropped.
+        '''
+        return True
+    
     def has_errors(self) -> bool:
         raise NotImplementedError
     
@@ -70,35 +118,223 @@ class DiagnosticBase:
     
     def has_infos(self) -> bool:
         raise NotImplementedError
+    
+    def flush(self) -> None:
+        pass
+    
+    def close(self) -> None:
+        self.flush()
+    
+    def __enter__(self) -> 'DiagnosticBase':
+        return self
+    
+    def __exit__(self, *args) -> None:
+        self.close()
 
-class StreamDiagnostics(DiagnosticBase):
-    def __init__(self, writer: IO) -> None:
-        self.writer = writer
+class FilteredDiagnostics(DiagnosticBase):
+    '''
+    Counts every message and drops those below `min_kind` before a message
+    object is even created; subclasses only `emit` the kept ones.
+    '''
+    def __init__(self, min_kind: DiagnosticKind = DiagnosticKind.INFO) -> None:
+        self.min_severity = KIND_SEVERITY[min_kind]
+        # Number of messages per severity, whether kept or not.
+        self.counts: List[int] = [0] * len(DiagnosticKind)
+    
+    def emit(self, message: DiagnosticMessage) -> None:
+        raise NotImplementedError
+    
+    def is_enabled(self, kind: DiagnosticKind) -> bool:
+        return KIND_SEVERITY[kind] >= self.min_severity
+    
+    def count(self, kind: DiagnosticKind) -> int:
+        return self.counts[KIND_SEVERITY[kind]]
     
     def add_message(self, message: DiagnosticMessage) -> None:
-        self.writer.write(f'{message}\n')
+        severity = KIND_SEVERITY[message.kind]
+        self.counts[severity] += 1
+        if severity >= self.min_severity:
+            self.emit(message)
     
     def add(self, location: Optional[DiagnosticLocation], kind: DiagnosticKind, message: str) -> None:
-        self.add_message(DiagnosticMessage(location = location, message = message, kind = kind))
+        severity = KIND_SEVERITY[kind]
+        self.counts[severity] += 1
+        if severity >= self.min_severity:
+            self.emit(DiagnosticMessage(location = location, message = message, kind = kind))
+    
+    def has_errors(self) -> bool:
+        return self.count(DiagnosticKind.ERROR) > 0
+    
+    def has_warnings(self) -> bool:
+        return self.count(DiagnosticKind.WARNING) > 0
+    
+    def has_infos(self) -> bool:
+        return self.count(DiagnosticKind.INFO) > 0
 
-class ListDiagnostics(DiagnosticBase):
-    def __init__(self) -> None:
-        self.messages: List[DiagnosticMessage] = []
+class WriterDiagnostics(FilteredDiagnostics):
+    '''
+    Formats kept messages and writes them to `writer`. By default every
+    line is written right away. In the background mode a thread formats and
+    writes, flushing whenever it has caught up; with a `buffer_size`, lines
+    are buffered until that many characters accumulate, an error arrives or
+    `flush_interval` seconds passed. Both flush at exit if not closed.
+    '''
+    def __init__(
+        self,
+        writer: IO,
+        min_kind: DiagnosticKind = DiagnosticKind.INFO,
+        background: bool = False,
+        buffer_size: int = 0,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ) -> None:
+        super().__init__(min_kind)
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending: List[str] = []
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+        self.queue: Optional[queue.SimpleQueue] = None
+        self.thread: Optional[threading.Thread] = None
+        if background:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(target = self.run_writer, name = 'diagnostics', daemon = True)
+            self.thread.start()
+        if background or buffer_size > 0:
+            # A weak reference, so the writer can still be collected before exit.
+            atexit.register(flush_at_exit, weakref.ref(self))
+    
+    def format(self, message: DiagnosticMessage) -> str:
+        raise NotImplementedError
+    
+    def emit(self, message: DiagnosticMessage) -> None:
+        if self.queue is not None:
+            self.queue.put(message)
+            return
+        line = self.format(message)
+        with self.lock:
+            self.pending.append(line)
+            self.pending_size += len(line)
+            now = time.monotonic()
+            if self.pending_size < self.buffer_size and message.kind != DiagnosticKind.ERROR and now - self.last_flush < self.flush_interval:
+                return
+            self.write_pending()
+            self.last_flush = now
+    
+    def write_pending(self) -> None:
+        if len(self.pending) == 0:
+            return
+        self.writer.write(''.join(self.pending))
+        self.writer.flush()
+        self.pending = []
+        self.pending_size = 0
+    
+    def run_writer(self) -> None:
+        assert self.queue is not None
+        while True:
+            # Drain everything queued so far, so bursts become one write.
+            item = self.queue.get()
+            lines: List[str] = []
+            while True:
+                if item is None:
+                    self.writer.write(''.join(lines))
+                    self.writer.flush()
+                    return
+                if isinstance(item, threading.Event):
+                    self.writer.write(''.join(lines))
+                    self.writer.flush()
+                    lines = []
+                    item.set()
+                else:
+                    lines.append(self.format(item))
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.writer.write(''.join(lines))
+            self.writer.flush()
+    
+    def flush(self) -> None:
+        if self.queue is not None:
+            if self.thread is not None and self.thread.is_alive():
+                done = threading.Event()
+                self.queue.put(done)
+                done.wait()
+            return
+        with self.lock:
+            self.write_pending()
+            self.last_flush = time.monotonic()
+    
+    def close(self) -> None:
+        if self.queue is not None and self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            return
+        self.flush()
+
+def flush_at_exit(ref: 'weakref.ReferenceType[WriterDiagnostics]') -> None:
+    diagnostic = ref()
+    if diagnostic is not None:
+        diagnostic.flush()
+
+class StreamDiagnostics(WriterDiagnostics):
+    def format(self, message: DiagnosticMessage) -> str:
+        return f'{message}\n'
+
+class JsonLinesDiagnostics(WriterDiagnostics):
+    '''
+    Writes one JSON object per message, without terminal colours, for tools.
+    '''
+    def format(self, message: DiagnosticMessage) -> str:
+        return json.dumps(message.to_json()) + '\n'
+
+class TeeDiagnostics(DiagnosticBase):
+    '''
+    Sends every message to all `sinks`.
+    '''
+    def __init__(self, sinks: Sequence[DiagnosticBase]) -> None:
+        self.sinks = sinks
+    
+    def is_enabled(self, kind: DiagnosticKind) -> bool:
+        return any(sink.is_enabled(kind) for sink in self.sinks)
     
     def add_message(self, message: DiagnosticMessage) -> None:
-        self.messages.append(message)
+        for sink in self.sinks:
+            sink.add_message(message)
     
     def add(self, location: Optional[DiagnosticLocation], kind: DiagnosticKind, message: str) -> None:
         self.add_message(DiagnosticMessage(location = location, message = message, kind = kind))
     
     def has_errors(self) -> bool:
-        return any(message.kind == DiagnosticKind.ERROR for message in self.messages)
+        return any(sink.has_errors() for sink in self.sinks)
     
     def has_warnings(self) -> bool:
-        return any(message.kind == DiagnosticKind.WARNING for message in self.messages)
+        return any(sink.has_warnings() for sink in self.sinks)
     
     def has_infos(self) -> bool:
-        return any(message.kind == DiagnosticKind.INFO for message in self.messages)
+        return any(sink.has_infos() for sink in self.sinks)
+    
+    def flush(self) -> None:
+        for sink in self.sinks:
+            sink.flush()
+    
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+class ListDiagnostics(FilteredDiagnostics):
+    def __init__(self, min_kind: DiagnosticKind = DiagnosticKind.INFO) -> None:
+        super().__init__(min_kind)
+        self.messages: List[DiagnosticMessage] = []
+    
+    def emit(self, message: DiagnosticMessage) -> None:
+        self.messages.append(message)
+    
+    def clear(self) -> None:
+        self.messages.clear()
+        self.counts = [0] * len(DiagnosticKind)
     
     def __iter__(self):
         return iter(self.messages)
@@ -110,4 +346,4 @@ class ListDiagnostics(DiagnosticBase):
         return self.messages[index]
     
     def __str__(self) -> str:
-        return '\n'.join(str(message) for message in self.messages)
\ No newline at end of file
+        return '\n'.join(str(message) for message in self.messages)
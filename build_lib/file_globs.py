@@ -0,0 +1,404 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Pattern, Set, Tuple
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+
+GLOB_CACHE_FILE_NAME = 'glob_cache.json'
+GLOB_CACHE_PATH = BASE_PATH / CACHE_DIR_NAME / GLOB_CACHE_FILE_NAME
+GLOB_CACHE_VERSION = 1
+GLOB_CHARS = re.compile(r'[*?\[]')
+# Directories changed this recently may change again within the same timestamp tick.
+RACY_MARGIN_NS = 2_000_000_000
+
+Token = Tuple[str, str]
+
+def is_glob(pattern: str) -> bool:
+    return GLOB_CHARS.search(pattern) is not None
+
+@lru_cache(maxsize = None)
+def tokenize(pattern: str) -> List[Token]:
+    '''
+    Splits a glob into `('literal', text)` and wildcard tokens: `**/`, `**`,
+    `*`, `?` and `[...]`.
+    '''
+    tokens: List[Token] = []
+    index = 0
+    literal = ''
+    while index < len(pattern):
+        char = pattern[index]
+        wildcard: Optional[Token] = None
+        if pattern.startswith('**/', index):
+            wildcard = ('**/', '**/')
+        elif pattern.startswith('**', index):
+            wildcard = ('**', '**')
+        elif char == '*':
+            wildcard = ('*', '*')
+        elif char == '?':
+            wildcard = ('?', '?')
+        elif char == '[':
+            end = pattern.find(']', index + 2)
+            if end != -1:
+                wildcard = ('[', pattern[index:end + 1])
+        if wildcard is None:
+            literal += char
+            index += 1
+            continue
+        if literal != '':
+            tokens.append(('literal', literal))
+            literal = ''
+        tokens.append(wildcard)
+        index += len(wildcard[1])
+    if literal != '':
+        tokens.append(('literal', literal))
+    return tokens
+
+def token_regex(token: Token) -> str:
+    kind, text = token
+    match kind:
+        case 'literal': return re.escape(text)
+        case '**/': return '((?:[^/]+/)*)'
+        case '**': return '(.*)'
+        case '*': return '([^/]*)'
+        case '?': return '([^/])'
+        case _:
+            body = text[1:-1]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            return f'([{body}])'
+
+@lru_cache(maxsize = None)
+def translate(pattern: str) -> Pattern[str]:
+    '''
+    Regex matching the same paths as `pattern`, with one group per wildcard.
+    '''
+    return re.compile(''.join(token_regex(token) for token in tokenize(pattern)))
+
+@dataclass
+class FileGlob:
+    '''
+    A "files" entry whose `srcPath` (or `path`) is a glob. Every wildcard of the
+    source pattern maps to the wildcard at the same position of the build
+    pattern, e.g. `src/**/*.ts` -> `build/**/*.js`.
+    '''
+    uuid: str
+    src: str
+    build: str
+    exclude: List[str] = field(default_factory = list)
+
+    @staticmethod
+    def is_glob_entry(json_data: Any) -> bool:
+        if type(json_data) != dict:
+            return False
+        pattern = json_data.get('srcPath', json_data.get('path'))
+        return type(pattern) == str and is_glob(pattern) or 'exclude' in json_data
+
+    @staticmethod
+    def from_json(module_path: Path, json_data: dict) -> 'FileGlob':
+        if 'uuid' not in json_data or type(json_data['uuid']) != str:
+            raise ValueError(f'"uuid" of a file pattern must be a "str": "{module_path}"\n{json_data}')
+        if 'path' not in json_data or type(json_data['path']) != str:
+            raise ValueError(f'"path" of a file pattern must be a "str": "{module_path}"\n{json_data}')
+        src = json_data.get('srcPath', json_data['path'])
+        if type(src) != str:
+            raise ValueError(f'type of "srcPath" must be a "str", but found "{type(src)}": {module_path}\n{json_data}')
+        exclude = json_data.get('exclude', [])
+        if type(exclude) != list or any(type(pattern) != str for pattern in exclude):
+            raise ValueError(f'type of "exclude" must be a "list" of "str", but found "{exclude}": {module_path}\n{json_data}')
+
+        file_glob = FileGlob(uuid = json_data['uuid'], src = src, build = json_data['path'], exclude = exclude)
+        file_glob.validate(module_path)
+        return file_glob
+
+    def validate(self, module_path: Path) -> None:
+        for pattern in [self.src, self.build, *self.exclude]:
+            if pattern.startswith('/') or '..' in pattern.split('/'):
+                raise ValueError(f'File patterns must stay inside the module: "{pattern}" in "{module_path}"')
+        src_wildcards = [kind for kind, _ in tokenize(self.src) if kind != 'literal']
+        build_wildcards = [kind for kind, _ in tokenize(self.build) if kind != 'literal']
+        if src_wildcards != build_wildcards:
+            raise ValueError(f'"{self.build}" must use the same wildcards in the same order as "{self.src}": "{module_path}"')
+
+    def to_json(self) -> dict:
+        json_data: dict = { 'uuid': self.uuid, 'path': self.build, 'srcPath': self.src }
+        if len(self.exclude) > 0:
+            json_data['exclude'] = self.exclude
+        return json_data
+
+    def root(self) -> str:
+        '''
+        Directory below which all matches lie: the segments before the first wildcard.
+        '''
+        segments = self.src.split('/')
+        fixed = []
+        for segment in segments[:-1]:
+            if is_glob(segment):
+                break
+            fixed.append(segment)
+        return '/'.join(fixed)
+
+    def max_depth(self) -> Optional[int]:
+        '''
+        Number of directory levels below `root()` a match can be in, or `None`
+        if the pattern contains `**`.
+        '''
+        if '**' in self.src:
+            return None
+        root = self.root()
+        return self.src.count('/') - (0 if root == '' else root.count('/') + 1)
+
+    def build_path_of(self, src_path: str) -> Optional[str]:
+        match = translate(self.src).fullmatch(src_path)
+        if match is None:
+            return None
+        groups = iter(match.groups())
+        return ''.join(text if kind == 'literal' else next(groups) for kind, text in tokenize(self.build))
+
+@dataclass
+class IgnoreRule:
+    regex: Pattern[str]
+    negate: bool
+    dir_only: bool
+
+def parse_gitignore(text: str) -> List[IgnoreRule]:
+    '''
+    Rules of a `.gitignore`, matching paths relative to its directory.
+    '''
+    rules: List[IgnoreRule] = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if line == '' or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        if line.startswith('\\'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line == '':
+            continue
+        # Without an inner slash, a pattern matches the name at any depth.
+        if '/' in line:
+            pattern = line.lstrip('/')
+        else:
+            pattern = '**/' + line
+        rules.append(IgnoreRule(regex = translate(pattern), negate = negate, dir_only = dir_only))
+    return rules
+
+# The rules of one `.gitignore`, with the repository-relative prefix of its directory.
+IgnoreStack = Tuple[Tuple[str, List[IgnoreRule]], ...]
+
+def is_ignored(stack: IgnoreStack, path: str, is_dir: bool) -> bool:
+    '''
+    Whether the repository-relative `path` is ignored; like git, the last
+    matching rule wins and deeper files come last.
+    '''
+    ignored = False
+    for prefix, rules in stack:
+        if not path.startswith(prefix):
+            continue
+        relative = path[len(prefix):]
+        for rule in rules:
+            if (is_dir or not rule.dir_only) and rule.regex.fullmatch(relative) is not None:
+                ignored = not rule.negate
+    return ignored
+
+def read_gitignore(directory: Path, prefix: str, stack: IgnoreStack, ignores: Dict[str, Optional[int]]) -> IgnoreStack:
+    path = directory / '.gitignore'
+    try:
+        text = path.read_text()
+        ignores[str(path)] = path.stat().st_mtime_ns
+    except (OSError, UnicodeDecodeError):
+        ignores[str(path)] = None
+        return stack
+    return stack + ((prefix, parse_gitignore(text)),)
+
+def repo_prefix(path: Path) -> str:
+    relative = os.path.relpath(path, BASE_PATH)
+    return '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+
+@dataclass
+class GlobExpansion:
+    # Matching source paths relative to the module directory.
+    files: List[str]
+    # Modification times of every walked directory; a new, removed or renamed
+    # entry changes the mtime of its directory.
+    dirs: Dict[str, int]
+    # Modification times of the `.gitignore` files read (or `None` if absent).
+    ignores: Dict[str, Optional[int]]
+
+def walk_file_glob(module_dir: Path, file_glob: FileGlob) -> GlobExpansion:
+    '''
+    Walks the tree below the glob's root with `os.scandir`, skipping `.git`,
+    excluded and ignored directories and directories deeper than the pattern
+    can match.
+    '''
+    include = translate(file_glob.src)
+    excludes = [translate(pattern) for pattern in file_glob.exclude]
+    max_depth = file_glob.max_depth()
+    root_rel = file_glob.root()
+    root = module_dir / root_rel if root_rel != '' else module_dir
+    result = GlobExpansion(files = [], dirs = {}, ignores = {})
+
+    # Apply the `.gitignore` files from the repository root down to the glob's
+    # root; nothing matches if any directory on the way is ignored.
+    stack: IgnoreStack = ()
+    for directory in [*reversed(root.parents), root]:
+        if directory != BASE_PATH and BASE_PATH not in directory.parents:
+            continue
+        if directory != BASE_PATH and is_ignored(stack, repo_prefix(directory).rstrip('/'), True):
+            return result
+        if directory != root:
+            stack = read_gitignore(directory, repo_prefix(directory), stack, result.ignores)
+
+    pending = [(root, '' if root_rel == '' else root_rel + '/', 0, stack)]
+    while len(pending) > 0:
+        directory, relative, depth, stack = pending.pop()
+        prefix = repo_prefix(directory)
+        try:
+            result.dirs[str(directory)] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if any(entry.name == '.gitignore' for entry in entries):
+            stack = read_gitignore(directory, prefix, stack, result.ignores)
+
+        for entry in entries:
+            path = relative + entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks = False)
+            except OSError:
+                continue
+            if is_dir:
+                if entry.name == '.git' or (max_depth is not None and depth + 1 > max_depth):
+                    continue
+                if any(exclude.fullmatch(path) is not None or exclude.fullmatch(path + '/') is not None for exclude in excludes):
+                    continue
+                if is_ignored(stack, prefix + entry.name, True):
+                    continue
+                pending.append((Path(entry.path), path + '/', depth + 1, stack))
+                continue
+            if include.fullmatch(path) is None or any(exclude.fullmatch(path) is not None for exclude in excludes):
+                continue
+            if is_ignored(stack, prefix + entry.name, False):
+                continue
+            result.files.append(path)
+
+    result.files.sort()
+    return result
+
+class GlobCache:
+    '''
+    Expansions of file globs, reused while none of the walked directories and
+    none of the `.gitignore` files consulted changed.
+    '''
+    def __init__(self, path: Optional[Path] = GLOB_CACHE_PATH) -> None:
+        self.path = path
+        self.entries: Dict[str, Any] = {}
+        self.used: Set[str] = set()
+        # Directories walked by each expansion looked up or updated, also by
+        # those too recent to cache, so a watcher can notice new matches.
+        self.walked: Dict[str, List[str]] = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(path: Optional[Path] = GLOB_CACHE_PATH) -> 'GlobCache':
+        cache = GlobCache(path)
+        if path is None:
+            return cache
+        try:
+            json_data = json.loads(path.read_bytes())
+        except (OSError, ValueError):
+            return cache
+
+        if type(json_data) != dict or json_data.get('version') != GLOB_CACHE_VERSION or type(json_data.get('entries')) != dict:
+            return cache
+        cache.entries = json_data['entries']
+        return cache
+
+    @staticmethod
+    def key(module_dir: Path, file_glob: FileGlob) -> str:
+        return json.dumps([str(module_dir), file_glob.src, file_glob.exclude])
+
+    def lookup(self, key: str) -> Optional[List[str]]:
+        self.used.add(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            for path, mtime_ns in entry['dirs'].items():
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    raise ValueError(path)
+            for path, mtime_ns in entry['ignores'].items():
+                current = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+                if current != mtime_ns:
+                    raise ValueError(path)
+            files = entry['files']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.walked[key] = list(entry['dirs'])
+        return files
+
+    def update(self, key: str, expansion: GlobExpansion, started_ns: int) -> None:
+        self.used.add(key)
+        self.walked[key] = list(expansion.dirs)
+        if any(mtime_ns >= started_ns - RACY_MARGIN_NS for mtime_ns in expansion.dirs.values()):
+            # Could still change without a visible mtime change; walk again next time.
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+            return
+        self.entries[key] = { 'files': expansion.files, 'dirs': expansion.dirs, 'ignores': expansion.ignores }
+        self.dirty = True
+
+    def walked_dirs(self) -> Set[Path]:
+        return { Path(path) for dirs in self.walked.values() for path in dirs }
+
+    def retain_used(self) -> None:
+        '''
+        Drops the expansions of globs that were not looked up since loading.
+        '''
+        for key in [key for key in self.entries if key not in self.used]:
+            del self.entries[key]
+            self.dirty = True
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        json_data = { 'version': GLOB_CACHE_VERSION, 'entries': self.entries }
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(json_data, separators = (',', ':')))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def expand_file_glob(module_dir: Path, file_glob: FileGlob, cache: Optional[GlobCache] = None) -> List[Tuple[str, str]]:
+    '''
+    Returns the `(source, build)` paths, relative to `module_dir`, matched by `file_glob`.
+    '''
+    key = GlobCache.key(module_dir, file_glob)
+    files = None if cache is None else cache.lookup(key)
+    if files is None:
+        started_ns = time.time_ns()
+        expansion = walk_file_glob(module_dir, file_glob)
+        if cache is not None:
+            cache.update(key, expansion, started_ns)
+        files = expansion.files
+
+    pairs: List[Tuple[str, str]] = []
+    for src in files:
+        build = file_glob.build_path_of(src)
+        if build is not None:
+            pairs.append((src, build))
+    return pairs
@@ -0,0 +1,143 @@
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from .changed_files import REPO_PATH, FileChecksum, iter_modules, normalize_repo_path
+from .checksum_store import CHECKSUM_FILE_NAME
+from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
+from .hashing import format_checksum
+from .parse_module_dep import Module
+from .stat_cache import STAT_CACHE_PATH, StatCache
+from .tracing import trace_span
+
+# Checksums of this algorithm are git blob ids, see `hashing.git_blob_hash`.
+GIT_ALGORITHM = 'git'
+# Only the blob ids of regular files are hashes of their content; symlinks and
+# submodules are hashed like untracked files.
+FILE_MODES = { b'100644', b'100755' }
+
+class GitError(ValueError):
+    pass
+
+def run_git(args: Sequence[str], cwd: Path = REPO_PATH) -> bytes:
+    try:
+        result = subprocess.run(['git', *args], cwd = cwd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    except OSError as e:
+        raise GitError(f'Unable to run git: {e}')
+    if result.returncode != 0:
+        raise GitError(f'"git {" ".join(args)}" failed: {result.stderr.decode(errors = "replace").strip()}')
+    return result.stdout
+
+def parse_blob_ids(output: bytes) -> Dict[str, str]:
+    '''
+    Blob ids by path from the `-z` output of `git ls-files -s` (mode, id,
+    stage) or `git ls-tree -r` (mode, type, id). Unmerged entries are skipped.
+    '''
+    blobs: Dict[str, str] = {}
+    for record in output.split(b'\0'):
+        info, _, path = record.partition(b'\t')
+        fields = info.split(b' ')
+        if len(fields) != 3 or fields[0] not in FILE_MODES:
+            continue
+        if fields[1] == b'blob':
+            oid = fields[2]
+        elif fields[2] == b'0':
+            oid = fields[1]
+        else:
+            continue
+        blobs[normalize_repo_path(os.fsdecode(path))] = oid.decode()
+    return blobs
+
+def parse_raw_diff_paths(output: bytes) -> Set[str]:
+    '''
+    Paths of the `-z` output of `git diff --raw --no-renames`, where every
+    status record is followed by a single path.
+    '''
+    paths: Set[str] = set()
+    fields = output.split(b'\0')
+    index = 0
+    while index + 1 < len(fields):
+        if fields[index].startswith(b':'):
+            paths.add(normalize_repo_path(os.fsdecode(fields[index + 1])))
+            index += 2
+        else:
+            index += 1
+    return paths
+
+class GitIndex(StatCache):
+    '''
+    Takes the checksums of clean tracked files from the blob ids in git's
+    index instead of reading them. Untracked and dirty files are hashed with
+    the same algorithm, reusing the stat cache.
+
+    Git already compares the working tree with the index by stat information,
+    so one `git ls-files -s` and one `git diff --raw` replace reading every file.
+    '''
+    def __init__(self, path: Optional[Path] = STAT_CACHE_PATH) -> None:
+        super().__init__(path)
+        self.blobs: Dict[str, str] = {}
+        # Tracked files whose content differs from the index.
+        self.modified: Set[str] = set()
+        self.git_hits = 0
+
+    @staticmethod
+    def load(path: Optional[Path] = STAT_CACHE_PATH, repo_path: Path = REPO_PATH) -> 'GitIndex':
+        index = GitIndex(path)
+        cache = StatCache.load(path)
+        index.entries = cache.entries
+        index.written_ns = cache.written_ns
+        with trace_span('Read git index', 'hash'):
+            index.blobs = parse_blob_ids(run_git(['ls-files', '-s', '-z'], repo_path))
+            index.modified = parse_raw_diff_paths(run_git(['diff', '--raw', '-z', '--no-renames', '--relative'], repo_path))
+        return index
+
+    def blob_checksum(self, key: str) -> Optional[str]:
+        key = normalize_repo_path(key)
+        if key in self.modified:
+            return None
+        oid = self.blobs.get(key)
+        return None if oid is None else format_checksum(GIT_ALGORITHM, oid)
+
+    def checksum_many(self, files: Sequence[Tuple[str, Path]], algorithm: str = GIT_ALGORITHM) -> List[str]:
+        if algorithm != GIT_ALGORITHM:
+            return super().checksum_many(files, algorithm)
+
+        checksums: List[Optional[str]] = [self.blob_checksum(key) for key, _ in files]
+        missed = [index for index, checksum in enumerate(checksums) if checksum is None]
+        self.git_hits += len(files) - len(missed)
+        for index, checksum in zip(missed, super().checksum_many([files[index] for index in missed], algorithm)):
+            checksums[index] = checksum
+        return [checksum for checksum in checksums if checksum is not None]
+
+def default_base_revision(repo_path: Path = REPO_PATH) -> Optional[str]:
+    '''
+    The last commit that updated the checksum store, i.e. the tree the
+    previous build recorded. `None` if the store was never committed.
+    '''
+    revision = run_git(['log', '-1', '--format=%H', '--', CHECKSUM_FILE_NAME], repo_path).decode().strip()
+    return revision if revision != '' else None
+
+def get_git_base_checksums(diagnostic: DiagnosticBase, module: Module, base_rev: Optional[str], stored: Optional[List[FileChecksum]], repo_path: Path = REPO_PATH) -> Optional[List[FileChecksum]]:
+    '''
+    Blob ids of `base_rev` as checksums to diff the module graph against, in
+    place of the stored checksums. Only the files declared now or recorded in
+    the checksum store are taken, so other tracked files are not reported as
+    removed. Returns `None`, like a missing store, if there is no base.
+    '''
+    location = DiagnosticLocation(path = Path(CHECKSUM_FILE_NAME), prefix = None, resolved_base_path = repo_path)
+    try:
+        if base_rev is None:
+            base_rev = default_base_revision(repo_path)
+            if base_rev is None:
+                diagnostic.add(location, DiagnosticKind.INFO, f'No commit of "{CHECKSUM_FILE_NAME}" to compare with')
+                return None
+        with trace_span('Read git base revision', 'diff', revision = base_rev):
+            blobs = parse_blob_ids(run_git(['ls-tree', '-r', '-z', base_rev, '--'], repo_path))
+    except GitError as e:
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to read base revision\n\t{e}')
+        return stored
+
+    keys = { file.src_key for current in iter_modules(module) for file in current.files }
+    keys.update(normalize_repo_path(file.path) for file in stored or [])
+    diagnostic.add(location, DiagnosticKind.INFO, f'Comparing with revision {base_rev}')
+    return [FileChecksum(Path(key), format_checksum(GIT_ALGORITHM, blobs[key])) for key in sorted(keys) if key in blobs]
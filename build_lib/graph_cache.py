@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+from .hashing import hash_bytes
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+
+GRAPH_CACHE_FILE_NAME = 'module_graph.json'
+GRAPH_CACHE_PATH = BASE_PATH / CACHE_DIR_NAME / GRAPH_CACHE_FILE_NAME
+GRAPH_CACHE_VERSION = 3
+
+@dataclass
+class ManifestFingerprint:
+    size: int
+    mtime_ns: int
+    inode: int
+    digest: str
+
+    @staticmethod
+    def from_path(path: Path) -> 'ManifestFingerprint':
+        st = os.stat(path)
+        return ManifestFingerprint(size = st.st_size, mtime_ns = st.st_mtime_ns, inode = st.st_ino, digest = hash_bytes(Path(path).read_bytes()))
+
+    def matches_stat(self, st: os.stat_result) -> bool:
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns and self.inode == st.st_ino
+
+class GraphCache:
+    '''
+    Stores the validated form of every `module.json` together with the stat and
+    content fingerprint of the manifest it was parsed from. A record is reused
+    while the stat information matches; when it does not (or the entry is
+    racily clean) the manifest content is hashed and the record is reused only
+    if the content is the same.
+
+    Records are opaque JSON values produced by the module parser.
+    '''
+    def __init__(self, path: Optional[Path] = GRAPH_CACHE_PATH) -> None:
+        self.path = path
+        self.entries: Dict[str, Any] = {}
+        self.written_ns: Optional[int] = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(path: Optional[Path] = GRAPH_CACHE_PATH) -> 'GraphCache':
+        cache = GraphCache(path)
+        if path is None:
+            return cache
+        try:
+            written_ns = path.stat().st_mtime_ns
+            json_data = json.loads(path.read_bytes())
+        except (OSError, ValueError):
+            return cache
+
+        if type(json_data) != dict or json_data.get('version') != GRAPH_CACHE_VERSION or type(json_data.get('entries')) != dict:
+            return cache
+
+        cache.entries = json_data['entries']
+        cache.written_ns = written_ns
+        return cache
+
+    def lookup(self, key: str, manifest_path: Path) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if type(entry) != list or len(entry) != 2:
+            self.misses += 1
+            return None
+
+        try:
+            size, mtime_ns, inode, digest = entry[0]
+            fingerprint = ManifestFingerprint(size = size, mtime_ns = mtime_ns, inode = inode, digest = digest)
+            st = os.stat(manifest_path)
+        except (OSError, TypeError, ValueError):
+            self.misses += 1
+            return None
+
+        racy = self.written_ns is None or fingerprint.mtime_ns >= self.written_ns
+        if fingerprint.matches_stat(st) and not racy:
+            self.hits += 1
+            return entry[1]
+
+        try:
+            current = ManifestFingerprint.from_path(manifest_path)
+        except OSError:
+            self.misses += 1
+            return None
+        if current.digest != fingerprint.digest:
+            self.misses += 1
+            return None
+
+        # Same content with new stat information (e.g. after a checkout).
+        self.hits += 1
+        self.update(key, current, entry[1])
+        return entry[1]
+
+    def update(self, key: str, fingerprint: ManifestFingerprint, record: Any) -> None:
+        self.entries[key] = [[fingerprint.size, fingerprint.mtime_ns, fingerprint.inode, fingerprint.digest], record]
+        self.dirty = True
+
+    def retain(self, keys: Iterable[str]) -> None:
+        '''
+        Drops the entries of manifests that are no longer part of the graph.
+        '''
+        keep = set(keys)
+        for key in [key for key in self.entries if key not in keep]:
+            del self.entries[key]
+            self.dirty = True
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        json_data = { 'version': GRAPH_CACHE_VERSION, 'entries': self.entries }
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(json_data, separators = (',', ':')))
+        os.replace(tmp_path, self.path)
+        self.written_ns = self.path.stat().st_mtime_ns
+        self.dirty = False
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import mmap
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+# Checksums written before algorithms were configurable are bare md5 hex
+# digests, so md5 stays the default and is stored without a prefix.
+DEFAULT_ALGORITHM = 'md5'
+CHUNK_SIZE = 1 << 20
+MMAP_THRESHOLD = 8 << 20
+
+HashFactory = Callable[..., Any]
+
+def git_blob_hash(size: int) -> Any:
+    '''
+    SHA-1 over a `blob <size>` header and the content: the object id git
+    stores for a file, so checksums can be compared with `git ls-files -s`.
+    '''
+    hasher = hashlib.sha1()
+    hasher.update(b'blob %d\0' % size)
+    return hasher
+
+ALGORITHMS: Dict[str, HashFactory] = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+    'git': git_blob_hash,
+}
+# Algorithms whose factory takes the size of the content up front.
+SIZED_ALGORITHMS: Set[str] = { 'git' }
+
+try:
+    import xxhash # type: ignore[import-untyped, import-not-found]
+    ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+except ImportError:
+    pass
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def register_algorithm(name: str, factory: HashFactory, sized: bool = False) -> None:
+    '''
+    Makes `factory` available as a checksum algorithm. The returned object must
+    provide `update(bytes)` and `hexdigest()` like the `hashlib` objects. A
+    `sized` factory is called with the size of the content in bytes.
+    '''
+    if ':' in name:
+        raise ValueError(f'Algorithm name must not contain ":": {name}')
+    ALGORITHMS[name] = factory
+    if sized:
+        SIZED_ALGORITHMS.add(name)
+    else:
+        SIZED_ALGORITHMS.discard(name)
+
+def get_factory(algorithm: str) -> HashFactory:
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f'Unknown hash algorithm: "{algorithm}", expected one of: {", ".join(sorted(ALGORITHMS))}')
+    return ALGORITHMS[algorithm]
+
+def new_hasher(algorithm: str, size: int) -> Any:
+    factory = get_factory(algorithm)
+    if algorithm in SIZED_ALGORITHMS:
+        return factory(size)
+    return factory()
+
+def format_checksum(algorithm: str, digest: str) -> str:
+    if algorithm == DEFAULT_ALGORITHM:
+        return digest
+    return f'{algorithm}:{digest}'
+
+def split_checksum(checksum: str) -> Tuple[str, str]:
+    algorithm, sep, digest = checksum.partition(':')
+    if sep == '':
+        return (DEFAULT_ALGORITHM, checksum)
+    return (algorithm, digest)
+
+def checksum_algorithm(checksum: str) -> str:
+    return split_checksum(checksum)[0]
+
+def hash_file(path: Path, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    '''
+    Hashes `path` without holding the whole file in memory: small files are read
+    in `CHUNK_SIZE` pieces into a reused buffer, large files are memory-mapped.
+    '''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        hasher = new_hasher(algorithm, size)
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+        else:
+            buffer = bytearray(min(CHUNK_SIZE, max(size, 1)))
+            view = memoryview(buffer)
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                hasher.update(view[:read])
+    return format_checksum(algorithm, hasher.hexdigest())
+
+def hash_bytes(data: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    hasher = new_hasher(algorithm, len(data))
+    hasher.update(data)
+    return format_checksum(algorithm, hasher.hexdigest())
+
+def checksum_matches(path: Path, checksum: str, stored: str) -> bool:
+    '''
+    Compares the `checksum` of `path` with a `stored` checksum that may have been
+    produced with another algorithm, rehashing `path` with that algorithm if so.
+    '''
+    stored_algorithm = checksum_algorithm(stored)
+    if stored_algorithm == checksum_algorithm(checksum):
+        return checksum == stored
+    if stored_algorithm not in ALGORITHMS:
+        return False
+    return hash_file(path, stored_algorithm) == stored
+
+def get_executor() -> ThreadPoolExecutor:
+    '''
+    Thread pool shared by every hashing call; hashlib releases the GIL while
+    hashing, so files are hashed in parallel.
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers = min(32, (os.cpu_count() or 1) + 4), thread_name_prefix = 'hash')
+    return _executor
+
+def hash_files(paths: Sequence[Path], algorithm: str = DEFAULT_ALGORITHM) -> List[str]:
+    get_factory(algorithm)
+    if len(paths) <= 1:
+        return [hash_file(path, algorithm) for path in paths]
+    return list(get_executor().map(lambda path: hash_file(path, algorithm), paths))
+
+async def hash_file_async(path: Path, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), hash_file, path, algorithm)
@@ -0,0 +1,24 @@
+from pathlib import Path
+from typing import Optional, Union
+from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
+from .file_globs import GlobCache
+from .graph_cache import GraphCache
+from .hashing import DEFAULT_ALGORITHM
+from .parse_module_dep import Module, ModuleCycleError, parse_module
+from .stat_cache import StatCache
+
+def load_module_graph(diagnostic: DiagnosticBase, base_path: Union[Path, str] = './', stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM, graph_cache: Optional[GraphCache] = None, glob_cache: Optional[GlobCache] = None) -> Optional[Module]:
+    '''
+    Like `parse_module`, but reports invalid manifests and include cycles
+    through `diagnostic` and returns `None` instead of raising.
+    '''
+    location = DiagnosticLocation(path = Path(base_path) / 'module.json', prefix = None, resolved_base_path = Path(base_path).resolve())
+    try:
+        return parse_module(base_path, stat_cache, algorithm, graph_cache, glob_cache)
+    except ModuleCycleError as e:
+        location = DiagnosticLocation(path = e.chain[0], prefix = None, resolved_base_path = e.chain[0].parent.resolve())
+        chain = '\n\t-> '.join(f'"{path}"' for path in e.chain)
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Include cycle detected:\n\t   {chain}')
+    except (ValueError, OSError) as e:
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Failed to load module graph\n\t{e}')
+    return None
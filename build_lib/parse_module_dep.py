@@ -1,8 +1,17 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 import json
-from hashlib import md5
+import os
+import posixpath
+import sys
+from .file_globs import FileGlob, GlobCache, expand_file_glob
+from .graph_cache import GraphCache, ManifestFingerprint
+from .hashing import DEFAULT_ALGORITHM, format_checksum, hash_files, split_checksum
+from .path_table import PATHS
+from .stat_cache import StatCache
+from .tracing import trace_span
 
 BASE_PATH = Path(__file__).parent.parent
 
@@ -13,16 +22,93 @@ def try_read_json(path: Path) -> Optional[dict]:
     except:
         return None
 
-@dataclass
 class DependencyFiles:
-    uuid: str
-    build_path: Path
-    src_path: Path
-    base_path: Path
-    checksum: str
+    '''
+    A file of a module. Paths are kept relative to `BASE_PATH` as a directory
+    id and a name in `PATHS`, and the checksum as its algorithm and raw
+    digest; graphs of millions of files would otherwise hold several `Path`
+    objects and a hex string per file.
+    '''
+    __slots__ = ('uuid', 'build_dir', 'build_name', 'src_dir', 'src_name', 'algorithm', 'digest')
+
+    def __init__(self, uuid: str, build_path: Union[Path, str], src_path: Union[Path, str], checksum: str = '') -> None:
+        self.uuid = uuid
+        self.build_dir, self.build_name = PATHS.split(build_path)
+        self.src_dir, self.src_name = PATHS.split(src_path)
+        self.checksum = checksum
+
+    @staticmethod
+    def from_json(base_path: Path, json_data: dict, stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM) -> 'DependencyFiles':
+        return DependencyFiles.from_json_list(base_path, [json_data], stat_cache, algorithm)[0]
+
+    @staticmethod
+    def from_json_list(base_path: Path, json_list: List[dict], stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM) -> List['DependencyFiles']:
+        '''
+        Parses every entry of a module's "files" list and hashes their sources
+        in one parallel batch.
+        '''
+        files = [DependencyFiles.parse_json(base_path, json_data) for json_data in json_list]
+        DependencyFiles.compute_checksums(files, stat_cache, algorithm)
+        return files
+
+    @staticmethod
+    def compute_checksums(files: List['DependencyFiles'], stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM) -> None:
+        if stat_cache is not None:
+            checksums = stat_cache.checksum_many([(file.src_key, file.get_src_path()) for file in files], algorithm)
+        else:
+            checksums = hash_files([file.get_src_path() for file in files], algorithm)
+
+        for file, checksum in zip(files, checksums):
+            file.checksum = checksum
+
+    @property
+    def checksum(self) -> str:
+        if self.algorithm is None:
+            return self.digest.decode()
+        return format_checksum(self.algorithm, self.digest.hex())
+
+    @checksum.setter
+    def checksum(self, checksum: str) -> None:
+        algorithm, digest = split_checksum(checksum)
+        try:
+            raw = bytes.fromhex(digest)
+        except ValueError:
+            raw = None
+        if raw is None or len(raw) == 0 or raw.hex() != digest:
+            # Not a lowercase hex digest; kept verbatim.
+            self.algorithm = None
+            self.digest = checksum.encode()
+            return
+        # Every file shares one string per algorithm.
+        self.algorithm = sys.intern(algorithm)
+        self.digest = raw
+
+    @property
+    def build_path(self) -> Path:
+        return Path(self.build_key)
+
+    @property
+    def src_path(self) -> Path:
+        return Path(self.src_key)
+
+    @property
+    def base_path(self) -> Path:
+        return BASE_PATH
+
+    # Keys of the file in the checksum store, without creating a `Path`.
+    @property
+    def build_key(self) -> str:
+        return PATHS.join(self.build_dir, self.build_name)
+
+    @property
+    def src_key(self) -> str:
+        return PATHS.join(self.src_dir, self.src_name)
 
     @staticmethod
-    def from_json(base_path: Path, json_data: dict) -> 'DependencyFiles':
+    def parse_json(base_path: Path, json_data: dict) -> 'DependencyFiles':
+        '''
+        Validates a "files" entry; the returned file has an empty checksum.
+        '''
         module_path = base_path / 'module.json'
         parent_path = base_path.relative_to(BASE_PATH)
 
@@ -57,26 +143,108 @@ class DependencyFiles:
             
             srcPath = parent_path / Path(json_data['srcPath'])
 
-        if not srcPath.exists():
+        if not (BASE_PATH / srcPath).exists():
             raise FileNotFoundError(f'File not found: {srcPath}')
         
-        checksum = md5(srcPath.read_bytes()).hexdigest()
-        
-        return DependencyFiles(uuid = uuid, build_path = buildPath, src_path = srcPath, base_path = BASE_PATH, checksum = checksum)
-    
+        return DependencyFiles(uuid = uuid, build_path = buildPath, src_path = srcPath)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, DependencyFiles):
+            return NotImplemented
+        return (self.src_dir, self.src_name, self.build_dir, self.build_name, self.uuid, self.algorithm, self.digest) == (other.src_dir, other.src_name, other.build_dir, other.build_name, other.uuid, other.algorithm, other.digest)
+
     def __hash__(self) -> int:
-        return hash(self.src_path)
-    
+        return hash((self.src_dir, self.src_name))
+
+    def __repr__(self) -> str:
+        return f'DependencyFiles(uuid={self.uuid!r}, build_path={self.build_key!r}, src_path={self.src_key!r}, checksum={self.checksum!r})'
+
     def get_build_path(self) -> Path:
-        return self.base_path / self.build_path
-    
+        return BASE_PATH / self.build_key
+
     def get_src_path(self) -> Path:
-        return self.base_path / self.src_path
+        return BASE_PATH / self.src_key
+
+def parse_str_list(json_data: dict, key: str) -> List[str]:
+    if key not in json_data:
+        return []
+    values = json_data[key]
+    if type(values) != list or any(type(value) != str for value in values):
+        raise ValueError(f'type of "{key}" must be a "list" of "str", but found "{values}": {json_data}')
+    return values
+
+MEMORY_UNITS = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+
+def parse_memory_size(value: Union[int, str]) -> int:
+    '''
+    Parses a size in bytes: an int, or a string with an optional binary unit
+    such as "512M" or "4GiB".
+    '''
+    if type(value) == int:
+        size = value
+    elif type(value) == str:
+        text = value.strip().upper().removesuffix('IB').removesuffix('B')
+        unit = MEMORY_UNITS.get(text[-1:], 1)
+        if unit != 1:
+            text = text[:-1]
+        try:
+            size = int(float(text) * unit)
+        except ValueError:
+            raise ValueError(f'Invalid memory size: "{value}"')
+    else:
+        raise ValueError(f'type of memory size must be an "int" or a "str", but found "{type(value)}": {value}')
+    if size < 0:
+        raise ValueError(f'Memory size must not be negative: {value}')
+    return size
+
+@dataclass
+class StepResources:
+    # Share of the machine's CPU slots the step keeps busy.
+    cpu: int = 1
+    # Peak memory of the step in bytes.
+    memory: int = 0
+    # Named resources, such as a package store, only one step may use at a time.
+    pools: List[str] = field(default_factory = list)
+
+    @staticmethod
+    def from_json(json_data: dict) -> 'StepResources':
+        if type(json_data) != dict:
+            raise ValueError(f'type of "resources" must be a "dict", but found "{type(json_data)}": {json_data}')
+        for key in json_data:
+            if key not in ('cpu', 'memory', 'pools'):
+                raise ValueError(f'Unknown resource "{key}": {json_data}')
+        cpu = json_data.get('cpu', 1)
+        if type(cpu) != int or cpu < 0:
+            raise ValueError(f'"cpu" must be a non-negative "int", but found "{cpu}": {json_data}')
+        memory = parse_memory_size(json_data.get('memory', 0))
+        return StepResources(cpu = cpu, memory = memory, pools = parse_str_list(json_data, 'pools'))
+
+    def to_json(self) -> dict:
+        json_data: dict = {}
+        if self.cpu != 1:
+            json_data['cpu'] = self.cpu
+        if self.memory != 0:
+            json_data['memory'] = self.memory
+        if len(self.pools) > 0:
+            json_data['pools'] = self.pools
+        return json_data
 
 @dataclass
 class DependencyCmds:
     name: str
     cmd: str
+    # Files (relative to the module) the step reads and produces; a step
+    # declaring either can be skipped when nothing it depends on changed.
+    inputs: List[str] = field(default_factory = list)
+    outputs: List[str] = field(default_factory = list)
+    # Names of the environment variables that affect the step.
+    env: List[str] = field(default_factory = list)
+    # What the step occupies while it runs; the build admits steps within its budget.
+    resources: StepResources = field(default_factory = StepResources)
+    # Seconds after which the step is killed; `None` waits forever.
+    timeout: Optional[float] = None
+    # Times a failed or timed out step is run again, with exponential backoff.
+    retries: int = 0
 
     @staticmethod
     def builtin(cmd: str) -> 'DependencyCmds':
@@ -103,7 +271,45 @@ class DependencyCmds:
         if type(cmd) != str:
             raise ValueError(f'type of "cmd" must be a "str", but found "{type(cmd)}": {cmds}')
         
-        return DependencyCmds(name = name, cmd = cmd)
+        inputs = parse_str_list(cmds, 'inputs')
+        outputs = parse_str_list(cmds, 'outputs')
+        env = parse_str_list(cmds, 'env')
+        resources = StepResources.from_json(cmds['resources']) if 'resources' in cmds else StepResources()
+
+        timeout = cmds.get('timeout')
+        if timeout is not None and (type(timeout) not in (int, float) or timeout <= 0):
+            raise ValueError(f'"timeout" must be a positive number of seconds, but found "{timeout}": {cmds}')
+
+        retries = cmds.get('retries', 0)
+        if type(retries) != int or retries < 0:
+            raise ValueError(f'"retries" must be a non-negative "int", but found "{retries}": {cmds}')
+
+        return DependencyCmds(name = name, cmd = cmd, inputs = inputs, outputs = outputs, env = env, resources = resources, timeout = None if timeout is None else float(timeout), retries = retries)
+
+    def to_json(self) -> Union[dict, str]:
+        '''
+        Inverse of `from_step`.
+        '''
+        if self.is_builtin():
+            return self.get_builtin()
+        json_data: dict = { 'name': self.name, 'cmd': self.cmd }
+        if len(self.inputs) > 0:
+            json_data['inputs'] = self.inputs
+        if len(self.outputs) > 0:
+            json_data['outputs'] = self.outputs
+        if len(self.env) > 0:
+            json_data['env'] = self.env
+        resources = self.resources.to_json()
+        if len(resources) > 0:
+            json_data['resources'] = resources
+        if self.timeout is not None:
+            json_data['timeout'] = self.timeout
+        if self.retries > 0:
+            json_data['retries'] = self.retries
+        return json_data
+
+    def is_cacheable(self) -> bool:
+        return not self.is_builtin() and (len(self.inputs) > 0 or len(self.outputs) > 0)
     
     def is_builtin(self) -> bool:
         return self.cmd.startswith('__builtin__:')
@@ -127,17 +333,30 @@ def validate_commands(path: Path, steps: List[DependencyCmds]) -> None:
     if has_deploy and not steps[-1].is_deploy():
         raise ValueError(f'Last step must be deploy: {path}')
 
+class ModuleCycleError(ValueError):
+    def __init__(self, chain: List[Path]) -> None:
+        self.chain = chain
+        super().__init__('Include cycle: ' + ' -> '.join(f'"{path}"' for path in chain))
+
 @dataclass
-class Module:
+class ModuleManifest:
+    '''
+    A validated `module.json` whose includes are not resolved yet.
+    '''
     name: str
     path: Path
+    base_path: Path
     resolve_base_path: Path
-    includes: List['Module']
+    includes: List[Path]
+    # Resolved directories of `includes`, used as keys of the included modules.
+    include_keys: List[Path]
     steps: List[DependencyCmds]
     files: List[DependencyFiles]
+    # Patterns in "files", expanded each time the graph is loaded.
+    file_globs: List[FileGlob] = field(default_factory = list)
 
     @staticmethod
-    def from_path(base_path: Path, module_path: Path) -> 'Module':
+    def from_path(base_path: Path, module_path: Path) -> 'ModuleManifest':
         resolved_base_path = base_path.resolve()
         path = module_path
 
@@ -158,7 +377,7 @@ class Module:
             if type(name) != str:
                 raise ValueError(f'type of "name" must be a "str", but found "{type(name)}": {path}')
 
-        includes: List['Module'] = []
+        includes: List[Path] = []
 
         if 'includes' in json_data:
             if type(json_data['includes']) != list:
@@ -168,9 +387,7 @@ class Module:
                 if type(include) != str:
                     raise ValueError(f'type of "include" must be a "str", but found "{type(include)}": {path}')
                 
-                include_path = base_path / include
-                include_module = Module.from_path(include_path, include_path / 'module.json')
-                includes.append(include_module)
+                includes.append(base_path / include)
         
         steps: List[DependencyCmds] = []
 
@@ -183,22 +400,280 @@ class Module:
             
 
         files: List[DependencyFiles] = []
+        file_globs: List[FileGlob] = []
 
         if 'files' in json_data:
             if type(json_data['files']) != list:
                 raise ValueError(f'type of "files" must be a "list", but found "{type(json_data["files"])}": {path}')
             
-            files = [DependencyFiles.from_json(resolved_base_path, file) for file in json_data['files']] 
+            for file in json_data['files']:
+                if FileGlob.is_glob_entry(file):
+                    file_globs.append(FileGlob.from_json(path, file))
+                else:
+                    files.append(DependencyFiles.parse_json(resolved_base_path, file))
         
-        module = Module(name = name, path = path, resolve_base_path = resolved_base_path, includes = includes, steps = steps, files = files)
-        return module
-    
+        include_keys = [include.resolve() for include in includes]
+        return ModuleManifest(name = name, path = path, base_path = base_path, resolve_base_path = resolved_base_path, includes = includes, include_keys = include_keys, steps = steps, files = files, file_globs = file_globs)
+
+    def to_record(self) -> list:
+        return [
+            self.name,
+            str(self.path),
+            str(self.base_path),
+            [str(include) for include in self.includes],
+            [str(include_key) for include_key in self.include_keys],
+            [step.to_json() for step in self.steps],
+            [[file.uuid, file.build_key, file.src_key] for file in self.files],
+            [file_glob.to_json() for file_glob in self.file_globs],
+        ]
+
+    @staticmethod
+    def from_record(resolve_base_path: Path, record: list, path_of: Callable[[str], Path] = Path) -> 'ModuleManifest':
+        name, path, base_path, includes, include_keys, steps, files, file_globs = record
+        return ModuleManifest(
+            name = name,
+            path = Path(path),
+            base_path = path_of(base_path),
+            resolve_base_path = resolve_base_path,
+            includes = [path_of(include) for include in includes],
+            include_keys = [path_of(include_key) for include_key in include_keys],
+            steps = [DependencyCmds.from_step(step) for step in steps],
+            files = [DependencyFiles(uuid = uuid, build_path = build_path, src_path = src_path) for uuid, build_path, src_path in files],
+            file_globs = [FileGlob.from_json(Path(path), file_glob) for file_glob in file_globs],
+        )
+
+    def expand_files(self, glob_cache: Optional[GlobCache] = None) -> List[DependencyFiles]:
+        '''
+        The listed files followed by the matches of every pattern; a file
+        listed explicitly (or matched earlier) keeps its first entry.
+        '''
+        if len(self.file_globs) == 0:
+            return self.files
+        files = list(self.files)
+        seen = { file.src_key for file in files }
+        parent_path = PATHS.normalize(self.resolve_base_path.relative_to(BASE_PATH))
+        for file_glob in self.file_globs:
+            for src, build in expand_file_glob(self.resolve_base_path, file_glob, glob_cache):
+                src_path = PATHS.normalize(posixpath.join(parent_path, src))
+                if src_path in seen:
+                    continue
+                seen.add(src_path)
+                files.append(DependencyFiles(uuid = file_glob.uuid, build_path = posixpath.join(parent_path, build), src_path = src_path))
+        return files
+
+class ModuleLoader:
+    '''
+    Loads a module graph, parsing every `module.json` exactly once. A module
+    included by several parents becomes a single shared `Module` node.
+
+    Manifests are loaded breadth first; all includes discovered at one depth
+    are parsed and validated concurrently, then the files of every module are
+    hashed in one parallel batch.
+    '''
+    def __init__(self, stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM, jobs: Optional[int] = None, graph_cache: Optional[GraphCache] = None, glob_cache: Optional[GlobCache] = None) -> None:
+        self.stat_cache = stat_cache
+        self.graph_cache = graph_cache
+        self.glob_cache = glob_cache
+        self.algorithm = algorithm
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+        self.manifests: Dict[Path, ModuleManifest] = {}
+        self.modules: Dict[Path, Module] = {}
+        # Files of every module, with their patterns expanded.
+        self.files: Dict[Path, List[DependencyFiles]] = {}
+        # Include paths repeat across manifests; share one `Path` per string.
+        self.paths: Dict[str, Path] = {}
+
+    def path_of(self, path: str) -> Path:
+        result = self.paths.get(path)
+        if result is None:
+            result = self.paths[path] = Path(path)
+        return result
+
+    def load(self, base_path: Path, module_path: Path) -> 'Module':
+        root_key = base_path.resolve()
+        self.paths[str(root_key)] = root_key
+        frontier = [(root_key, base_path, module_path)]
+        queued = { root_key }
+        with trace_span('Parse manifests', 'parse') as args, ThreadPoolExecutor(max_workers = self.jobs, thread_name_prefix = 'manifest') as executor:
+            while len(frontier) > 0:
+                manifests: List[Optional[ModuleManifest]] = [self.read_cached_manifest(key, module_path) for key, _, module_path in frontier]
+                missed = [index for index, manifest in enumerate(manifests) if manifest is None]
+                for index, parsed in zip(missed, executor.map(lambda index: self.read_manifest(*frontier[index]), missed)):
+                    manifests[index] = parsed
+
+                next_frontier = []
+                for (key, _, _), manifest in zip(frontier, manifests):
+                    assert manifest is not None
+                    self.manifests[key] = manifest
+                    for include, key in zip(manifest.includes, manifest.include_keys):
+                        if key in queued:
+                            continue
+                        queued.add(key)
+                        next_frontier.append((key, include, include / 'module.json'))
+                frontier = next_frontier
+            if args is not None:
+                args['manifests'] = len(self.manifests)
+
+        if self.graph_cache is not None:
+            self.graph_cache.retain(str(key) for key in self.manifests)
+        self.check_cycles(root_key)
+        with trace_span('Expand file patterns', 'glob'):
+            for key, manifest in self.manifests.items():
+                self.files[key] = manifest.expand_files(self.glob_cache)
+        files = [file for module_files in self.files.values() for file in module_files]
+        with trace_span('Hash files', 'hash', files = len(files)):
+            DependencyFiles.compute_checksums(files, self.stat_cache, self.algorithm)
+        return self.link(root_key)
+
+    def read_cached_manifest(self, key: Path, module_path: Path) -> Optional[ModuleManifest]:
+        if self.graph_cache is None:
+            return None
+
+        record = self.graph_cache.lookup(str(key), module_path)
+        if record is None:
+            return None
+        try:
+            return ModuleManifest.from_record(key, record, self.path_of)
+        except (TypeError, ValueError):
+            return None
+
+    def read_manifest(self, key: Path, base_path: Path, module_path: Path) -> ModuleManifest:
+        '''
+        Parses a manifest that is not in the graph cache and caches it.
+        '''
+        if self.graph_cache is None:
+            return ModuleManifest.from_path(base_path, module_path)
+
+        # Fingerprint before parsing, so an edit made while parsing is seen next time.
+        try:
+            fingerprint = ManifestFingerprint.from_path(module_path)
+        except OSError:
+            fingerprint = None
+        manifest = ModuleManifest.from_path(base_path, module_path)
+        if fingerprint is not None:
+            self.graph_cache.update(str(key), fingerprint, manifest.to_record())
+        return manifest
+
+    def check_cycles(self, root_key: Path) -> None:
+        # Iterative DFS; `chain` mirrors the stack of modules being visited.
+        done: Dict[Path, bool] = {}
+        chain: List[Path] = []
+        on_chain: Dict[Path, int] = {}
+        stack = [(root_key, 0)]
+        while len(stack) > 0:
+            key, index = stack.pop()
+            if index == 0:
+                chain.append(key)
+                on_chain[key] = len(chain) - 1
+            include_keys = self.manifests[key].include_keys
+            if index < len(include_keys):
+                stack.append((key, index + 1))
+                include_key = include_keys[index]
+                if include_key in on_chain:
+                    cycle = chain[on_chain[include_key]:] + [include_key]
+                    raise ModuleCycleError([self.manifests[item].path for item in cycle])
+                if include_key not in done:
+                    stack.append((include_key, 0))
+                continue
+            chain.pop()
+            del on_chain[key]
+            done[key] = True
+
+    def link(self, root_key: Path) -> 'Module':
+        # Post-order, so every include is created before the modules using it.
+        stack = [(root_key, False)]
+        while len(stack) > 0:
+            key, expanded = stack.pop()
+            if key in self.modules:
+                continue
+            manifest = self.manifests[key]
+            include_keys = manifest.include_keys
+            if not expanded:
+                stack.append((key, True))
+                stack.extend((include_key, False) for include_key in reversed(include_keys) if include_key not in self.modules)
+                continue
+            self.modules[key] = Module(
+                name = manifest.name,
+                path_id = PATHS.intern(manifest.path),
+                dir_id = module_dir_id(manifest.resolve_base_path),
+                includes = [self.modules[include_key] for include_key in include_keys],
+                steps = manifest.steps,
+                files = self.files[key],
+            )
+        return self.modules[root_key]
+
+def module_dir_id(resolve_base_path: Path) -> int:
+    '''
+    Id of a module directory in `PATHS`: relative to the repository when it is
+    inside it, absolute otherwise; `BASE_PATH / PATHS[id]` gives it back either way.
+    '''
+    try:
+        return PATHS.intern(resolve_base_path.relative_to(BASE_PATH))
+    except ValueError:
+        return PATHS.intern(resolve_base_path)
+
+@dataclass(eq = False, slots = True)
+class Module:
+    name: str
+    # Ids in `PATHS` of the manifest and of the resolved module directory.
+    path_id: int = field(repr = False)
+    dir_id: int = field(repr = False)
+    includes: List['Module']
+    steps: List[DependencyCmds]
+    files: List[DependencyFiles]
+
+    @staticmethod
+    def from_path(base_path: Path, module_path: Path, stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM) -> 'Module':
+        return ModuleLoader(stat_cache, algorithm).load(base_path, module_path)
+
+    @property
+    def path(self) -> Path:
+        return PATHS.path(self.path_id)
+
+    @property
+    def resolve_base_path(self) -> Path:
+        return BASE_PATH / PATHS[self.dir_id]
+
+    # A module is identified by its directory, so the node shared by several
+    # parents compares and hashes the same everywhere.
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Module):
+            return NotImplemented
+        return self.dir_id == other.dir_id
+
     def __hash__(self) -> int:
-        return hash(id(self))
+        return hash(self.dir_id)
  
-def parse_module(base_path: Union[Path, str] = './') -> Module:
+def parse_module(base_path: Union[Path, str] = './', stat_cache: Optional[StatCache] = None, algorithm: str = DEFAULT_ALGORITHM, graph_cache: Optional[GraphCache] = None, glob_cache: Optional[GlobCache] = None) -> Module:
+    '''
+    Parses the module tree rooted at `base_path`, hashing files with `algorithm`.
+    File checksums are reused from `stat_cache` when the files did not change,
+    manifests are reused from `graph_cache` when their content did not change
+    and file patterns are not expanded again while `glob_cache` finds their
+    directories unchanged; the default on-disk caches are used and updated
+    when none is given.
+    '''
     module_path = Path(base_path) / 'module.json'
-    module = Module.from_path(Path(base_path), module_path)
+    owns_stat_cache = stat_cache is None
+    if stat_cache is None:
+        stat_cache = StatCache.load()
+    owns_graph_cache = graph_cache is None
+    if graph_cache is None:
+        graph_cache = GraphCache.load()
+    owns_glob_cache = glob_cache is None
+    if glob_cache is None:
+        glob_cache = GlobCache.load()
+    module = ModuleLoader(stat_cache, algorithm, graph_cache = graph_cache, glob_cache = glob_cache).load(Path(base_path), module_path)
+    try:
+        if owns_stat_cache:
+            stat_cache.save()
+        if owns_graph_cache:
+            graph_cache.save()
+        if owns_glob_cache:
+            glob_cache.retain_used()
+            glob_cache.save()
+    except OSError:
+        pass
     if module.name == '<Unknown Module>':
         module.name = "Root Module"
     return module
@@ -0,0 +1,69 @@
+import posixpath
+import threading
+from pathlib import Path, PurePath
+from typing import Dict, List, Tuple, Union
+
+class PathTable:
+    '''
+    Interns paths as '/'-separated, normalised strings and hands out a small
+    integer id for each, so a path shared by many nodes of the module graph
+    is stored once. A file path is split into the id of its directory and
+    its name, and names are shared too, so the files of a million-file graph
+    do not each hold their full path. `Path` objects are only created on
+    request.
+
+    Ids are never reused; a table lives as long as the process.
+    '''
+    def __init__(self) -> None:
+        self.ids: Dict[str, int] = {}
+        self.strings: List[str] = []
+        self.names: Dict[str, str] = {}
+        # Manifests are parsed on several threads.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(path: Union[PurePath, str]) -> str:
+        path_str = path.as_posix() if isinstance(path, PurePath) else path
+        path_str = posixpath.normpath(path_str)
+        return '' if path_str == '.' else path_str
+
+    def intern(self, path: Union[PurePath, str]) -> int:
+        path_str = self.normalize(path)
+        path_id = self.ids.get(path_str)
+        if path_id is not None:
+            return path_id
+        with self.lock:
+            path_id = self.ids.get(path_str)
+            if path_id is None:
+                path_id = len(self.strings)
+                self.strings.append(path_str)
+                self.ids[path_str] = path_id
+        return path_id
+
+    def split(self, path: Union[PurePath, str]) -> Tuple[int, str]:
+        '''
+        Returns the id of the directory of `path` and its interned name.
+        '''
+        path_str = self.normalize(path)
+        head, _, name = path_str.rpartition('/')
+        if head == '' and path_str.startswith('/'):
+            head = '/'
+        return (self.intern(head), self.names.setdefault(name, name))
+
+    def join(self, dir_id: int, name: str) -> str:
+        head = self.strings[dir_id]
+        if head == '' or head.endswith('/'):
+            return head + name
+        return f'{head}/{name}'
+
+    def __getitem__(self, path_id: int) -> str:
+        return self.strings[path_id]
+
+    def path(self, path_id: int) -> Path:
+        return Path(self.strings[path_id])
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+# Shared by every module graph of the process, so reloading a graph reuses its ids.
+PATHS = PathTable()
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+import asyncio
+import heapq
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Set, Tuple
+from .parse_module_dep import StepResources
+
+def physical_memory() -> Optional[int]:
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+@dataclass
+class ResourceBudget:
+    # CPU slots shared by all running steps.
+    cpu: int
+    # Bytes shared by all running steps; `None` does not limit memory.
+    memory: Optional[int] = None
+
+    @staticmethod
+    def default(cpu: int) -> 'ResourceBudget':
+        return ResourceBudget(cpu = cpu, memory = physical_memory())
+
+    def clamp(self, resources: StepResources) -> StepResources:
+        '''
+        A step that asks for more than the whole budget runs alone instead of never.
+        '''
+        memory = resources.memory if self.memory is None else min(resources.memory, self.memory)
+        return StepResources(cpu = min(resources.cpu, self.cpu), memory = memory, pools = resources.pools)
+
+@dataclass(eq = False)
+class ResourceRequest:
+    resources: StepResources
+    future: 'asyncio.Future[None]'
+
+class ResourceGovernor:
+    '''
+    Admits steps while the sum of their resources fits `budget` and each
+    exclusive pool is held by at most one step.
+
+    Waiting steps are admitted by descending priority. A step that does not
+    fit keeps the CPU and memory it is waiting for reserved, so smaller steps
+    behind it cannot starve it; a step that only waits for a pool reserves
+    just that pool.
+    '''
+    def __init__(self, budget: ResourceBudget) -> None:
+        self.budget = budget
+        self.cpu = 0
+        self.memory = 0
+        self.pools: Set[str] = set()
+        self.waiting: List[Tuple[float, int, ResourceRequest]] = []
+        self.sequence = 0
+
+    def fits(self, resources: StepResources, cpu: int, memory: Optional[int], pools: Set[str]) -> Tuple[bool, bool]:
+        '''
+        Whether `resources` fit into what is left, and whether CPU or memory
+        (rather than a pool) is what is missing.
+        '''
+        short = resources.cpu > cpu or (memory is not None and resources.memory > memory)
+        return (not short and pools.isdisjoint(resources.pools), short)
+
+    def admit(self) -> None:
+        cpu = self.budget.cpu - self.cpu
+        memory = None if self.budget.memory is None else self.budget.memory - self.memory
+        pools = set(self.pools)
+        remaining: List[Tuple[float, int, ResourceRequest]] = []
+        while len(self.waiting) > 0:
+            entry = heapq.heappop(self.waiting)
+            request = entry[2]
+            if request.future.done():
+                continue
+            fits, short = self.fits(request.resources, cpu, memory, pools)
+            if fits:
+                self.take(request.resources)
+                request.future.set_result(None)
+            else:
+                remaining.append(entry)
+            if fits or short:
+                cpu -= request.resources.cpu
+                memory = None if memory is None else memory - request.resources.memory
+            pools.update(request.resources.pools)
+        self.waiting = remaining
+        heapq.heapify(self.waiting)
+
+    def take(self, resources: StepResources) -> None:
+        self.cpu += resources.cpu
+        self.memory += resources.memory
+        self.pools.update(resources.pools)
+
+    def release(self, resources: StepResources) -> None:
+        self.cpu -= resources.cpu
+        self.memory -= resources.memory
+        self.pools.difference_update(resources.pools)
+        self.admit()
+
+    @asynccontextmanager
+    async def acquire(self, resources: StepResources, priority: float = 0.0) -> AsyncIterator[None]:
+        resources = self.budget.clamp(resources)
+        request = ResourceRequest(resources = resources, future = asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiting, (-priority, self.sequence, request))
+        self.sequence += 1
+        self.admit()
+        try:
+            await request.future
+        except BaseException:
+            if request.future.done() and not request.future.cancelled():
+                self.release(resources)
+            else:
+                request.future.cancel()
+                self.admit()
+            raise
+        try:
+            yield
+        finally:
+            self.release(resources)
@@ -1,56 +1,217 @@
-from os import chdir, getcwd
-import subprocess
-from typing import Optional
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import os
+import re
+import signal
+from pathlib import Path
+from typing import BinaryIO, Callable, Deque, Optional
 
 from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
+from .hashing import hash_bytes, split_checksum
 from .parse_module_dep import DependencyCmds
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
 from colorama import Fore, Style
 
 TAB_SPACE = '    '
+STEP_LOG_PATH = BASE_PATH / CACHE_DIR_NAME / 'logs'
+DEFAULT_TAIL_LINES = 50
+DEFAULT_TAIL_BYTES = 16 * 1024
+READ_SIZE = 64 * 1024
+# Longer lines are split, so a child that never writes a newline cannot grow our buffer.
+MAX_LINE_BYTES = 64 * 1024
+# Seconds a killed step gets to exit after SIGTERM before it gets SIGKILL.
+KILL_GRACE_PERIOD = 5.0
 
-def convert_output_to_str(output: Optional[bytes]) -> str:
-    if output is None:
-        return ''
+@dataclass
+class StepOutputOptions:
+    # Forward every line to the diagnostics while the step runs.
+    live: bool = False
+    # Directory of the full per-step logs; `None` keeps no logs.
+    log_dir: Optional[Path] = STEP_LOG_PATH
+    # Bounds of the output kept in memory for the report after the step.
+    tail_lines: int = DEFAULT_TAIL_LINES
+    tail_bytes: int = DEFAULT_TAIL_BYTES
+
+class OutputTail:
+    '''
+    The last lines of a stream, bounded by count and size.
+    '''
+    def __init__(self, max_lines: int = DEFAULT_TAIL_LINES, max_bytes: int = DEFAULT_TAIL_BYTES) -> None:
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lines: Deque[bytes] = deque()
+        self.size = 0
+        self.total = 0
+
+    def append(self, line: bytes) -> None:
+        self.total += 1
+        if len(line) > self.max_bytes:
+            line = line[-self.max_bytes:]
+        self.lines.append(line)
+        self.size += len(line)
+        while len(self.lines) > self.max_lines or self.size > self.max_bytes:
+            self.size -= len(self.lines.popleft())
+
+    @property
+    def dropped(self) -> int:
+        return self.total - len(self.lines)
+
+    def to_str(self) -> str:
+        return f'\n{TAB_SPACE}'.join(decode_line(line) for line in self.lines).strip()
+
+def decode_line(line: bytes) -> str:
+    return line.decode('utf-8', errors = 'replace').rstrip('\r')
+
+def step_log_path(log_dir: Path, location: DiagnosticLocation, cmd: DependencyCmds) -> Path:
+    '''
+    Log file of a step: one directory per module, one file per step. The
+    command's digest tells apart steps with the same name.
+    '''
+    module_dir = re.sub(r'[^A-Za-z0-9._-]+', '_', str(location.path.parent)).strip('_') or 'root'
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', cmd.name).strip('_') or 'step'
+    digest = split_checksum(hash_bytes(cmd.cmd.encode()))[1][:8]
+    return log_dir / module_dir / f'{name}-{digest}.log'
+
+async def pump_lines(stream: Optional[asyncio.StreamReader], tail: OutputTail, log: Optional[BinaryIO], on_line: Optional[Callable[[bytes], None]]) -> None:
+    '''
+    Reads `stream` as it is produced, keeping only `tail` in memory.
+    '''
+    if stream is None:
+        return
+    partial = b''
+
+    def emit(line: bytes) -> None:
+        tail.append(line)
+        if log is not None:
+            log.write(line + b'\n')
+        if on_line is not None:
+            on_line(line)
+
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if len(chunk) == 0:
+            break
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            emit(line)
+        while len(partial) > MAX_LINE_BYTES:
+            emit(partial[:MAX_LINE_BYTES])
+            partial = partial[MAX_LINE_BYTES:]
+    if len(partial) > 0:
+        emit(partial)
+
+def report_tail(diagnostic: DiagnosticBase, location: DiagnosticLocation, kind: DiagnosticKind, title: str, tail: OutputTail, log_path: Optional[Path]) -> None:
+    # Decoding the output is wasted work when its level is filtered out.
+    if tail.total == 0 or not diagnostic.is_enabled(kind):
+        return
+    header = title
+    if tail.dropped > 0:
+        header = f'{title} (last {len(tail.lines)} of {tail.total} lines)'
+    if log_path is not None:
+        header = f'{header} [log: "{log_path}"]'
+    color = Fore.GREEN
+    match kind:
+        case DiagnosticKind.ERROR: color = Fore.RED
+        case DiagnosticKind.WARNING: color = Fore.YELLOW
+    diagnostic.add(location, kind, f'{color}{Style.BRIGHT}{header}: {Style.RESET_ALL} \n{TAB_SPACE}{tail.to_str()}')
+
+async def terminate_process_group(process: asyncio.subprocess.Process, grace_period: float = KILL_GRACE_PERIOD) -> None:
+    '''
+    Stops the step and everything it started: the shell leads its own session
+    (`start_new_session`), so its process group holds all of its children.
+    '''
+    if process.returncode is not None:
+        return
     try:
-        return output.decode('utf-8').strip().replace('\r\n', '\n').replace('\n', f'\n{TAB_SPACE}')
-    except:
-        return ''
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(process.wait(), grace_period)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
 
-def run_shell(diagnostic: DiagnosticBase, location: DiagnosticLocation, cmd: DependencyCmds):
+async def run_shell_async(diagnostic: DiagnosticBase, location: DiagnosticLocation, cmd: DependencyCmds, output: Optional[StepOutputOptions] = None) -> bool:
+    '''
+    Runs `cmd` and streams its output: lines are optionally forwarded live,
+    written to the step's log file, and only a bounded tail of each stream is
+    kept for the report after the step. The step's process group is killed
+    when it exceeds its `timeout` or the build is cancelled.
+    '''
+    if output is None:
+        output = StepOutputOptions()
     diagnostic.add(location, DiagnosticKind.INFO, f'Running shell command: "{cmd.cmd}"')
-    current_dir = getcwd()
-    try:
-        cmd_base_path = location.resolved_base_path
-        diagnostic.add(location, DiagnosticKind.INFO, f'Changing directory to: "{cmd_base_path}"')
-        chdir(cmd_base_path)
-    except:
-        diagnostic.add(location, DiagnosticKind.ERROR, f'Unable to change directory: from "{current_dir}" to "{cmd_base_path}"')
+    cmd_base_path = location.resolved_base_path
+    if not cmd_base_path.is_dir():
+        diagnostic.add(location, DiagnosticKind.ERROR, f'Unable to run in directory: "{cmd_base_path}"')
         return False
-    
+    diagnostic.add(location, DiagnosticKind.INFO, f'Working directory: "{cmd_base_path}"')
+
+    log_path = None if output.log_dir is None else step_log_path(output.log_dir, location, cmd)
+    log: Optional[BinaryIO] = None
+    stdout = OutputTail(output.tail_lines, output.tail_bytes)
+    stderr = OutputTail(output.tail_lines, output.tail_bytes)
+    live = output.live and diagnostic.is_enabled(DiagnosticKind.INFO)
+
+    def forward(prefix: str) -> Optional[Callable[[bytes], None]]:
+        if not live:
+            return None
+        return lambda line: diagnostic.add(location, DiagnosticKind.INFO, f'{prefix}{decode_line(line)}')
+
+    timed_out = False
     try:
-        result = subprocess.run(cmd.cmd, shell=True, start_new_session=True, capture_output=True)
-        if result.returncode != 0:
-            diagnostic.add(location, DiagnosticKind.ERROR, f'Shell command failed: {result.returncode}')
-            stdout = convert_output_to_str(result.stdout)
-            stderr = convert_output_to_str(result.stderr)
-            if len(stdout) > 0:
-                diagnostic.add(location, DiagnosticKind.INFO, f'{Fore.GREEN}{Style.BRIGHT}Stdout: {Style.RESET_ALL} \n{TAB_SPACE}{stdout}')
-
-            if len(stderr) > 0:
-                diagnostic.add(location, DiagnosticKind.ERROR, f'{Fore.RED}{Style.BRIGHT}Stderr: {Style.RESET_ALL} \n{TAB_SPACE}{stderr}')
-            return False
-        else:
-            diagnostic.add(location, DiagnosticKind.SUCCESS, f'Shell command succeeded')
-            stdout = convert_output_to_str(result.stdout)
-            stderr = convert_output_to_str(result.stderr)
-            if len(stdout) > 0:
-                diagnostic.add(location, DiagnosticKind.INFO, f'{Fore.GREEN}{Style.BRIGHT}Stdout: {Style.RESET_ALL} \n{TAB_SPACE}{stdout}')
-
-            if len(stderr) > 0:
-                diagnostic.add(location, DiagnosticKind.ERROR, f'{Fore.RED}{Style.BRIGHT}Stderr: {Style.RESET_ALL} \n{TAB_SPACE}{stderr}')
-        return True
+        if log_path is not None:
+            log_path.parent.mkdir(parents = True, exist_ok = True)
+            log = log_path.open('wb')
+        # The child gets its own working directory and session, so commands of
+        # different modules can run at the same time without touching our cwd.
+        process = await asyncio.create_subprocess_shell(
+            cmd.cmd,
+            cwd = cmd_base_path,
+            start_new_session = True,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.PIPE,
+        )
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                pump_lines(process.stdout, stdout, log, forward('')),
+                pump_lines(process.stderr, stderr, log, forward('stderr: ')),
+                process.wait(),
+            ), cmd.timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            await terminate_process_group(process)
+        except asyncio.CancelledError:
+            await terminate_process_group(process)
+            raise
     except Exception as e:
         diagnostic.add(location, DiagnosticKind.ERROR, f'Unable to run shell command: {e}')
         return False
     finally:
-        chdir(current_dir)
\ No newline at end of file
+        if log is not None:
+            log.close()
+
+    if timed_out or process.returncode != 0:
+        if timed_out:
+            diagnostic.add(location, DiagnosticKind.ERROR, f'Shell command timed out after {cmd.timeout:g}s')
+        else:
+            diagnostic.add(location, DiagnosticKind.ERROR, f'Shell command failed: {process.returncode}')
+        report_tail(diagnostic, location, DiagnosticKind.INFO, 'Stdout', stdout, log_path)
+        report_tail(diagnostic, location, DiagnosticKind.ERROR, 'Stderr', stderr, log_path)
+        return False
+
+    diagnostic.add(location, DiagnosticKind.SUCCESS, f'Shell command succeeded')
+    if not live:
+        report_tail(diagnostic, location, DiagnosticKind.INFO, 'Stdout', stdout, log_path)
+        # Many tools log progress to stderr; that does not make a successful step an error.
+        report_tail(diagnostic, location, DiagnosticKind.WARNING, 'Stderr', stderr, log_path)
+    return True
+
+def run_shell(diagnostic: DiagnosticBase, location: DiagnosticLocation, cmd: DependencyCmds, output: Optional[StepOutputOptions] = None) -> bool:
+    return asyncio.run(run_shell_async(diagnostic, location, cmd, output))
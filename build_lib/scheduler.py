@@ -0,0 +1,224 @@
+from dataclasses import dataclass, field
+import asyncio
+import heapq
+import os
+import time
+from typing import AbstractSet, Awaitable, Callable, Dict, List, MutableMapping, Optional, Tuple
+from .parse_module_dep import Module
+from .tracing import CURRENT_SLOT, current_track, get_tracer
+
+def default_job_count() -> int:
+    return os.cpu_count() or 1
+
+def default_module_cost(module: Module) -> float:
+    return float(len(module.steps))
+
+@dataclass(eq = False)
+class ScheduleNode:
+    module: Module
+    cost: float
+    # Modules listed in `includes`; they must finish before this node starts.
+    dependencies: List['ScheduleNode'] = field(default_factory = list)
+    # Modules that include this one.
+    dependents: List['ScheduleNode'] = field(default_factory = list)
+    # Cost of the longest path from this node up to a root, including itself.
+    priority: float = 0.0
+
+@dataclass
+class BuildGraph:
+    nodes: Dict[Module, ScheduleNode]
+
+    @staticmethod
+    def from_module(module: Module, cost: Callable[[Module], float] = default_module_cost) -> 'BuildGraph':
+        nodes: Dict[Module, ScheduleNode] = {}
+
+        def visit(current: Module) -> ScheduleNode:
+            node = nodes.get(current)
+            if node is not None:
+                return node
+            node = ScheduleNode(module = current, cost = cost(current))
+            nodes[current] = node
+            for include in current.includes:
+                dep = visit(include)
+                if dep not in node.dependencies:
+                    node.dependencies.append(dep)
+                    dep.dependents.append(node)
+            return node
+
+        visit(module)
+        graph = BuildGraph(nodes = nodes)
+        graph.compute_priorities()
+        return graph
+
+    def subgraph(self, modules: AbstractSet[Module]) -> 'BuildGraph':
+        '''
+        Returns the graph restricted to `modules`. The set is expected to be
+        closed under "is included by", so no ordering is lost by dropping the
+        edges to other modules.
+        '''
+        nodes = { node.module: ScheduleNode(module = node.module, cost = node.cost) for node in self.nodes.values() if node.module in modules }
+        for node in self.nodes.values():
+            if node.module not in nodes:
+                continue
+            for dep in node.dependencies:
+                if dep.module in nodes:
+                    nodes[node.module].dependencies.append(nodes[dep.module])
+                    nodes[dep.module].dependents.append(nodes[node.module])
+        graph = BuildGraph(nodes = nodes)
+        graph.compute_priorities()
+        return graph
+
+    def topological_order(self) -> List[ScheduleNode]:
+        '''
+        Returns the nodes so that every node comes after all of its dependencies.
+        '''
+        pending = { node.module: len(node.dependencies) for node in self.nodes.values() }
+        ready = [node for node in self.nodes.values() if pending[node.module] == 0]
+        order: List[ScheduleNode] = []
+        while len(ready) > 0:
+            node = ready.pop()
+            order.append(node)
+            for parent in node.dependents:
+                pending[parent.module] -= 1
+                if pending[parent.module] == 0:
+                    ready.append(parent)
+
+        if len(order) != len(self.nodes):
+            stuck = [f'"{node.module.name}"' for node in self.nodes.values() if pending[node.module] > 0]
+            raise ValueError(f'Include cycle between modules: {", ".join(stuck)}')
+        return order
+
+    def compute_priorities(self) -> None:
+        for node in reversed(self.topological_order()):
+            longest = max((parent.priority for parent in node.dependents), default = 0.0)
+            node.priority = node.cost + longest
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+async def run_graph(
+    graph: BuildGraph,
+    run: Callable[[Module], Awaitable[bool]],
+    jobs: Optional[int] = None,
+    on_blocked: Optional[Callable[[Module, Module], None]] = None,
+    slotless: AbstractSet[Module] = frozenset(),
+    fail_fast: bool = False,
+    on_cancelled: Optional[Callable[[Module, Module], None]] = None,
+) -> MutableMapping[Module, bool]:
+    '''
+    Runs `run` for every module in the graph, starting a module only once all
+    of its includes succeeded. At most `jobs` modules run at the same time and
+    ready modules on the longest remaining path are started first.
+
+    Modules whose includes failed are not run; `on_blocked(module, failed_include)`
+    is called for each of them and they are reported as failed.
+
+    Every running module occupies one of `jobs` worker slots, exposed through
+    `CURRENT_SLOT`; with an active tracer the time each module waited in the
+    ready queue and the time it ran are recorded on the track of its slot.
+    Modules in `slotless` only wait for something outside this process, so
+    they start as soon as they are ready, without a slot.
+
+    With `fail_fast`, the first failure cancels the running modules, calling
+    `on_cancelled(module, failed)` for each, and no further module is started.
+    '''
+    if jobs is None:
+        jobs = default_job_count()
+    if jobs < 1:
+        raise ValueError(f'Job count must be at least 1, but found {jobs}')
+
+    results: MutableMapping[Module, bool] = {}
+    pending = { node.module: len(node.dependencies) for node in graph.nodes.values() }
+    ready: List[Tuple[float, int, ScheduleNode]] = []
+    running: Dict[asyncio.Task, Tuple[ScheduleNode, Optional[int]]] = {}
+    free_slots = list(range(jobs))
+    sequence = 0
+    tracer = get_tracer()
+    ready_ns: Dict[Module, int] = {}
+
+    def start(node: ScheduleNode, slot: Optional[int]) -> None:
+        task = asyncio.create_task(run_in_slot(node, slot), name = f'{node.module.name}_build')
+        running[task] = (node, slot)
+
+    def push(node: ScheduleNode) -> None:
+        nonlocal sequence
+        if node.module in slotless:
+            start(node, None)
+            return
+        heapq.heappush(ready, (-node.priority, sequence, node))
+        sequence += 1
+        if tracer is not None:
+            ready_ns[node.module] = time.perf_counter_ns()
+
+    async def run_in_slot(node: ScheduleNode, slot: Optional[int]) -> bool:
+        # Tasks run in a copy of the current context, so this is only seen by `node`.
+        CURRENT_SLOT.set(slot)
+        if tracer is None:
+            return await run(node.module)
+        start_ns = time.perf_counter_ns()
+        track = current_track()
+        tracer.add(node.module.name, 'queue', ready_ns.pop(node.module, start_ns), start_ns, track)
+        success = False
+        try:
+            success = await run(node.module)
+            return success
+        finally:
+            tracer.add(node.module.name, 'module', start_ns, time.perf_counter_ns(), track, path = str(node.module.resolve_base_path), success = success)
+
+    def block(node: ScheduleNode, failed: Module) -> None:
+        for parent in node.dependents:
+            if parent.module in results:
+                continue
+            results[parent.module] = False
+            if on_blocked is not None:
+                on_blocked(parent.module, failed)
+            block(parent, failed)
+
+    async def cancel(failed: Module) -> None:
+        for task in running:
+            task.cancel()
+        # Cancelled steps kill their processes before the tasks finish.
+        await asyncio.gather(*running, return_exceptions = True)
+        for node, _ in running.values():
+            results[node.module] = False
+            if on_cancelled is not None:
+                on_cancelled(node.module, failed)
+        running.clear()
+        ready.clear()
+        for node in graph.nodes.values():
+            if node.module not in results:
+                results[node.module] = False
+                if on_blocked is not None:
+                    on_blocked(node.module, failed)
+
+    for node in graph.topological_order():
+        if pending[node.module] == 0:
+            push(node)
+
+    while len(ready) > 0 or len(running) > 0:
+        while len(ready) > 0 and len(free_slots) > 0:
+            _, _, node = heapq.heappop(ready)
+            start(node, heapq.heappop(free_slots))
+
+        done, _ = await asyncio.wait(running.keys(), return_when = asyncio.FIRST_COMPLETED)
+        failed: Optional[Module] = None
+        for task in done:
+            node, slot = running.pop(task)
+            if slot is not None:
+                heapq.heappush(free_slots, slot)
+            success = task.result()
+            results[node.module] = success
+            if not success:
+                failed = failed or node.module
+                block(node, node.module)
+                continue
+            for parent in node.dependents:
+                pending[parent.module] -= 1
+                if pending[parent.module] == 0 and parent.module not in results:
+                    push(parent)
+
+        if fail_fast and failed is not None:
+            await cancel(failed)
+            break
+
+    return results
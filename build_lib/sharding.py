@@ -0,0 +1,238 @@
+from dataclasses import dataclass
+import heapq
+import json
+import os
+import statistics
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from .changed_files import module_dir_key
+from .checksum_store import read_json_checksums, write_sorted_json
+from .parse_module_dep import Module
+from .scheduler import BuildGraph, ScheduleNode
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME
+
+DURATIONS_FILE_NAME = 'durations.json'
+DURATIONS_PATH = BASE_PATH / CACHE_DIR_NAME / DURATIONS_FILE_NAME
+DURATIONS_VERSION = 1
+# Weight of the latest run in the recorded duration of a module.
+DURATION_SMOOTHING = 0.5
+# Estimated seconds per step of a module that was never built.
+DEFAULT_STEP_SECONDS = 1.0
+# How long a shard waits for another shard to store the artifacts of an include.
+DEFAULT_SHARD_WAIT = 1800.0
+SHARD_POLL_INTERVAL = 2.0
+
+@dataclass(frozen = True)
+class ShardSpec:
+    # 1-based, like the shard options of most CI runners.
+    index: int
+    count: int
+
+    @staticmethod
+    def parse(text: str) -> 'ShardSpec':
+        index, sep, count = text.partition('/')
+        try:
+            spec = ShardSpec(index = int(index), count = int(count))
+        except ValueError:
+            raise ValueError(f'Invalid shard "{text}", expected "i/N"')
+        if sep == '' or spec.count < 1 or not 1 <= spec.index <= spec.count:
+            raise ValueError(f'Invalid shard "{text}", expected "i/N" with 1 <= i <= N')
+        return spec
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+class ModuleDurations:
+    '''
+    Smoothed build time of every module in seconds, keyed by its directory.
+    Shards only agree on an assignment if they read the same file, so they
+    record into a copy from `for_shard` instead. The file lives in the
+    uncommitted build cache, so CI has to persist it between runs.
+    '''
+    def __init__(self, path: Optional[Path] = DURATIONS_PATH) -> None:
+        self.path = path
+        self.entries: Dict[str, float] = {}
+        self.dirty = False
+        # Keys recorded by this build; with `only_recorded` the others are not saved.
+        self.recorded: Set[str] = set()
+        self.only_recorded = False
+
+    @staticmethod
+    def load(path: Optional[Path] = DURATIONS_PATH) -> 'ModuleDurations':
+        durations = ModuleDurations(path)
+        if path is None:
+            return durations
+        try:
+            json_data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return durations
+
+        if type(json_data) != dict or json_data.get('version') != DURATIONS_VERSION or type(json_data.get('entries')) != dict:
+            return durations
+        durations.entries = { key: float(value) for key, value in json_data['entries'].items() if type(value) in (int, float) and value >= 0 }
+        return durations
+
+    def record(self, module: Module, seconds: float) -> None:
+        key = module_dir_key(module)
+        previous = self.entries.get(key)
+        if previous is not None:
+            seconds = DURATION_SMOOTHING * seconds + (1 - DURATION_SMOOTHING) * previous
+        # Rounded so the file, and every assignment computed from it, is stable across platforms.
+        self.entries[key] = round(seconds, 3)
+        self.recorded.add(key)
+        self.dirty = True
+
+    def for_shard(self, path: Path) -> 'ModuleDurations':
+        '''
+        Copy that a shard records its build times into, saved to `path` with
+        only the modules the shard built, so the file all shards planned with
+        stays untouched until `merge_shard_durations`.
+        '''
+        durations = ModuleDurations(path)
+        durations.entries = dict(self.entries)
+        durations.only_recorded = True
+        return durations
+
+    def update(self, entries: Mapping[str, float]) -> None:
+        self.entries.update(entries)
+        self.dirty = True
+
+    def estimate(self, module: Module) -> float:
+        '''
+        Recorded duration of `module`, or its step count times the median
+        recorded seconds per step.
+        '''
+        seconds = self.entries.get(module_dir_key(module))
+        if seconds is not None:
+            return seconds
+        return len(module.steps) * self.seconds_per_step()
+
+    def seconds_per_step(self) -> float:
+        if len(self.entries) == 0:
+            return DEFAULT_STEP_SECONDS
+        return statistics.median(self.entries.values()) or DEFAULT_STEP_SECONDS
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        entries = { key: self.entries[key] for key in self.recorded } if self.only_recorded else self.entries
+        json_data = { 'version': DURATIONS_VERSION, 'entries': dict(sorted(entries.items())) }
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(json_data, indent = 4))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+@dataclass
+class ShardPlan:
+    spec: ShardSpec
+    # Modules built by this shard.
+    modules: Set[Module]
+    # Includes of those modules built by other shards; their outputs are
+    # restored from the shared artifact store once the other shard stored them.
+    foreign: Set[Module]
+    wait_timeout: float = DEFAULT_SHARD_WAIT
+
+    def only(self) -> Set[Module]:
+        return self.modules | self.foreign
+
+def shard_groups(graph: BuildGraph, can_split: Optional[Callable[[Module], bool]] = None) -> List[List[ScheduleNode]]:
+    '''
+    Splits the graph into groups that are built on the same shard. A module
+    with steps stays with its includes, unless `can_split(include)` allows the
+    include to be restored from the artifact store instead. Modules without
+    steps only order their includes and do not link them.
+    '''
+    parent: Dict[Module, Module] = { module: module for module in graph.nodes }
+
+    def find(module: Module) -> Module:
+        while parent[module] is not module:
+            parent[module] = parent[parent[module]]
+            module = parent[module]
+        return module
+
+    for node in graph.nodes.values():
+        if len(node.module.steps) == 0:
+            continue
+        for dep in node.dependencies:
+            if can_split is None or not can_split(dep.module):
+                parent[find(dep.module)] = find(node.module)
+
+    groups: Dict[Module, List[ScheduleNode]] = {}
+    for node in graph.nodes.values():
+        groups.setdefault(find(node.module), []).append(node)
+    return list(groups.values())
+
+def assign_shards(graph: BuildGraph, count: int, estimate: Optional[ModuleDurations] = None, can_split: Optional[Callable[[Module], bool]] = None) -> List[Set[Module]]:
+    '''
+    Distributes the groups of `graph` over `count` shards, the most expensive
+    group first onto the least loaded shard. Ties are broken by module
+    directory, so every worker computes the same assignment.
+    '''
+    if estimate is None:
+        estimate = ModuleDurations(None)
+    weighted: List[Tuple[float, str, List[ScheduleNode]]] = []
+    for group in shard_groups(graph, can_split):
+        cost = sum(estimate.estimate(node.module) for node in group)
+        weighted.append((cost, min(module_dir_key(node.module) for node in group), group))
+    weighted.sort(key = lambda entry: (-entry[0], entry[1]))
+
+    shards: List[Set[Module]] = [set() for _ in range(count)]
+    loads = [(0.0, index) for index in range(count)]
+    for cost, _, group in weighted:
+        load, index = heapq.heappop(loads)
+        shards[index].update(node.module for node in group)
+        heapq.heappush(loads, (load + cost, index))
+    return shards
+
+def plan_shard(graph: BuildGraph, spec: ShardSpec, estimate: Optional[ModuleDurations] = None, can_split: Optional[Callable[[Module], bool]] = None, wait_timeout: float = DEFAULT_SHARD_WAIT) -> ShardPlan:
+    modules = assign_shards(graph, spec.count, estimate, can_split)[spec.index - 1]
+    foreign = { dep.module for module in modules if len(module.steps) > 0 for dep in graph.nodes[module].dependencies if dep.module not in modules }
+    return ShardPlan(spec = spec, modules = modules, foreign = foreign, wait_timeout = wait_timeout)
+
+def shard_checksums_path(spec: ShardSpec) -> Path:
+    return BASE_PATH / f'checksums.shard-{spec.index}-of-{spec.count}.json'
+
+def write_shard_checksums(path: Path, checksums: Mapping[str, Optional[str]]) -> None:
+    '''
+    Writes the checksum updates of a shard; a `None` checksum (`null`)
+    removes the entry of a file that no module declares any more.
+    '''
+    write_sorted_json(path, sorted(checksums.items()))
+
+def shard_durations_path(durations_path: Path, spec: ShardSpec) -> Path:
+    return durations_path.with_name(f'{durations_path.stem}.shard-{spec.index}-of-{spec.count}{durations_path.suffix}')
+
+def merge_shard_durations(paths: Iterable[Path]) -> Dict[str, float]:
+    '''
+    Combines the build times recorded by every shard. A shard only records
+    the modules it built itself, so no module appears twice.
+    '''
+    merged: Dict[str, float] = {}
+    for path in paths:
+        if not path.exists():
+            raise FileNotFoundError(f'Shard durations not found: "{path}"')
+        merged.update(ModuleDurations.load(path).entries)
+    return merged
+
+def merge_shard_checksums(paths: Iterable[Path]) -> Dict[str, Optional[str]]:
+    '''
+    Combines the checksum updates of every shard. Raises `ValueError` if two
+    shards recorded different checksums for a file, since the shards then
+    built different sources.
+    '''
+    merged: Dict[str, Optional[str]] = {}
+    origin: Dict[str, Path] = {}
+    for path in paths:
+        checksums = read_json_checksums(path)
+        if checksums is None:
+            raise FileNotFoundError(f'Shard checksums not found: "{path}"')
+        for key, checksum in checksums.items():
+            if checksum is not None and type(checksum) != str:
+                raise ValueError(f'Invalid checksum of "{key}" in "{path}"')
+            if key in merged and merged[key] != checksum:
+                raise ValueError(f'Conflicting checksums of "{key}" in "{origin[key]}" and "{path}"')
+            merged[key] = checksum
+            origin[key] = path
+    return merged
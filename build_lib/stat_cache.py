@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+from .hashing import DEFAULT_ALGORITHM, checksum_algorithm, hash_file, hash_files
+
+BASE_PATH = Path(__file__).parent.parent
+CACHE_DIR_NAME = '.build_cache'
+STAT_CACHE_FILE_NAME = 'stat_cache.json'
+STAT_CACHE_PATH = BASE_PATH / CACHE_DIR_NAME / STAT_CACHE_FILE_NAME
+STAT_CACHE_VERSION = 1
+
+@dataclass
+class StatEntry:
+    size: int
+    mtime_ns: int
+    inode: int
+    checksum: str
+
+    @staticmethod
+    def from_stat(st: os.stat_result, checksum: str) -> 'StatEntry':
+        return StatEntry(size = st.st_size, mtime_ns = st.st_mtime_ns, inode = st.st_ino, checksum = checksum)
+
+    def matches(self, st: os.stat_result) -> bool:
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns and self.inode == st.st_ino
+
+class StatCache:
+    '''
+    Remembers the checksum of a file together with its size, mtime and inode,
+    so an unchanged file does not have to be read again.
+
+    Like git's index, an entry whose mtime is not older than the last time the
+    cache was written is "racily clean": the file may have been modified again
+    within the timestamp granularity, so its checksum is recomputed.
+    '''
+    def __init__(self, path: Optional[Path] = STAT_CACHE_PATH) -> None:
+        self.path = path
+        self.entries: Dict[str, StatEntry] = {}
+        # mtime of the cache file when it was loaded; entries at or after it are suspect.
+        self.written_ns: Optional[int] = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(path: Optional[Path] = STAT_CACHE_PATH) -> 'StatCache':
+        cache = StatCache(path)
+        if path is None:
+            return cache
+        try:
+            written_ns = path.stat().st_mtime_ns
+            json_data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return cache
+
+        if type(json_data) != dict or json_data.get('version') != STAT_CACHE_VERSION or type(json_data.get('entries')) != dict:
+            return cache
+
+        for key, value in json_data['entries'].items():
+            try:
+                size, mtime_ns, inode, checksum = value
+                cache.entries[key] = StatEntry(size = int(size), mtime_ns = int(mtime_ns), inode = int(inode), checksum = str(checksum))
+            except (TypeError, ValueError):
+                continue
+        cache.written_ns = written_ns
+        return cache
+
+    def is_racy(self, entry: StatEntry) -> bool:
+        return self.written_ns is None or entry.mtime_ns >= self.written_ns
+
+    def lookup(self, key: str, st: os.stat_result, algorithm: str = DEFAULT_ALGORITHM) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None or not entry.matches(st) or self.is_racy(entry):
+            return None
+        if checksum_algorithm(entry.checksum) != algorithm:
+            return None
+        return entry.checksum
+
+    def update(self, key: str, st: os.stat_result, checksum: str) -> None:
+        entry = StatEntry.from_stat(st, checksum)
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.dirty = True
+
+    def checksum(self, key: str, path: Path, algorithm: str = DEFAULT_ALGORITHM) -> str:
+        '''
+        Returns the checksum of `path`, hashing it only when the stat information
+        differs from the cached entry or the entry is racily clean.
+        '''
+        st = os.stat(path)
+        checksum = self.lookup(key, st, algorithm)
+        if checksum is not None:
+            self.hits += 1
+            return checksum
+
+        self.misses += 1
+        checksum = hash_file(path, algorithm)
+        self.update(key, st, checksum)
+        # Rewriting the cache moves its mtime past a racily clean entry, so the
+        # next run can trust it again.
+        self.dirty = True
+        return checksum
+
+    def checksum_many(self, files: Sequence[Tuple[str, Path]], algorithm: str = DEFAULT_ALGORITHM) -> List[str]:
+        '''
+        Like `checksum` for `(key, path)` pairs, hashing all misses in parallel.
+        '''
+        checksums: List[Optional[str]] = []
+        stats: List[os.stat_result] = []
+        missed: List[int] = []
+        for index, (key, path) in enumerate(files):
+            st = os.stat(path)
+            stats.append(st)
+            checksum = self.lookup(key, st, algorithm)
+            if checksum is None:
+                missed.append(index)
+            checksums.append(checksum)
+
+        self.hits += len(files) - len(missed)
+        self.misses += len(missed)
+        for index, checksum in zip(missed, hash_files([files[index][1] for index in missed], algorithm)):
+            self.update(files[index][0], stats[index], checksum)
+            checksums[index] = checksum
+        if len(missed) > 0:
+            self.dirty = True
+        return [checksum for checksum in checksums if checksum is not None]
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        json_data = {
+            'version': STAT_CACHE_VERSION,
+            'entries': { key: [e.size, e.mtime_ns, e.inode, e.checksum] for key, e in sorted(self.entries.items()) },
+        }
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(json_data, separators = (',', ':')))
+        os.replace(tmp_path, self.path)
+        self.written_ns = self.path.stat().st_mtime_ns
+        self.dirty = False
@@ -0,0 +1,122 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from .hashing import hash_bytes, hash_files
+from .parse_module_dep import DependencyCmds, Module
+from .stat_cache import BASE_PATH, CACHE_DIR_NAME, StatCache
+
+STEP_CACHE_FILE_NAME = 'step_cache.json'
+STEP_CACHE_PATH = BASE_PATH / CACHE_DIR_NAME / STEP_CACHE_FILE_NAME
+STEP_CACHE_VERSION = 1
+FINGERPRINT_ALGORITHM = 'sha256'
+
+def step_key(module: Module, index: int) -> str:
+    return f'{module.resolve_base_path}#{index}'
+
+def hash_inputs(module: Module, inputs: Iterable[str], stat_cache: Optional[StatCache] = None) -> Optional[List[Tuple[str, str]]]:
+    '''
+    Sorted checksums of the `inputs` of a step of `module`, or `None` if one is missing.
+    '''
+    inputs = sorted(inputs)
+    input_paths = [module.resolve_base_path / path for path in inputs]
+    if any(not path.is_file() for path in input_paths):
+        return None
+
+    if stat_cache is not None:
+        checksums = stat_cache.checksum_many([(str(path), path) for path in input_paths])
+    else:
+        checksums = hash_files(input_paths)
+    return list(zip(inputs, checksums))
+
+def step_fingerprint(module: Module, step: DependencyCmds, previous: Optional[str], stat_cache: Optional[StatCache] = None) -> Optional[str]:
+    '''
+    Fingerprint of everything the step declares to depend on: its command, the
+    checksums of its inputs, the selected environment variables and the
+    fingerprint of the step before it. Returns `None` when the step cannot be
+    cached, because it declares nothing or an input is missing.
+    '''
+    if not step.is_cacheable():
+        return None
+
+    inputs = hash_inputs(module, step.inputs, stat_cache)
+    if inputs is None:
+        return None
+
+    data = {
+        'cmd': step.cmd,
+        'inputs': inputs,
+        'outputs': sorted(step.outputs),
+        'env': { name: os.environ.get(name) for name in sorted(step.env) },
+        'previous': previous,
+    }
+    return hash_bytes(json.dumps(data, sort_keys = True).encode(), FINGERPRINT_ALGORITHM)
+
+def outputs_exist(module: Module, step: DependencyCmds) -> bool:
+    return all((module.resolve_base_path / path).exists() for path in step.outputs)
+
+class StepCache:
+    '''
+    Fingerprints of the last successful run of every cacheable step.
+    '''
+    def __init__(self, path: Optional[Path] = STEP_CACHE_PATH, stat_cache: Optional[StatCache] = None) -> None:
+        self.path = path
+        self.stat_cache = stat_cache
+        self.entries: Dict[str, str] = {}
+        self.dirty = False
+
+    @staticmethod
+    def load(path: Optional[Path] = STEP_CACHE_PATH, stat_cache: Optional[StatCache] = None) -> 'StepCache':
+        cache = StepCache(path, stat_cache)
+        if path is None:
+            return cache
+        try:
+            json_data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return cache
+
+        if type(json_data) != dict or json_data.get('version') != STEP_CACHE_VERSION or type(json_data.get('entries')) != dict:
+            return cache
+        cache.entries = { key: value for key, value in json_data['entries'].items() if type(value) == str }
+        return cache
+
+    def fingerprint(self, module: Module, index: int, previous: Optional[str]) -> Optional[str]:
+        '''
+        Fingerprint of step `index`, computed right before it would run since
+        its inputs may be produced by the steps before it. A step after an
+        uncacheable one is uncacheable too (`previous` is `None`), since the
+        effects of that step are unknown.
+        '''
+        if previous is None:
+            return None
+        return step_fingerprint(module, module.steps[index], previous, self.stat_cache)
+
+    def is_fresh(self, module: Module, index: int, fingerprint: Optional[str]) -> bool:
+        if fingerprint is None:
+            return False
+        return self.entries.get(step_key(module, index)) == fingerprint and outputs_exist(module, module.steps[index])
+
+    def record(self, module: Module, index: int, fingerprint: Optional[str]) -> None:
+        key = step_key(module, index)
+        if fingerprint is None:
+            if key in self.entries:
+                del self.entries[key]
+                self.dirty = True
+            return
+        if self.entries.get(key) != fingerprint:
+            self.entries[key] = fingerprint
+            self.dirty = True
+
+    def invalidate(self, module: Module, index: int) -> None:
+        self.record(module, index, None)
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        json_data = { 'version': STEP_CACHE_VERSION, 'entries': dict(sorted(self.entries.items())) }
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(json_data, indent = 4))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
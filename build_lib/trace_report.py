@@ -0,0 +1,79 @@
+from typing import Dict, List, Tuple
+from .parse_module_dep import Module
+from .scheduler import BuildGraph
+from .tracing import Tracer
+
+DEFAULT_TOP_STEPS = 10
+PHASES = [
+    ('parse', 'Parse manifests'),
+    ('hash', 'Hash files'),
+    ('diff', 'Diff checksums'),
+    ('queue', 'Queue wait'),
+    ('artifact', 'Artifacts'),
+    ('step', 'Steps'),
+]
+
+def module_durations(tracer: Tracer) -> Dict[str, int]:
+    '''
+    Run time of every built module, keyed by its resolved directory.
+    '''
+    return { str(event.args['path']): event.duration_ns for event in tracer.by_category('module') }
+
+def critical_path(graph: BuildGraph, durations: Dict[str, int]) -> Tuple[int, List[Tuple[Module, int]]]:
+    '''
+    Longest chain of modules through the include graph, weighted by their
+    traced run time: no schedule with more workers could finish sooner.
+    Returns its total time and the modules from the first to the last built.
+    '''
+    finish: Dict[Module, int] = {}
+    previous: Dict[Module, Module] = {}
+    for node in graph.topological_order():
+        start = 0
+        if len(node.dependencies) > 0:
+            slowest = max((dep.module for dep in node.dependencies), key = lambda dep: finish[dep])
+            previous[node.module] = slowest
+            start = finish[slowest]
+        finish[node.module] = start + durations.get(str(node.module.resolve_base_path), 0)
+
+    if len(finish) == 0:
+        return (0, [])
+    last = max(finish, key = lambda module: finish[module])
+    path: List[Tuple[Module, int]] = []
+    current = last
+    while True:
+        path.append((current, durations.get(str(current.resolve_base_path), 0)))
+        if current not in previous:
+            break
+        current = previous[current]
+    path.reverse()
+    return (finish[last], path)
+
+def format_seconds(duration_ns: float) -> str:
+    return f'{duration_ns / 1e9:.3f}s'
+
+def format_trace_summary(tracer: Tracer, module: Module, top: int = DEFAULT_TOP_STEPS) -> str:
+    lines: List[str] = ['Build trace summary']
+    if len(tracer.events) > 0:
+        end_ns = max(event.start_ns + event.duration_ns for event in tracer.events)
+        lines.append(f'  Wall time: {format_seconds(end_ns - tracer.origin_ns)}')
+
+    lines.append('  Phases (summed over workers):')
+    for category, title in PHASES:
+        events = tracer.by_category(category)
+        if len(events) == 0:
+            continue
+        lines.append(f'    {title:<16} {format_seconds(sum(event.duration_ns for event in events)):>10}  ({len(events)} events)')
+
+    durations = module_durations(tracer)
+    if len(durations) > 0:
+        total, path = critical_path(BuildGraph.from_module(module), durations)
+        lines.append(f'  Critical path: {format_seconds(total)} through {len(path)} modules')
+        for current, duration in path:
+            lines.append(f'    {format_seconds(duration):>10}  {current.name} ({current.path})')
+
+    steps = sorted((event for event in tracer.by_category('step') if not event.args.get('cached')), key = lambda event: event.duration_ns, reverse = True)[:top]
+    if len(steps) > 0:
+        lines.append('  Slowest steps:')
+        for event in steps:
+            lines.append(f'    {format_seconds(event.duration_ns):>10}  {event.args.get("module")}: {event.name}')
+    return '\n'.join(lines)
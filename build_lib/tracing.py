@@ -0,0 +1,110 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+# Track of the main thread; worker slot `n` is traced on track `n + 1`.
+MAIN_TRACK = 0
+# Worker slot running the current module, set by the scheduler for each module task.
+CURRENT_SLOT: ContextVar[Optional[int]] = ContextVar('CURRENT_SLOT', default = None)
+
+_tracer: Optional['Tracer'] = None
+_disabled = nullcontext()
+
+@dataclass
+class TraceEvent:
+    name: str
+    category: str
+    start_ns: int
+    duration_ns: int
+    track: int
+    args: Dict[str, Any] = field(default_factory = dict)
+
+    def to_chrome(self, origin_ns: int) -> dict:
+        return {
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': (self.start_ns - origin_ns) / 1000,
+            'dur': self.duration_ns / 1000,
+            'pid': os.getpid(),
+            'tid': self.track,
+            'args': self.args,
+        }
+
+class Tracer:
+    '''
+    Collects timed events of a build. Instrumented code asks `get_tracer()` for
+    the active tracer and does nothing when there is none.
+    '''
+    def __init__(self) -> None:
+        self.origin_ns = time.perf_counter_ns()
+        self.events: List[TraceEvent] = []
+
+    def add(self, name: str, category: str, start_ns: int, end_ns: int, track: Optional[int] = None, **args: Any) -> None:
+        if track is None:
+            track = current_track()
+        self.events.append(TraceEvent(name = name, category = category, start_ns = start_ns, duration_ns = end_ns - start_ns, track = track, args = args))
+
+    @contextmanager
+    def span(self, name: str, category: str, track: Optional[int] = None, **args: Any) -> Iterator[Dict[str, Any]]:
+        '''
+        Times the body; the yielded dict may be filled with extra arguments.
+        '''
+        start_ns = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            self.add(name, category, start_ns, time.perf_counter_ns(), track, **args)
+
+    def by_category(self, category: str) -> List[TraceEvent]:
+        return [event for event in self.events if event.category == category]
+
+    def to_chrome(self) -> dict:
+        tracks = sorted({ event.track for event in self.events } | { MAIN_TRACK })
+        metadata = [
+            { 'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': track, 'args': { 'name': 'main' if track == MAIN_TRACK else f'worker {track - 1}' } }
+            for track in tracks
+        ]
+        events = [event.to_chrome(self.origin_ns) for event in sorted(self.events, key = lambda event: event.start_ns)]
+        return { 'traceEvents': metadata + events, 'displayTimeUnit': 'ms' }
+
+    def export_chrome(self, path: Path) -> None:
+        '''
+        Writes the events in the Chrome `trace_event` format, viewable in
+        chrome://tracing or Perfetto.
+        '''
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(self.to_chrome()))
+        os.replace(tmp_path, path)
+
+def current_track() -> int:
+    slot = CURRENT_SLOT.get()
+    return MAIN_TRACK if slot is None else slot + 1
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+def set_tracer(tracer: Optional[Tracer]) -> Optional[Tracer]:
+    '''
+    Activates `tracer` (or disables tracing) and returns the previous one.
+    '''
+    global _tracer
+    previous = _tracer
+    _tracer = tracer
+    return previous
+
+def trace_span(name: str, category: str, **args: Any) -> ContextManager[Any]:
+    '''
+    `Tracer.span` on the active tracer, or a shared no-op context when tracing
+    is disabled.
+    '''
+    tracer = _tracer
+    if tracer is None:
+        return _disabled
+    return tracer.span(name, category, **args)
@@ -0,0 +1,346 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import AbstractSet, Dict, Iterable, List, Optional, Set, Tuple, Union
+from .affected import get_affected_modules
+from .artifact_store import ArtifactStore
+from .build_module_dep import build_module_async
+from .resources import ResourceBudget
+from .changed_files import FileChecksum, diff_module_checksums, iter_modules
+from .diagnostics import DiagnosticBase, DiagnosticKind, DiagnosticLocation
+from .file_globs import GlobCache
+from .graph_cache import GraphCache
+from .hashing import DEFAULT_ALGORITHM
+from .module_graph import load_module_graph
+from .parse_module_dep import DependencyFiles, Module
+from .run_shell_cmds import StepOutputOptions
+from .stat_cache import StatCache
+from .step_cache import StepCache
+import asyncio
+
+DEFAULT_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 0.5
+
+class FileWatcher:
+    '''
+    Reports which of a set of watched files changed, and which of a set of
+    watched directories gained or lost an entry.
+    '''
+    def watch(self, paths: Iterable[Path], directories: Iterable[Path] = ()) -> None:
+        raise NotImplementedError
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        '''
+        Blocks until at least one watched file changed or `timeout` seconds
+        passed, and returns the changed files.
+        '''
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def wait_debounced(self, debounce: float = DEFAULT_DEBOUNCE) -> Set[Path]:
+        '''
+        Waits for a change, then keeps collecting until no change arrived for
+        `debounce` seconds, so a burst of writes results in one rebuild.
+        '''
+        changed = self.wait(None)
+        while True:
+            more = self.wait(debounce)
+            if len(more) == 0:
+                return changed
+            changed |= more
+
+StatKey = Optional[Tuple[int, int, int]]
+
+def stat_key(path: Path) -> StatKey:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class PollingWatcher(FileWatcher):
+    def __init__(self, interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        self.interval = interval
+        self.stats: Dict[Path, StatKey] = {}
+
+    def watch(self, paths: Iterable[Path], directories: Iterable[Path] = ()) -> None:
+        # A directory's mtime changes when an entry is added, removed or renamed.
+        self.stats = { path: self.stats[path] if path in self.stats else stat_key(path) for path in [*paths, *directories] }
+
+    def poll(self) -> Set[Path]:
+        changed: Set[Path] = set()
+        for path, old in self.stats.items():
+            new = stat_key(path)
+            if new != old:
+                self.stats[path] = new
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.poll()
+            if len(changed) > 0:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return changed
+            delay = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+# Flags from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+ENTRY_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(FileWatcher):
+    '''
+    Watches the directories containing the watched files, so files replaced by
+    rename (as most editors and `git checkout` do) are still reported.
+    '''
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError('inotify is not available')
+        self.libc = ctypes.CDLL(libc_name, use_errno = True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories: Dict[Path, int] = {}
+        self.descriptors: Dict[int, Path] = {}
+        self.files: Set[Path] = set()
+        self.entry_dirs: Set[Path] = set()
+
+    def watch(self, paths: Iterable[Path], directories: Iterable[Path] = ()) -> None:
+        self.files = set(paths)
+        self.entry_dirs = set(directories)
+        watched = { path.parent for path in self.files } | self.entry_dirs
+        for directory in list(self.directories):
+            if directory not in watched:
+                wd = self.directories.pop(directory)
+                self.descriptors.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for directory in watched:
+            if directory in self.directories:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                continue
+            self.directories[directory] = wd
+            self.descriptors[wd] = directory
+
+    def read_events(self) -> Set[Path]:
+        changed: Set[Path] = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost; treat everything as changed.
+                    changed |= self.files
+                    continue
+                directory = self.descriptors.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_DELETE_SELF:
+                    changed |= { path for path in self.files if path.parent == directory }
+                    if directory in self.entry_dirs:
+                        changed.add(directory)
+                    continue
+                path = directory / os.fsdecode(name)
+                if path in self.files:
+                    changed.add(path)
+                elif mask & ENTRY_MASK and directory in self.entry_dirs:
+                    changed.add(directory)
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if len(readable) == 0:
+                return set()
+            changed = self.read_events()
+            if len(changed) > 0:
+                return changed
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def open_watcher(polling: bool = False) -> FileWatcher:
+    if not polling:
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher()
+
+def manifest_path(module: Module) -> Path:
+    return module.resolve_base_path / 'module.json'
+
+class WatchSession:
+    '''
+    Keeps the module graph in memory and rebuilds the modules affected by each
+    batch of file changes. Manifest changes reload the graph through in-memory
+    graph and stat caches, so only the changed manifests are parsed again and
+    only the touched files are rehashed.
+    '''
+    def __init__(
+        self,
+        diagnostic: DiagnosticBase,
+        base_path: Union[Path, str] = './',
+        algorithm: str = DEFAULT_ALGORITHM,
+        jobs: Optional[int] = None,
+        step_cache: Optional[StepCache] = None,
+        artifact_store: Optional[ArtifactStore] = None,
+        baseline: Optional[Dict[str, str]] = None,
+        watcher: Optional[FileWatcher] = None,
+        debounce: float = DEFAULT_DEBOUNCE,
+        output: Optional[StepOutputOptions] = None,
+        budget: Optional[ResourceBudget] = None,
+    ) -> None:
+        self.diagnostic = diagnostic
+        self.base_path = Path(base_path)
+        self.algorithm = algorithm
+        self.jobs = jobs
+        self.step_cache = step_cache
+        self.artifact_store = artifact_store
+        # Checksums of the sources as of the last successful build of their module.
+        self.baseline: Dict[str, str] = dict(baseline or {})
+        self.watcher = watcher if watcher is not None else open_watcher()
+        self.debounce = debounce
+        self.output = output
+        self.budget = budget
+        self.stat_cache = StatCache.load()
+        self.graph_cache = GraphCache.load()
+        self.glob_cache = GlobCache.load()
+        self.module: Optional[Module] = None
+        self.owners: Dict[Path, List[DependencyFiles]] = {}
+        self.manifests: Set[Path] = set()
+        # Directories the file globs expand from; a new entry may be a new match.
+        self.glob_dirs: Set[Path] = set()
+
+    def load(self) -> bool:
+        self.glob_cache.walked.clear()
+        module = load_module_graph(self.diagnostic, self.base_path, self.stat_cache, self.algorithm, graph_cache = self.graph_cache, glob_cache = self.glob_cache)
+        try:
+            self.graph_cache.save()
+            self.glob_cache.save()
+        except OSError:
+            pass
+        if module is None:
+            return False
+        self.module = module
+        self.owners = {}
+        self.manifests = set()
+        for current in iter_modules(module):
+            self.manifests.add(manifest_path(current))
+            for file in current.files:
+                self.owners.setdefault(file.get_src_path(), []).append(file)
+        self.glob_dirs = self.glob_cache.walked_dirs()
+        self.watcher.watch(self.manifests | set(self.owners), self.glob_dirs)
+        return True
+
+    def needs_reload(self, changed: AbstractSet[Path]) -> bool:
+        '''
+        Whether `changed` may add or remove modules or files, rather than
+        only change the content of known files.
+        '''
+        return len(changed & self.manifests) > 0 or len(changed & self.glob_dirs) > 0 or any(not path.exists() for path in changed)
+
+    def refresh_files(self, paths: Iterable[Path]) -> None:
+        for path in paths:
+            files = self.owners.get(path, [])
+            if len(files) == 0:
+                continue
+            try:
+                checksum = self.stat_cache.checksum(files[0].src_key, path, self.algorithm)
+            except OSError as e:
+                self.diagnostic.add(DiagnosticLocation(path = path, prefix = None, resolved_base_path = self.base_path.resolve()), DiagnosticKind.ERROR, f'Failed to read "{path}"\n\t{e}')
+                continue
+            for file in files:
+                file.checksum = checksum
+
+    def build_affected(self, changed_manifests: AbstractSet[Path] = frozenset()) -> None:
+        if self.module is None:
+            return
+        cached = { key: FileChecksum(Path(key), checksum) for key, checksum in self.baseline.items() }
+        changes = diff_module_checksums(self.module, cached)
+        # A module whose manifest changed may have different steps; rebuild it too.
+        changed_modules = [current for current in iter_modules(self.module) if manifest_path(current) in changed_manifests]
+        affected = get_affected_modules(self.module, changes, changed_modules)
+        location = DiagnosticLocation.from_module(self.module)
+        if len(affected) == 0:
+            self.diagnostic.add(location, DiagnosticKind.INFO, 'No affected modules')
+            return
+
+        self.diagnostic.add(location, DiagnosticKind.INFO, f'Rebuilding {len(affected)} affected modules')
+        results = asyncio.run(build_module_async(self.diagnostic, self.module, self.jobs, affected, self.step_cache, self.artifact_store, self.output, self.budget))
+        for current, success in results.items():
+            if not success:
+                continue
+            for file in current.files:
+                self.baseline[file.src_key] = file.checksum
+            for key in changes.modules[current].removed:
+                self.baseline.pop(key, None)
+        if self.step_cache is not None:
+            self.step_cache.save()
+
+    def handle(self, changed: Set[Path]) -> None:
+        location = DiagnosticLocation(path = self.base_path / 'module.json', prefix = None, resolved_base_path = self.base_path.resolve())
+        self.diagnostic.add(location, DiagnosticKind.INFO, f'Detected changes in {len(changed)} files')
+        changed_manifests = changed & self.manifests
+        if self.needs_reload(changed):
+            if not self.load():
+                return
+        else:
+            self.refresh_files(changed)
+        self.build_affected(changed_manifests)
+
+    def run(self) -> None:
+        if not self.load():
+            # Still watch the root manifest, so fixing it restarts the build.
+            self.manifests = { (self.base_path / 'module.json').resolve() }
+            self.watcher.watch(self.manifests)
+        else:
+            self.build_affected()
+
+        location = DiagnosticLocation(path = self.base_path / 'module.json', prefix = None, resolved_base_path = self.base_path.resolve())
+        try:
+            while True:
+                self.diagnostic.add(location, DiagnosticKind.INFO, f'Watching {len(self.manifests) + len(self.owners)} files for changes')
+                self.handle(self.watcher.wait_debounced(self.debounce))
+                try:
+                    self.stat_cache.save()
+                except OSError:
+                    pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
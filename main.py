@@ -1,16 +1,277 @@
 import sys
-from build_lib import parse_module, StreamDiagnostics, build_module, parse_cached_file_checksums, get_changed_files_from_module, upsert_checksum
+import build_client
+
+# A request to the daemon must not pay for importing build_lib.
+if __name__ == '__main__' and build_client.is_client(sys.argv[1:]):
+    sys.exit(build_client.main(sys.argv[1:]))
+
+import argparse
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Type
+from build_lib import load_module_graph, StreamDiagnostics, JsonLinesDiagnostics, TeeDiagnostics, DiagnosticKind, build_module, parse_cached_file_checksums, get_changeset_from_module, upsert_checksum
+from build_lib.affected import get_affected_modules
+from build_lib.artifact_store import ARTIFACT_STORE_PATH, DEFAULT_MAX_BYTES, LocalArtifactStore, is_cacheable
+from build_lib.checksum_store import CHECKSUM_FILE_NAME, open_checksum_store
+from build_lib.daemon import DEFAULT_IDLE_TIMEOUT, BuildDaemon
+from build_lib.deploy import DEPLOY_PATH, Deployer
+from build_lib.diagnostics import DiagnosticBase
+from build_lib.git_changes import GIT_ALGORITHM, GitError, GitIndex, get_git_base_checksums
+from build_lib.changed_files import ChangeSet, get_built_changeset, get_changed_files_from_changeset, get_removed_paths, iter_modules
+from build_lib.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+from build_lib.parse_module_dep import parse_memory_size
+from build_lib.resources import ResourceBudget, physical_memory
+from build_lib.run_shell_cmds import DEFAULT_TAIL_LINES, STEP_LOG_PATH, StepOutputOptions
+from build_lib.scheduler import BuildGraph, default_job_count
+from build_lib.sharding import DEFAULT_SHARD_WAIT, DURATIONS_PATH, ModuleDurations, ShardSpec, merge_shard_checksums, merge_shard_durations, plan_shard, shard_checksums_path, shard_durations_path, write_shard_checksums
+from build_lib.step_cache import StepCache
+from build_lib.trace_report import DEFAULT_TOP_STEPS, format_trace_summary
+from build_lib.tracing import Tracer, set_tracer
+from build_lib.watch import WatchSession, open_watcher
 from pprint import pprint
 
+def argument_type(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    '''
+    Lets argparse report the message of the `ValueError` raised by `parse`.
+    '''
+    def convert(text: str) -> Any:
+        try:
+            return parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return convert
+
+class RequestArgumentParser(argparse.ArgumentParser):
+    '''
+    Parses the options of a daemon request, raising instead of exiting the daemon.
+    Without -h/--help, since printing the help exits too.
+    '''
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        kwargs.setdefault('add_help', False)
+        super().__init__(*args, **kwargs)
+
+    def error(self, message: str) -> Any:
+        raise ValueError(message)
+
+    def exit(self, status: int = 0, message: Optional[str] = None) -> Any:
+        raise ValueError(message or f'Exited with status {status}')
+
+def parse_args(argv: Optional[List[str]] = None, parser_class: Type[argparse.ArgumentParser] = argparse.ArgumentParser) -> argparse.Namespace:
+    parser = parser_class(description = 'Build the modules of the repository')
+    parser.add_argument('-j', '--jobs', type = int, default = default_job_count(), help = 'Maximum number of modules built in parallel (default: number of CPUs)')
+    parser.add_argument('--cpu-slots', type = int, help = 'CPU slots shared by the running steps; a step takes one unless its "resources" declare otherwise (default: --jobs)')
+    parser.add_argument('--memory-budget', type = argument_type(parse_memory_size), help = 'Memory shared by the running steps, e.g. "24G", as declared by their "resources" (default: physical memory)')
+    parser.add_argument('--hash-algorithm', choices = sorted(ALGORITHMS), default = DEFAULT_ALGORITHM, help = f'Algorithm used to checksum files (default: {DEFAULT_ALGORITHM})')
+    parser.add_argument('--checksum-store', choices = ['json', 'sqlite'], default = 'json', help = 'Backend of the checksum store; checksums.json is kept up to date with either (default: json)')
+    parser.add_argument('--change-detection', choices = ['checksum', 'git'], default = 'checksum', help = 'Compare checksums with the checksum store, or git blob ids with a base revision, hashing only untracked and dirty files (default: checksum)')
+    parser.add_argument('--base-rev', metavar = 'REV', help = f'Revision compared with by --change-detection git (default: the last commit of {CHECKSUM_FILE_NAME})')
+    parser.add_argument('--fail-fast', action = 'store_true', help = 'Stop at the first module that fails, cancelling the running steps and skipping the modules not started yet')
+    parser.add_argument('--full', action = 'store_true', help = 'Build every module instead of only the modules affected by changed files')
+    parser.add_argument('--no-step-cache', action = 'store_true', help = 'Run every step even if its declared inputs did not change')
+    parser.add_argument('--artifact-cache', type = Path, nargs = '?', const = ARTIFACT_STORE_PATH, metavar = 'DIR', help = f'Restore the outputs of affected modules from a build artifact cache instead of running their steps; only safe when every step declares its inputs. DIR may be on a shared filesystem (default: {ARTIFACT_STORE_PATH})')
+    parser.add_argument('--artifact-cache-size', type = int, default = DEFAULT_MAX_BYTES, help = 'Maximum size of the artifact cache in bytes')
+    parser.add_argument('--watch', action = 'store_true', help = 'Keep running and rebuild the affected modules whenever a manifest or source file changes')
+    parser.add_argument('--poll', action = 'store_true', help = 'Poll for changes in watch mode instead of using inotify')
+    parser.add_argument('--shard', type = argument_type(ShardSpec.parse), metavar = 'i/N', help = 'Build only the i-th of N shards of the affected modules, balanced by recorded durations; includes built by other shards are restored from a shared --artifact-cache, or kept on one shard without it')
+    parser.add_argument('--shard-wait', type = float, default = DEFAULT_SHARD_WAIT, help = f'Seconds a shard waits for the artifacts of an include built by another shard (default: {DEFAULT_SHARD_WAIT:.0f})')
+    parser.add_argument('--shard-checksums', type = Path, metavar = 'FILE', help = 'Checksum updates of this shard (default: checksums.shard-i-of-N.json)')
+    parser.add_argument('--durations', type = Path, default = DURATIONS_PATH, help = f'Build times of the modules, recorded by every build and used to balance shards; all shards must read the same file and leave it untouched. The default is not committed, so CI must persist it between runs (e.g. restore it before the shards and save it after --merge-durations), or shards are balanced by step counts (default: {DURATIONS_PATH})')
+    parser.add_argument('--shard-durations', type = Path, metavar = 'FILE', help = 'Build times recorded by this shard (default: next to --durations, e.g. durations.shard-i-of-N.json)')
+    parser.add_argument('--merge-checksums', type = Path, nargs = '+', metavar = 'FILE', help = f'Merge the checksum updates of all shards into the checksum store and exit')
+    parser.add_argument('--merge-durations', type = Path, nargs = '+', metavar = 'FILE', help = 'With --merge-checksums, also merge the build times recorded by all shards into --durations')
+    parser.add_argument('--deploy-dir', type = Path, default = DEPLOY_PATH, help = f'Destination the deploy steps publish changed build files to (default: {DEPLOY_PATH})')
+    parser.add_argument('--print-affected', action = 'store_true', help = 'Print the modules that would be built and exit without building')
+    parser.add_argument('--log-level', choices = [kind.name.lower() for kind in DiagnosticKind], default = 'info', help = 'Least severe diagnostics printed, from info < success < warning < error (default: info)')
+    parser.add_argument('--diagnostics-json', type = Path, metavar = 'FILE', help = 'Also write every diagnostic as a JSON object per line to FILE, regardless of --log-level')
+    parser.add_argument('--live-output', action = 'store_true', help = 'Print the output of steps line by line while they run')
+    parser.add_argument('--log-dir', type = Path, default = STEP_LOG_PATH, help = f'Directory of the full output log of every step (default: {STEP_LOG_PATH})')
+    parser.add_argument('--no-step-logs', action = 'store_true', help = 'Do not write step output to log files')
+    parser.add_argument('--output-tail', type = int, default = DEFAULT_TAIL_LINES, help = f'Number of last output lines of a step shown after it finished (default: {DEFAULT_TAIL_LINES})')
+    parser.add_argument('--trace', type = Path, metavar = 'FILE', help = 'Write a Chrome trace_event JSON file of the build, with one track per worker')
+    parser.add_argument('--trace-summary', action = 'store_true', help = 'Print the time spent in every phase, the critical path and the slowest steps')
+    parser.add_argument('--trace-top', type = int, default = DEFAULT_TOP_STEPS, help = f'Number of slowest steps in the trace summary (default: {DEFAULT_TOP_STEPS})')
+    parser.add_argument('--daemon', action = 'store_true', help = 'Serve builds from a background process that keeps the module graph and caches in memory')
+    parser.add_argument('--daemon-idle-timeout', type = float, default = DEFAULT_IDLE_TIMEOUT, help = f'Seconds without requests after which the daemon stops (default: {DEFAULT_IDLE_TIMEOUT:.0f})')
+    parser.add_argument('--connect', action = 'store_true', help = 'Send the build (or --print-affected) to the daemon, starting it if needed, and stream its output')
+    parser.add_argument('--daemon-status', action = 'store_true', help = 'Print the state of the running daemon')
+    parser.add_argument('--daemon-stop', action = 'store_true', help = 'Stop the running daemon')
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error(f'--jobs must be at least 1, but found {args.jobs}')
+    if args.cpu_slots is not None and args.cpu_slots < 1:
+        parser.error(f'--cpu-slots must be at least 1, but found {args.cpu_slots}')
+    if args.output_tail < 0:
+        parser.error(f'--output-tail must not be negative, but found {args.output_tail}')
+    if args.watch and (args.trace is not None or args.trace_summary):
+        parser.error('--trace and --trace-summary cannot be used with --watch')
+    if args.watch and args.change_detection == 'git':
+        parser.error('--change-detection git cannot be used with --watch')
+    if args.watch and args.shard is not None:
+        parser.error('--shard cannot be used with --watch')
+    if args.shard_checksums is not None and args.shard is None:
+        parser.error('--shard-checksums requires --shard')
+    if args.shard_durations is not None and args.shard is None:
+        parser.error('--shard-durations requires --shard')
+    if args.merge_durations is not None and args.merge_checksums is None:
+        parser.error('--merge-durations requires --merge-checksums')
+    if args.base_rev is not None and args.change_detection != 'git':
+        parser.error('--base-rev requires --change-detection git')
+    if args.daemon and (args.watch or args.shard is not None or args.merge_checksums is not None or args.change_detection == 'git'):
+        parser.error('--daemon cannot be used with --watch, --shard, --merge-checksums or --change-detection git')
+    return args
+
+def parse_request(daemon_args: argparse.Namespace, argv: List[str]) -> argparse.Namespace:
+    '''
+    Options of a request to the daemon; the options that configure the
+    daemon's caches must match the ones it was started with.
+    '''
+    args = parse_args(argv, RequestArgumentParser)
+    if args.watch or args.shard is not None or args.merge_checksums is not None or args.trace is not None or args.trace_summary or args.diagnostics_json is not None:
+        raise ValueError('--watch, --shard, --merge-checksums, --trace, --trace-summary and --diagnostics-json are not supported by the daemon')
+    for name in ('hash_algorithm', 'checksum_store', 'change_detection', 'no_step_cache', 'artifact_cache', 'durations'):
+        if getattr(args, name) != getattr(daemon_args, name):
+            raise ValueError(f'--{name.replace("_", "-")} differs from the running daemon; stop it with --daemon-stop first')
+    return args
+
+def open_diagnostics(args: argparse.Namespace) -> DiagnosticBase:
+    console = StreamDiagnostics(sys.stdout, DiagnosticKind.from_name(args.log_level), background = True)
+    if args.diagnostics_json is None:
+        return console
+    return TeeDiagnostics([console, JsonLinesDiagnostics(args.diagnostics_json.open('w'), background = True)])
+
 def main() -> None:
-    module = parse_module()
+    args = parse_args()
+    with open_diagnostics(args) as diagnostic:
+        run(args, diagnostic)
+
+def merge_checksums(args: argparse.Namespace, diagnostic: DiagnosticBase) -> None:
+    try:
+        checksums = merge_shard_checksums(args.merge_checksums)
+        store = open_checksum_store(args.checksum_store)
+        store.apply({ key: checksum for key, checksum in checksums.items() if checksum is not None }, [key for key, checksum in checksums.items() if checksum is None])
+    except (ValueError, OSError, sqlite3.Error) as e:
+        diagnostic.add(None, DiagnosticKind.ERROR, f'Failed to merge shard checksums\n\t{e}')
+        sys.exit(1)
+    diagnostic.add(None, DiagnosticKind.SUCCESS, f'Merged {len(checksums)} checksums from {len(args.merge_checksums)} shards')
+
+    if args.merge_durations is not None:
+        try:
+            entries = merge_shard_durations(args.merge_durations)
+            durations = ModuleDurations.load(args.durations)
+            durations.update(entries)
+            durations.save()
+        except OSError as e:
+            diagnostic.add(None, DiagnosticKind.ERROR, f'Failed to merge shard durations\n\t{e}')
+            sys.exit(1)
+        diagnostic.add(None, DiagnosticKind.SUCCESS, f'Merged {len(entries)} module durations from {len(args.merge_durations)} shards into "{args.durations}"')
+
+def run(args: argparse.Namespace, diagnostic: DiagnosticBase) -> None:
+    if args.merge_checksums is not None:
+        merge_checksums(args, diagnostic)
+        return
+
+    step_cache = None if args.no_step_cache else StepCache.load()
+    artifact_store = None if args.artifact_cache is None else LocalArtifactStore(args.artifact_cache, args.artifact_cache_size)
+    output = StepOutputOptions(live = args.live_output, log_dir = None if args.no_step_logs else args.log_dir, tail_lines = args.output_tail)
+    budget = ResourceBudget(cpu = args.jobs if args.cpu_slots is None else args.cpu_slots, memory = physical_memory() if args.memory_budget is None else args.memory_budget)
+
+    if args.daemon:
+        BuildDaemon(
+            diagnostic,
+            lambda argv: parse_request(args, argv),
+            open_checksum_store(args.checksum_store),
+            ModuleDurations.load(args.durations),
+            args.daemon_idle_timeout,
+            algorithm = args.hash_algorithm,
+            jobs = args.jobs,
+            step_cache = step_cache,
+            artifact_store = artifact_store,
+            watcher = open_watcher(args.poll),
+            output = output,
+            budget = budget,
+        ).run()
+        return
+
+    if args.watch:
+        checksum_store = open_checksum_store(args.checksum_store)
+        baseline = {} if args.full else { str(file.path): file.checksum for file in parse_cached_file_checksums(diagnostic, checksum_store) or [] }
+        WatchSession(diagnostic, algorithm = args.hash_algorithm, jobs = args.jobs, step_cache = step_cache, artifact_store = artifact_store, baseline = baseline, watcher = open_watcher(args.poll), output = output, budget = budget).run()
+        return
+
+    tracer = Tracer() if args.trace is not None or args.trace_summary else None
+    set_tracer(tracer)
+    git_index = None
+    algorithm = args.hash_algorithm
+    if args.change_detection == 'git':
+        try:
+            git_index = GitIndex.load()
+        except GitError as e:
+            diagnostic.add(None, DiagnosticKind.ERROR, f'Failed to read the git index\n\t{e}')
+            sys.exit(1)
+        algorithm = GIT_ALGORITHM
+    module = load_module_graph(diagnostic, stat_cache = git_index, algorithm = algorithm)
+    if git_index is not None:
+        git_index.save()
+    if module is None:
+        sys.exit(1)
+
+    checksum_store = open_checksum_store(args.checksum_store)
+    files = parse_cached_file_checksums(diagnostic, checksum_store)
+    if git_index is not None:
+        files = get_git_base_checksums(diagnostic, module, args.base_rev, files)
+    changes = get_changeset_from_module(diagnostic, module, files)
+    affected = set(iter_modules(module)) if args.full else get_affected_modules(module, changes)
+    durations = ModuleDurations.load(args.durations)
+    shard = None
+    if args.shard is not None:
+        if len(durations.entries) == 0:
+            diagnostic.add(None, DiagnosticKind.WARNING, f'No build times recorded in "{args.durations}", balancing shards by step counts; persist --durations between CI runs')
+        shard = plan_shard(BuildGraph.from_module(module).subgraph(affected), args.shard, durations, None if artifact_store is None else is_cacheable, args.shard_wait)
+        affected = shard.only()
+        diagnostic.add(None, DiagnosticKind.INFO, f'Shard {args.shard}: {len(shard.modules)} modules, estimated {sum(durations.estimate(current) for current in shard.modules):.1f}s, {len(shard.foreign)} includes from other shards')
+    # Deploy steps publish the files of every module they include, even those built by other shards.
+    deployer = Deployer(args.deploy_dir, changes, args.jobs, modules = None if shard is None else shard.modules)
+    if shard is not None:
+        # Only the files of this shard's modules are recorded by it.
+        changes = ChangeSet(modules = { current: change for current, change in changes.modules.items() if current in shard.modules })
+
+    if args.print_affected:
+        diagnostic.flush()
+        for node in BuildGraph.from_module(module).subgraph(affected).topological_order():
+            print(f'{node.module.name}\t{node.module.path}')
+        return
+
+    diagnostic.flush()
     pprint(module)
-    diagnostic = StreamDiagnostics(sys.stdout)
-    build_module(diagnostic, module)
-    files = parse_cached_file_checksums(diagnostic)
-    changed_files = get_changed_files_from_module(diagnostic, module, files)
+    if args.shard is not None:
+        # The durations all shards planned with stay untouched until they are merged.
+        durations = durations.for_shard(args.shard_durations or shard_durations_path(args.durations, args.shard))
+    results = build_module(diagnostic, module, jobs = args.jobs, only = affected, step_cache = step_cache, artifact_store = artifact_store, output = output, budget = budget, durations = durations, shard = shard, fail_fast = args.fail_fast, deployer = deployer)
+    changed_files = get_changed_files_from_changeset(diagnostic, module, get_built_changeset(changes, results), check_build_paths = files is not None)
+    changed_files -= deployer.undeployed(changed_files)
+    # The shard of a deploy step also records the files it published for other shards.
+    changed_files |= deployer.published
+    removed = get_removed_paths(changes, results)
+    diagnostic.flush()
     print(changed_files)
-    upsert_checksum(diagnostic, changed_files)
+    if args.shard is None:
+        upsert_checksum(diagnostic, changed_files, store = checksum_store, removed = removed)
+    else:
+        shard_path = args.shard_checksums or shard_checksums_path(args.shard)
+        shard_checksums: Dict[str, Optional[str]] = { key: None for key in removed }
+        shard_checksums.update({ file.src_key: file.checksum for file in changed_files })
+        write_shard_checksums(shard_path, shard_checksums)
+        diagnostic.add(None, DiagnosticKind.INFO, f'Wrote {len(changed_files)} checksums of shard {args.shard} to "{shard_path}"')
+
+    if tracer is not None:
+        if args.trace is not None:
+            tracer.export_chrome(args.trace)
+        if args.trace_summary:
+            diagnostic.flush()
+            print(format_trace_summary(tracer, module, args.trace_top))
+
+    if not all(results.values()):
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()